@@ -0,0 +1,377 @@
+import gzip
+import hashlib
+import json
+import math
+import os
+import re
+import threading
+from datetime import date
+
+from flask import Blueprint, Response, abort, request, send_file
+from werkzeug.security import safe_join
+
+import report_index
+from clusters import ClusterHolder
+from map_payload import PAYLOAD_DIR, write_payload
+from spatial_index import SpatialHolder
+from static_files import ENCODINGS
+from stats_cube import TOP_N, StatsHolder, month_of
+from text_index import TextHolder, snippet
+import report_store
+from report_store import EPOCH, parse_day
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+# Responses smaller than this are sent uncompressed
+MIN_COMPRESS_SIZE = 1024
+DEFAULT_LIMIT = 100
+DEFAULT_NEARBY_KM = 10
+# Larger radii are capped (the whole country is within this of any point in it)
+MAX_NEARBY_KM = 500
+DEFAULT_SEARCH_LIMIT = 20
+MONTH_RE = re.compile(r'^\d{4}-(0[1-9]|1[0-2])$')
+MIMETYPES = {'.json': 'application/json', '.bin': 'application/octet-stream'}
+MAX_LIMIT = 1000
+
+api = Blueprint('api', __name__, url_prefix='/api')
+reports_index = report_index.ReportIndexHolder()
+report_clusters = ClusterHolder()
+report_locations = SpatialHolder()
+report_texts = TextHolder()
+report_stats = StatsHolder()
+
+
+@api.record_once
+def populate_store(state):
+    # an empty store is filled at startup, in the background, not by the first request
+    reports_index.start()
+payload_version = None
+payload_lock = threading.Lock()
+# one report store connection per request thread, opened on its first /changes request
+store_connections = threading.local()
+
+
+def compress(body):
+    """Compresses a response body with the best encoding the client accepts.
+
+    Returns:
+    --------
+    body: bytes
+        the (possibly) compressed body
+    encoding: str or None
+        the Content-Encoding, None if not compressed
+    """
+    if len(body) < MIN_COMPRESS_SIZE:
+        return body, None
+    offered = ['br', 'gzip'] if brotli is not None else ['gzip']
+    encoding = request.accept_encodings.best_match(offered)
+    if encoding == 'br':
+        return brotli.compress(body, quality=5), encoding
+    if encoding == 'gzip':
+        return gzip.compress(body, compresslevel=6), encoding
+    return body, None
+
+
+def json_response(build, version, last_modified):
+    '''Serve a JSON payload with validators, answering conditional requests without building it
+
+    Parameters:
+    -----------
+    build: callable
+        () -> the JSON-serialisable payload
+    version: str
+        the version of the data the payload is computed from
+    last_modified: float
+        epoch time the data last changed
+
+    Returns:
+    --------
+    response: Response
+        304 if the client's copy is current, else the (compressed) JSON
+    '''
+    # the payload only depends on the route, the data version and the query arguments
+    key = request.path + '@' + version + '?' + '&'.join('%s=%s' % item for item in sorted(request.args.items(multi=True)))
+    etag = hashlib.sha1(key.encode('utf-8')).hexdigest()[:16]
+
+    response = Response(mimetype='application/json')
+    response.set_etag(etag, weak=True)
+    response.last_modified = last_modified
+    response.vary.add('Accept-Encoding')
+    response.cache_control.no_cache = True
+    if request.if_none_match.contains_weak(etag):
+        response.status_code = 304
+        return response
+
+    body, encoding = compress(json.dumps(build(), ensure_ascii=False).encode('utf-8'))
+    response.set_data(body)
+    if encoding:
+        response.content_encoding = encoding
+    # handles If-Modified-Since
+    return response.make_conditional(request)
+
+
+def send_precompressed(directory, filename):
+    '''Serve a static file, or its precompressed .br/.gz variant if the client accepts it
+
+    The response is conditional (ETag / Last-Modified of the file sent) and must be
+    revalidated, since the file names are not versioned.
+    '''
+    path = safe_join(directory, filename)
+    if path is None or not os.path.isfile(path):
+        abort(404)
+    variants = {encoding: path + suffix for encoding, suffix in ENCODINGS if os.path.isfile(path + suffix)}
+    encoding = request.accept_encodings.best_match(list(variants)) if variants else None
+    mimetype = MIMETYPES.get(os.path.splitext(filename)[1], 'application/octet-stream')
+    response = send_file(variants[encoding] if encoding else path, mimetype=mimetype, conditional=True)
+    if encoding:
+        response.content_encoding = encoding
+    response.vary.add('Accept-Encoding')
+    response.cache_control.no_cache = True
+    return response
+
+
+def parse_month(value):
+    '''"YYYY-MM" or a date (DD/MM/YYYY, YYYY-MM-DD) -> "YYYY-MM". Raises ValueError if invalid.'''
+    if MONTH_RE.match(value):
+        return value
+    month = month_of(parse_day(value))
+    if month is None:
+        raise ValueError('invalid month %r, expected YYYY-MM, DD/MM/YYYY or YYYY-MM-DD' % value)
+    return month
+
+
+def error(message, status=400):
+    return Response(json.dumps({'error': message}), status=status, mimetype='application/json')
+
+
+@api.route('/reports')
+def reports():
+    '''Query the stored reports, newest first
+
+    Query parameters (all optional):
+    - from, to: date range (DD/MM/YYYY or YYYY-MM-DD), inclusive
+    - flower: flower name
+    - source: comma-separated sources (wildflowers, tiuli, merged, flask)
+    - bbox: min_lon,min_lat,max_lon,max_lat; keeps reports with a sighting inside it
+    - cursor: next_cursor of the previous page
+    - limit: page size (default 100, at most 1000)
+    '''
+    try:
+        date_from = parse_day(request.args['from']) if 'from' in request.args else None
+        date_to = parse_day(request.args['to']) if 'to' in request.args else None
+        bbox = report_index.parse_bbox(request.args['bbox']) if 'bbox' in request.args else None
+        limit = min(max(int(request.args.get('limit', DEFAULT_LIMIT)), 1), MAX_LIMIT)
+    except ValueError as e:
+        return error('invalid query parameter: %s' % e)
+    cursor = request.args.get('cursor')
+    if cursor:
+        try:
+            report_index.parse_cursor(cursor)
+        except ValueError:
+            return error('invalid cursor')
+    if 'from' in request.args and date_from is None or 'to' in request.args and date_to is None:
+        return error('invalid date, expected DD/MM/YYYY or YYYY-MM-DD')
+
+    index = reports_index.get()
+
+    def build():
+        results, next_cursor, total = index.query(
+            date_from, date_to, flower=request.args.get('flower'), source=request.args.get('source'),
+            bbox=bbox, cursor=cursor or None, limit=limit)
+        return {'total': total, 'count': len(results), 'next_cursor': next_cursor, 'reports': results}
+
+    return json_response(build, index.version, index.built_at)
+
+
+@api.route('/clusters')
+def clusters():
+    '''Marker clusters for a map viewport
+
+    Query parameters:
+    - bbox: min_lon,min_lat,max_lon,max_lat of the viewport
+    - zoom: the map zoom level; above clusters.MAX_ZOOM single sightings are returned
+    '''
+    try:
+        bbox = report_index.parse_bbox(request.args['bbox'])
+        zoom = int(request.args['zoom'])
+    except KeyError as e:
+        return error('missing query parameter: %s' % e.args[0])
+    except ValueError as e:
+        return error('invalid query parameter: %s' % e)
+
+    index = reports_index.get()
+    clusters = report_clusters.get(index)
+    return json_response(lambda: {'zoom': zoom, 'clusters': clusters.query(bbox, zoom)}, clusters.version, index.built_at)
+
+
+@api.route('/nearby')
+def nearby():
+    '''Sightings near a point, nearest first
+
+    Query parameters:
+    - lat, lon: the point
+    - km: search radius (default 10, at most 500)
+    - days: only sightings from the last `days` days before `to` (default: any date)
+    - to: end of the date window (DD/MM/YYYY or YYYY-MM-DD, default today)
+    - flower: flower name
+    - k: return only the k nearest sightings
+    - limit: maximal number of sightings (default 100, at most 1000)
+    '''
+    try:
+        lat = float(request.args['lat'])
+        lon = float(request.args['lon'])
+        km = float(request.args.get('km', DEFAULT_NEARBY_KM))
+        days = int(request.args['days']) if 'days' in request.args else None
+        k = int(request.args['k']) if 'k' in request.args else None
+        limit = min(max(int(request.args.get('limit', DEFAULT_LIMIT)), 1), MAX_LIMIT)
+    except KeyError as e:
+        return error('missing query parameter: %s' % e.args[0])
+    except ValueError as e:
+        return error('invalid query parameter: %s' % e)
+    if not (math.isfinite(lat) and math.isfinite(lon) and -90 <= lat <= 90 and -180 <= lon <= 180):
+        return error('lat and lon must be valid coordinates')
+    if not km >= 0:
+        return error('km must be a non-negative number')
+    km = min(km, MAX_NEARBY_KM)
+    date_to = parse_day(request.args['to']) if 'to' in request.args else (date.today() - EPOCH).days
+    if date_to is None:
+        return error('invalid date, expected DD/MM/YYYY or YYYY-MM-DD')
+    date_from = date_to - days if days is not None else None
+    if days is None and 'to' not in request.args:
+        date_to = None
+    flower = request.args.get('flower')
+
+    index = reports_index.get()
+    spatial = report_locations.get(index)
+
+    def build():
+        if k is not None:
+            found = spatial.nearest(lat, lon, min(k, limit), km, date_from, date_to, flower)
+        else:
+            found = spatial.within(lat, lon, km, date_from, date_to, flower)
+        points = [dict(point, distance_km=round(distance, 3)) for distance, point in found[:limit]]
+        return {'total': len(found), 'count': len(points), 'points': points}
+
+    return json_response(build, spatial.version, index.built_at)
+
+
+@api.route('/search')
+def search():
+    '''Full-text search over the report titles and texts, best match first
+
+    Query parameters:
+    - q: the query; every word must match. Words match with or without Hebrew prefix
+      letters (ו, ה, ב, ל, מ, ש, כ), `word*` is a prefix search and "quoted words" a phrase.
+    - limit: maximal number of results (default 20, at most 1000)
+    '''
+    query = request.args.get('q', '').strip()
+    if not query:
+        return error('missing query parameter: q')
+    try:
+        limit = min(max(int(request.args.get('limit', DEFAULT_SEARCH_LIMIT)), 1), MAX_LIMIT)
+    except ValueError as e:
+        return error('invalid query parameter: %s' % e)
+
+    index = reports_index.get()
+    text_index = report_texts.get(index)
+
+    def build():
+        total, results = text_index.search(query, limit)
+        return {'total': total, 'count': len(results), 'results': [{
+            'id': report['id'], 'score': round(score, 4), 'source': report['source'], 'date': report['date'],
+            'observer': report['observer'], 'title': report['title'], 'snippet': snippet(report, position),
+        } for score, report, position in results]}
+
+    return json_response(build, text_index.version, index.built_at)
+
+
+@api.route('/stats')
+def stats():
+    '''Report statistics (totals, per-flower counts, top locations, monthly trends) of a slice
+
+    Query parameters (all optional):
+    - from, to: month range (YYYY-MM, or dates, counted by whole months), inclusive
+    - source: comma-separated sources
+    - flower: restrict the statistics to one flower
+    - top: length of the top flowers / locations lists (default 5)
+    '''
+    try:
+        month_from = parse_month(request.args['from']) if 'from' in request.args else None
+        month_to = parse_month(request.args['to']) if 'to' in request.args else None
+        top = min(max(int(request.args.get('top', TOP_N)), 1), MAX_LIMIT)
+    except ValueError as e:
+        return error('invalid query parameter: %s' % e)
+    sources = set(request.args['source'].split(',')) if request.args.get('source') else None
+
+    index = reports_index.get()
+    cube = report_stats.get(index)
+    if cube is None:
+        return error('the statistics are being prepared, please try again shortly', 503)
+    return json_response(lambda: cube.slice(month_from, month_to, sources, request.args.get('flower'), top),
+                         cube.version, index.built_at)
+
+
+@api.route('/payload/<path:filename>')
+def payload(filename):
+    '''The compact map payload (see map_payload.py): meta.json, points.bin, places.json and texts.json
+
+    Rebuilt from the report index, in a background thread, whenever it changes; the
+    last payload written is served meanwhile. meta.json names the data files by version
+    (<version>/points.bin ...), and those never change.
+    '''
+    index = reports_index.get()
+    if payload_version != index.version and not payload_lock.locked():
+        threading.Thread(target=refresh_payload, args=(index,), name="payload-refresh", daemon=True).start()
+    if filename == 'meta.json' and not os.path.exists(os.path.join(PAYLOAD_DIR, filename)):
+        return error('the map payload is being prepared, please try again shortly', 503)
+    return send_precompressed(PAYLOAD_DIR, filename)
+
+
+def refresh_payload(index):
+    '''Writes the payload of a report index, unless another thread is already writing one'''
+    global payload_version
+    if not payload_lock.acquire(blocking=False):
+        return
+    try:
+        if payload_version != index.version:
+            write_payload(index.reports)
+            payload_version = index.version
+    except Exception as e:
+        print('failed to write the map payload: %s: %s' % (type(e).__name__, e))
+    finally:
+        payload_lock.release()
+
+
+def store_connection():
+    '''The report store connection of the current thread'''
+    conn = getattr(store_connections, 'conn', None)
+    if conn is None:
+        conn = store_connections.conn = report_store.connect(reports_index.store_file)
+    return conn
+
+
+@api.route('/changes')
+def changes():
+    '''Reports inserted, updated or deleted since a cursor, oldest change first
+
+    Query parameters:
+    - since: the cursor returned by the previous call (default 0: every report)
+    - limit: maximal number of changed reports (default 100, at most 1000)
+
+    Returns {changes: [{seq, op, id, report}], cursor, more}; call again with
+    since=cursor while `more` is true.
+    '''
+    try:
+        since = int(request.args.get('since', 0))
+        limit = min(max(int(request.args.get('limit', DEFAULT_LIMIT)), 1), MAX_LIMIT)
+    except ValueError as e:
+        return error('invalid query parameter: %s' % e)
+
+    index = reports_index.get()
+    conn = store_connection()
+    changed, cursor, more = report_store.query_changes(conn, since, limit)
+    version = report_index.store_version(conn)
+    return json_response(lambda: {'changes': changed, 'cursor': str(cursor), 'more': more}, version, index.built_at)
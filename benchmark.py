@@ -0,0 +1,437 @@
+import gc
+import glob
+import json
+import os
+import platform
+import random
+import shutil
+import statistics
+import sys
+import tempfile
+import time
+import tracemalloc
+
+# The scenarios never reach the network: the API clients replay recorded fixtures (see replay.py),
+# so a lookup missing from them fails fast instead of calling a geocoder
+os.environ.setdefault("API_REPLAY", "replay")
+
+ROOT = os.path.dirname(os.path.abspath(__file__))
+RESULTS_DIR = "bench_results"
+# A scenario regresses when its ops/sec drop, or its peak memory grows, by more than this
+SPEED_THRESHOLD = 0.10
+MEMORY_THRESHOLD = 0.20
+
+
+def fixture(*parts):
+    return os.path.join(ROOT, *parts)
+
+
+def synthesize_reports(reports, scale, seed=0):
+    """Returns `scale` copies of reports; the extra copies are shifted by up to a year so they are distinct reports."""
+    from report_store import format_day, parse_day
+
+    rng = random.Random(seed)
+    synthetic = list(reports)
+    for copy in range(1, scale):
+        for report in reports:
+            day = parse_day(report.get("date"))
+            if day is not None:
+                shift = rng.randint(1, 365) * rng.choice((-1, 1))
+                synthetic.append(dict(report, date=format_day(day + shift)))
+            else:
+                synthetic.append(dict(report, observer="%s (%d)" % (report.get("observer") or "", copy)))
+    return synthetic
+
+
+class Corpus:
+    def __init__(self, scale=1, workdir=None):
+        """The checked-in fixtures, repeated `scale` times, loaded on first use.
+
+        Pages are repeated as they are; reports are synthesised with shifted dates
+        (see synthesize_reports). Files the scenarios need on disk go to workdir.
+        """
+        self.scale = scale
+        self.workdir = workdir or tempfile.mkdtemp(prefix="flowers-bench-")
+        self._cache = {}
+
+    def _get(self, name, load):
+        if name not in self._cache:
+            self._cache[name] = load()
+        return self._cache[name]
+
+    @staticmethod
+    def _read(paths):
+        pages = []
+        for path in paths:
+            with open(path, "r", encoding="utf-8") as f:
+                pages.append((os.path.basename(path), f.read()))
+        return pages
+
+    @property
+    def wildflowers_pages(self):
+        return self._get("wildflowers_pages", lambda: self._read(
+            sorted(glob.glob(fixture("data", "page_*.html")))) * self.scale)
+
+    @property
+    def tiuli_pages(self):
+        return self._get("tiuli_pages", lambda: self._read(
+            sorted(glob.glob(fixture("tiuli_scraped_reports", "*.html")))) * self.scale)
+
+    @property
+    def merged_reports(self):
+        def load():
+            from json_stream import iter_reports
+            return synthesize_reports(list(iter_reports(fixture("merged_reports.json"))), self.scale)
+        return self._get("merged_reports", load)
+
+    @property
+    def flask_reports(self):
+        def load():
+            with open(fixture("static", "reports.json"), "r", encoding="utf-8") as f:
+                return synthesize_reports(json.load(f), self.scale)
+        return self._get("flask_reports", load)
+
+    @property
+    def llm_output_dir(self):
+        """A directory with the LLM output files, copied `scale` times under distinct names."""
+        def build():
+            path = os.path.join(self.workdir, "output")
+            os.makedirs(path, exist_ok=True)
+            for source in sorted(glob.glob(fixture("output", "page_*.json"))):
+                name = os.path.basename(source)[:-len(".json")]
+                for copy in range(self.scale):
+                    shutil.copyfile(source, os.path.join(path, "%s%s.json" % (name, "_%d" % copy if copy else "")))
+            return path
+        return self._get("llm_output_dir", build)
+
+    @property
+    def store_file(self):
+        """A report store holding the (scaled) merged reports."""
+        def build():
+            import report_store
+            path = os.path.join(self.workdir, "reports.db")
+            conn = report_store.connect(path)
+            report_store.ingest_reports(conn, self.merged_reports, "merged")
+            conn.close()
+            return path
+        return self._get("store_file", build)
+
+
+# Every scenario is set up from a corpus and returns (run, ops): run() does `ops`
+# operations and is what gets timed. Setup (loading fixtures, building stores) is not.
+SCENARIOS = {}
+
+
+def scenario(name):
+    def register(setup):
+        SCENARIOS[name] = setup
+        return setup
+    return register
+
+
+@scenario("wildflowers_segment")
+def wildflowers_segment(corpus):
+    from wildflowers_parse import parse_page
+
+    pages = corpus.wildflowers_pages
+
+    def run():
+        for number, (_, html) in enumerate(pages):
+            parse_page(html, number)
+    return run, len(pages)
+
+
+@scenario("tiuli_parse")
+def tiuli_parse(corpus):
+    from tiuli_parse import extract_data_from_html
+
+    pages = corpus.tiuli_pages
+
+    def run():
+        for filename, html in pages:
+            try:
+                extract_data_from_html(html, filename)
+            except Exception:
+                pass  # a few pages have no report details, as in process_html_files
+    return run, len(pages)
+
+
+@scenario("merge")
+def merge(corpus):
+    from merge import merge_json_files
+
+    folder = corpus.llm_output_dir
+    output_file = os.path.join(corpus.workdir, "merged.json")
+    manifest_file = os.path.join(corpus.workdir, "merge_manifest.json")
+
+    def run():
+        # a full rebuild, decoded in this process so its memory is measured
+        merge_json_files(folder, output_file, manifest_file=manifest_file, workers=1)
+    return run, len(os.listdir(folder))
+
+
+def _geocode_cache_scenario(hit_ratio, lookups=20000):
+    def setup(corpus):
+        from map_layer import GeocodeCache
+
+        cache_file = os.path.join(corpus.workdir, "geocode_cache_%d.csv" % (hit_ratio * 100))
+        if os.path.exists(cache_file):
+            os.remove(cache_file)
+        cache = GeocodeCache(lambda location: (31.5, 35.0), cache_file=cache_file,
+                             seed_files=(fixture("location_cache.csv"),))
+        # the seed cache, scaled with distinct names
+        known = list(cache.cache)
+        for copy in range(1, corpus.scale):
+            cache.cache.update({"%s %d" % (name, copy): cache.cache[name] for name in known})
+        known = list(cache.cache)
+        rng = random.Random(0)
+        runs = [0]
+
+        def run():
+            # misses use new names on every run, so they stay misses (and are appended to the CSV)
+            runs[0] += 1
+            for i in range(lookups):
+                if rng.random() < hit_ratio:
+                    cache(known[rng.randrange(len(known))])
+                else:
+                    cache("unknown place %d-%d" % (runs[0], i))
+        return run, lookups
+    return setup
+
+
+for _ratio in (1.0, 0.9, 0.5):
+    scenario("geocode_cache_hit%d" % (_ratio * 100))(_geocode_cache_scenario(_ratio))
+
+
+@scenario("store_ingest")
+def store_ingest(corpus):
+    import report_store
+
+    reports = corpus.merged_reports
+    path = os.path.join(corpus.workdir, "ingest.db")
+
+    def run():
+        for suffix in ("", "-wal", "-shm"):
+            if os.path.exists(path + suffix):
+                os.remove(path + suffix)
+        conn = report_store.connect(path)
+        report_store.ingest_reports(conn, reports, "merged")
+        conn.close()
+    return run, len(reports)
+
+
+@scenario("store_query")
+def store_query(corpus):
+    import report_store
+
+    conn = report_store.connect(corpus.store_file)
+    flowers = [name for name, _ in report_store.flower_counts(conn)[:5]]
+    first, last = report_store.date_range(conn)
+    queries = [
+        lambda: report_store.query_reports(conn),
+        lambda: report_store.query_reports(conn, date_from=last - 30, date_to=last),
+        lambda: report_store.query_sightings(conn, date_from=first, date_to=first + 365),
+        lambda: report_store.flower_counts(conn),
+        lambda: report_store.date_range(conn),
+    ] + [lambda flower=flower: report_store.query_reports(conn, flower=flower) for flower in flowers]
+
+    def run():
+        for query in queries:
+            query()
+    return run, len(queries)
+
+
+@scenario("snapshot_build")
+def snapshot_build(corpus):
+    from map_layer import build_map_layer
+    from snapshot import Snapshot, write_atomic
+
+    reports = corpus.flask_reports
+    path = os.path.join(corpus.workdir, "reports.json")
+
+    def run():
+        # what a refresh does after scraping: persist, version and build the map layer
+        write_atomic(path, reports)
+        snapshot = Snapshot(reports, time.time())
+        build_map_layer(reports, lambda location: (31.5, 35.0), snapshot.version)
+    return run, len(reports)
+
+
+# Endpoints timed through the Flask test client. The /api routes serve the scaled
+# store; /map and /reports serve the app's snapshot (static/reports.json).
+ENDPOINTS = (
+    "/api/reports?limit=50",
+    "/api/reports?from=01/01/2024&limit=50",
+    "/api/clusters?bbox=34.2,29.5,35.9,33.3&zoom=8",
+    "/api/nearby?lat=32.79&lon=35.0&km=10",
+    "/api/search?q=%D7%9B%D7%9C%D7%A0%D7%99%D7%95%D7%AA",
+    "/api/stats",
+    "/map",
+    "/reports",
+)
+
+
+def _endpoint_scenario(route, requests=50):
+    def setup(corpus):
+        os.environ.setdefault("SNAPSHOT_REFRESH", "0")
+        import api
+        import flask_app
+        import report_index
+
+        from loadtest import load_app
+
+        if getattr(api.reports_index, "store_file", None) != corpus.store_file:
+            api.reports_index = report_index.ReportIndexHolder(corpus.store_file)
+        if os.path.dirname(getattr(flask_app.map_layers.geocode, "cache_file", "")) != corpus.workdir:
+            # the map layer is built in memory, through a geocode cache in the workdir
+            load_app(stub_latency=0, workdir=corpus.workdir)
+        # the statistics are built in the background by the app; here before the first request
+        api.report_stats.update(api.reports_index.get())
+        client = flask_app.app.test_client()
+        # the first request builds the indexes; the steady state is what is measured
+        status = client.get(route).status_code
+        if status >= 400:
+            raise RuntimeError("%s returned HTTP %d" % (route, status))
+
+        def run():
+            for _ in range(requests):
+                client.get(route)
+        return run, requests
+    return setup
+
+
+for _route in ENDPOINTS:
+    scenario("flask " + _route)(_endpoint_scenario(_route))
+
+
+def measure(run, ops, repeat=3):
+    """Times `repeat` runs (the best one gives ops/sec), then one more under tracemalloc for the peak memory."""
+    times = []
+    for _ in range(repeat):
+        gc.collect()
+        started = time.perf_counter()
+        run()
+        times.append(time.perf_counter() - started)
+    gc.collect()
+    tracemalloc.start()
+    try:
+        run()
+        peak = tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+    best = min(times)
+    return {"ops": ops, "best_s": best, "mean_s": statistics.mean(times),
+            "ops_per_sec": ops / best if best else None, "peak_bytes": peak}
+
+
+def run_benchmarks(names=None, scale=1, repeat=3):
+    """Runs the selected scenarios (all by default) on a `scale`x corpus. Returns the results dict."""
+    names = names or list(SCENARIOS)
+    unknown = [name for name in names if name not in SCENARIOS]
+    if unknown:
+        raise ValueError("unknown scenarios: %s" % ", ".join(unknown))
+    corpus = Corpus(scale)
+    results = {
+        "created": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "python": platform.python_version(),
+        "machine": platform.machine(),
+        "scale": scale,
+        "repeat": repeat,
+        "scenarios": {},
+    }
+    try:
+        for name in names:
+            started = time.perf_counter()
+            try:
+                run, ops = SCENARIOS[name](corpus)
+                result = measure(run, ops, repeat)
+            except Exception as e:
+                print(f"{name}: failed: {type(e).__name__}: {e}")
+                results["scenarios"][name] = {"error": f"{type(e).__name__}: {e}"}
+                continue
+            results["scenarios"][name] = result
+            print(f"{name}: {result['ops_per_sec']:,.1f} ops/s ({result['ops']} ops in {result['best_s'] * 1000:.1f}ms), "
+                  f"peak {result['peak_bytes'] / 2 ** 20:.1f} MiB  [{time.perf_counter() - started:.1f}s]")
+    finally:
+        shutil.rmtree(corpus.workdir, ignore_errors=True)
+    return results
+
+
+def compare(baseline, current, speed_threshold=SPEED_THRESHOLD, memory_threshold=MEMORY_THRESHOLD):
+    """Compares two results dicts. Returns (report lines, names of the regressed scenarios)."""
+    lines, regressions = [], []
+    if baseline.get("scale") != current.get("scale"):
+        lines.append("warning: comparing scale %s against scale %s" % (current.get("scale"), baseline.get("scale")))
+    width = max([len(name) for name in current["scenarios"]] + [8])
+    lines.append("%-*s  %14s  %8s  %10s  %8s" % (width, "scenario", "ops/s", "change", "peak MiB", "change"))
+    for name, result in current["scenarios"].items():
+        base = baseline["scenarios"].get(name)
+        if "error" in result or base is None or "error" in base:
+            lines.append("%-*s  %s" % (width, name, result.get("error") or "no baseline"))
+            continue
+        speed = result["ops_per_sec"] / base["ops_per_sec"] - 1
+        memory = result["peak_bytes"] / base["peak_bytes"] - 1 if base["peak_bytes"] else 0.0
+        flags = []
+        if speed < -speed_threshold:
+            flags.append("SLOWER")
+        if memory > memory_threshold:
+            flags.append("MORE MEMORY")
+        if flags:
+            regressions.append(name)
+        lines.append("%-*s  %14s  %+7.1f%%  %10.1f  %+7.1f%%  %s" % (
+            width, name, f"{result['ops_per_sec']:,.1f}", 100 * speed, result["peak_bytes"] / 2 ** 20,
+            100 * memory, " ".join(flags)))
+    return lines, regressions
+
+
+def latest_result(results_dir=RESULTS_DIR):
+    paths = sorted(glob.glob(os.path.join(results_dir, "*.json")))
+    return paths[-1] if paths else None
+
+
+def load_results(path):
+    with open(path, "r", encoding="utf-8") as f:
+        return json.load(f)
+
+
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Benchmarks over the checked-in fixtures")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    run_parser = subparsers.add_parser("run", help="Run the scenarios and save the results as JSON")
+    run_parser.add_argument("scenarios", nargs="*", help="Scenarios to run (default: all)")
+    run_parser.add_argument("--scale", type=int, default=1, help="Synthesise a corpus this many times the fixtures (e.g. 10, 100)")
+    run_parser.add_argument("--repeat", type=int, default=3)
+    run_parser.add_argument("--output", help=f"Results file (default: {RESULTS_DIR}/<time>.json)")
+    subparsers.add_parser("list", help="List the scenarios")
+    compare_parser = subparsers.add_parser("compare", help="Compare results against a baseline; exits 1 on a regression")
+    compare_parser.add_argument("baseline")
+    compare_parser.add_argument("current", nargs="?", help=f"Results to check (default: the latest in {RESULTS_DIR})")
+    compare_parser.add_argument("--speed-threshold", type=float, default=SPEED_THRESHOLD)
+    compare_parser.add_argument("--memory-threshold", type=float, default=MEMORY_THRESHOLD)
+    args = parser.parse_args()
+
+    os.chdir(ROOT)
+    if args.command == "list":
+        print("\n".join(SCENARIOS))
+    elif args.command == "run":
+        try:
+            results = run_benchmarks(args.scenarios, args.scale, args.repeat)
+        except ValueError as e:
+            parser.error(str(e))
+        output = args.output or os.path.join(RESULTS_DIR, time.strftime("%Y%m%d-%H%M%S") + "-x%d.json" % args.scale)
+        os.makedirs(os.path.dirname(output) or ".", exist_ok=True)
+        with open(output, "w", encoding="utf-8") as f:
+            json.dump(results, f, indent=2, ensure_ascii=False)
+        print(f"Saved results to {output}")
+    else:
+        current = args.current or latest_result()
+        if current is None:
+            parser.error(f"no results in {RESULTS_DIR}; run the benchmarks first")
+        lines, regressions = compare(load_results(args.baseline), load_results(current),
+                                     args.speed_threshold, args.memory_threshold)
+        print("\n".join(lines))
+        if regressions:
+            print(f"{len(regressions)} regressions: {', '.join(regressions)}")
+        sys.exit(1 if regressions else 0)
@@ -0,0 +1,145 @@
+import math
+import threading
+
+from report_index import append_only_since, sighting_points
+
+MIN_ZOOM = 0
+# Above MAX_ZOOM the individual sightings are returned
+MAX_ZOOM = 16
+# Cluster cell size in screen pixels, as the map's markercluster maxClusterRadius
+CLUSTER_RADIUS = 50
+TILE_SIZE = 256
+TOP_FLOWERS = 3
+
+
+def project(latitude, longitude):
+    """Web Mercator projection to [0, 1] x [0, 1] (x east, y south), as used by map tiles."""
+    x = longitude / 360 + 0.5
+    sin = math.sin(math.radians(max(min(latitude, 85.0511), -85.0511)))
+    y = 0.5 - 0.25 * math.log((1 + sin) / (1 - sin)) / math.pi
+    return x, y
+
+
+def unproject(x, y):
+    longitude = (x - 0.5) * 360
+    latitude = math.degrees(math.atan(math.sinh(math.pi * (1 - 2 * y))))
+    return latitude, longitude
+
+
+class ClusterIndex:
+    def __init__(self, version=None, min_zoom=MIN_ZOOM, max_zoom=MAX_ZOOM, radius=CLUSTER_RADIUS):
+        """Hierarchical grid clustering of sightings, one level per zoom.
+
+        At zoom z the world is cut into square cells of `radius` screen pixels and every
+        cell holding sightings is one cluster (count, centroid, flower counts), so a point
+        belongs to exactly one cluster per zoom and new points only touch the cells they
+        fall in. Cells are immutable tuples; `with_reports` copies the per-zoom dicts and
+        replaces only the touched cells, so readers never see a half-updated index.
+        """
+        self.version = version
+        self.min_zoom = min_zoom
+        self.max_zoom = max_zoom
+        self.radius = radius
+        # zoom -> {(cx, cy): (count, sum_x, sum_y, {flower: count}, points)}
+        # points (a tuple of the sightings) is only kept at max_zoom and for single-sighting cells
+        self.levels = {zoom: {} for zoom in range(min_zoom, max_zoom + 1)}
+        self.report_ids = frozenset()
+
+    def cell_size(self, zoom):
+        return self.radius / (TILE_SIZE * 2 ** zoom)
+
+    def with_reports(self, reports, version):
+        """Returns a new index with the sightings of `reports` added."""
+        new = ClusterIndex(version, self.min_zoom, self.max_zoom, self.radius)
+        new.levels = {zoom: dict(cells) for zoom, cells in self.levels.items()}
+        new.report_ids = self.report_ids | {report["id"] for report in reports}
+        for point in sighting_points(reports):
+            x, y = project(point["latitude"], point["longitude"])
+            for zoom, cells in new.levels.items():
+                size = new.cell_size(zoom)
+                key = (int(x / size), int(y / size))
+                count, sum_x, sum_y, flowers, points = cells.get(key, (0, 0.0, 0.0, {}, ()))
+                if point["flower"]:
+                    flowers = dict(flowers)
+                    flowers[point["flower"]] = flowers.get(point["flower"], 0) + 1
+                if zoom == new.max_zoom or count == 0:
+                    points = points + (point,)
+                else:
+                    points = ()
+                cells[key] = (count + 1, sum_x + x, sum_y + y, flowers, points)
+        return new
+
+    def _cells_in_bbox(self, zoom, bbox):
+        """Yields (key, cell) of the cells of a zoom level that intersect bbox."""
+        cells = self.levels[zoom]
+        min_lon, min_lat, max_lon, max_lat = bbox
+        x0, y0 = project(max_lat, min_lon)
+        x1, y1 = project(min_lat, max_lon)
+        size = self.cell_size(zoom)
+        cx0, cy0, cx1, cy1 = int(x0 / size), int(y0 / size), int(x1 / size), int(y1 / size)
+        if (cx1 - cx0 + 1) * (cy1 - cy0 + 1) <= len(cells):
+            for cx in range(cx0, cx1 + 1):
+                for cy in range(cy0, cy1 + 1):
+                    cell = cells.get((cx, cy))
+                    if cell is not None:
+                        yield (cx, cy), cell
+        else:
+            for key, cell in cells.items():
+                if cx0 <= key[0] <= cx1 and cy0 <= key[1] <= cy1:
+                    yield key, cell
+
+    def query(self, bbox, zoom):
+        """Returns the clusters and single sightings visible in bbox at a map zoom.
+
+        Args:
+            bbox (tuple): (min_lon, min_lat, max_lon, max_lat).
+            zoom (int): The map zoom level.
+
+        Returns:
+            list: dicts with latitude, longitude and count; clusters also have an id
+            ("zoom/cx/cy") and their top flowers, single sightings have `point` instead.
+        """
+        zoom = max(int(zoom), self.min_zoom)
+        results = []
+        if zoom > self.max_zoom:
+            for _, cell in self._cells_in_bbox(self.max_zoom, bbox):
+                for point in cell[4]:
+                    results.append({"latitude": point["latitude"], "longitude": point["longitude"],
+                                    "count": 1, "point": point})
+            return results
+
+        for (cx, cy), (count, sum_x, sum_y, flowers, points) in self._cells_in_bbox(zoom, bbox):
+            latitude, longitude = unproject(sum_x / count, sum_y / count)
+            if count == 1:
+                results.append({"latitude": latitude, "longitude": longitude, "count": 1, "point": points[0]})
+                continue
+            top = sorted(flowers.items(), key=lambda item: (-item[1], item[0]))[:TOP_FLOWERS]
+            results.append({"id": "%d/%d/%d" % (zoom, cx, cy), "latitude": latitude, "longitude": longitude,
+                            "count": count, "flowers": [flower for flower, _ in top]})
+        return results
+
+
+class ClusterHolder:
+    def __init__(self):
+        """Keeps a ClusterIndex in step with a report_index.ReportIndex.
+
+        When the report index changes, only the reports not clustered yet are added;
+        the clustering is rebuilt from scratch only if reports were updated or removed.
+        """
+        self.clusters = ClusterIndex()
+        self.lock = threading.Lock()
+
+    def get(self, report_index):
+        clusters = self.clusters
+        if clusters.version == report_index.version:
+            return clusters
+        with self.lock:
+            clusters = self.clusters
+            if clusters.version != report_index.version:
+                new_reports = [r for r in report_index.reports if r["id"] not in clusters.report_ids]
+                if (not append_only_since(report_index, clusters.version)
+                        or len(clusters.report_ids) + len(new_reports) != len(report_index)):
+                    clusters, new_reports = ClusterIndex(), report_index.reports
+                self.clusters = clusters = clusters.with_reports(new_reports, report_index.version)
+                print('clustered %d new reports' % len(new_reports))
+            return clusters
@@ -1,188 +1,99 @@
-import requests
-import json
 import os
-import time
-from datetime import datetime
 
-from bs4 import BeautifulSoup
-from flask import Flask, render_template
+from flask import Flask, jsonify, render_template
 
-if os.getenv('MAPS_API_KEY') is None:
-    print('MAPS_API_KEY not found in environment variables')
-    raise Exception('MAPS_API_KEY not found in environment variables')
+from api import api
+from ingest import get_lat_lon_from_location, missing_api_keys, scrape_latest_reports
+from map_layer import GeocodeCache, MapLayerCache
+from response_cache import ResponseCache
+from snapshot import SnapshotRefresher
 
-if os.getenv('GEMINI_API_KEY') is None:
-    print('GEMINI_API_KEY not found in environment variables')
-    raise Exception('GEMINI_API_KEY not found in environment variables')
+# Serving only needs the prebuilt snapshot; without the keys the refreshes fail (and
+# the last snapshot keeps being served) until the keys are set
+for key in missing_api_keys():
+    print('%s not found in environment variables, the reports will not be refreshed' % key)
+
+# Set SNAPSHOT_REFRESH=0 to only serve the prebuilt snapshot and leave scraping to
+# a separate ingest job (generate_data.py --scrape)
+SNAPSHOT_REFRESH = os.getenv('SNAPSHOT_REFRESH', '1') != '0'
 
 app = Flask(__name__)
+app.register_blueprint(api)
 
-def extract_reports_from_html(html_content):
-    """Extracts flowering reports from HTML content using BeautifulSoup."""
-    soup = BeautifulSoup(html_content, "html.parser")
-    reports = []
-    # Adjust this selector to target the report elements accurately. Inspect the website's HTML!
-    report_elements = soup.find_all("div", class_="aboutBody")  # Example selector
+# Report locations are resolved once per data version, through a persistent geocode cache,
+# and the resolved layer is saved next to the snapshot for the next process to load
+map_layers = MapLayerCache(GeocodeCache(get_lat_lon_from_location))
 
-    if not report_elements:
-        print("No report elements found. Check your CSS selector.")
-        return None
 
-    for report_element in report_elements:
-        reports.append(report_element.text)
+@app.route('/')
+def hello_world():
+    return 'Hello from Flask!'
 
-    return reports
 
-def generate_json_with_gemini(reports):
-    """Generates JSON from flowring reports website using the Gemini API.
-    
-    Parameters:
-    -----------
-    reports: str
-        the reports to process (scraped from the website)
-        
-    Returns:
-    --------
-    json_output: str
-        the JSON output from the Gemini API
-        """
-
-    if not reports:
-        return "No reports to process."
-
-    prompt = f"""
-    Extract flower names and locations (into a structed JSON) using the the following website html code (originating from a flowering report website which is in hebrew):
-
-    {reports}
-
-    The JSON format should contain the following fields:
-    - flowers: The name of the flower.
-    - locations: The location where the flower was found.
-    - maps_query_locations: location names formatted for Google Maps queries (e.g. ignoring "near", "between" etc. so more likely to return a valid results when querying Google Maps).
-    - date: The date of the observation
-    - original_report: The original report text.
-    - observer: The name of the person who reported the observation.
-
-    the "flowers" and "locations" fields should be an array of strings (even if only one flower or location is mentioned).
-
-    If a report doesn't have flower or location information, leave the corresponding field empty.
-    """
-
-    print('generate json with gemini')
-    try:
-        import google.generativeai as genai
-
-        # get the google api key from the environment variable
-        gemini_api_key = os.environ.get("GEMINI_API_KEY")
-
-        # Set your Gemini API key
-        genai.configure(api_key=gemini_api_key)
-
-        # model = genai.GenerativeModel('gemini-pro')
-        model = genai.GenerativeModel("gemini-1.5-flash")
-        print('running model')
-        response = model.generate_content(prompt)
-        print('got response')
-        json_output = response.text
-
-        if json_output.startswith("```json"):
-            json_output = json_output[7:]
-            json_output = json_output[:-4]
-
-        try:
-            # Validate JSON output
-            parsed_json = json.loads(json_output)
-            print('parsed json. total reports: %d' % len(parsed_json))
-            return parsed_json
-        except json.JSONDecodeError as e:
-            print(f"Gemini returned invalid JSON: {e}")
-            # print(f"Raw Gemini Output:\n{json_output}") #print the raw output for debugging
-            return json_output
-
-    except Exception as e:
-        print(f"Error calling Gemini API: {e}")
-        return None
-
-def get_lat_lon_from_location(location, key=None):
-    '''Get the latitude and longitude of a location using the Google Maps API
-    
-    Parameters:
-    -----------
-    location: str
-        the location to query
-    key: str or None
-        the Google Maps API key to use. If None, the key is read from the GOOGLE_MAPS_API_KEY environment variable.
-    
+# the reports are served from an in-memory snapshot (also saved to static/reports.json),
+# rebuilt every hour in a background thread while requests keep using the last good one.
+# The map layer of a new snapshot is built in that thread too, before requests need it.
+refresher = SnapshotRefresher(scrape_latest_reports,
+                              on_swap=lambda snapshot: map_layers.build(snapshot.reports, snapshot.version))
+if refresher.snapshot is not None:
+    # load (or, if it was not built at deploy time, build) the layer of the saved snapshot in the background
+    map_layers.get(refresher.snapshot.reports, refresher.snapshot.version)
+
+
+# rendered pages are cached (with their compressed variants) until the snapshot changes
+response_cache = ResponseCache()
+
+
+def layer_version():
+    # pages are rendered from the map layer, which may lag behind a new snapshot while it is built;
+    # an incomplete layer rebuilt with fewer geocoding errors renders differently
+    layer = map_layers.layer
+    return '%s-%d' % (layer['version'], layer.get('errors', 0)) if layer is not None else None
+
+
+def get_layer():
+    '''Get the map layer of the snapshot currently served, or the last good one while it is built
+
     Returns:
     --------
-    lat: float
-        the latitude of the location
-    lon: float
-        the longitude of the location
+    err: str
+        error message, if no layer is available yet
+    layer: dict
+        the map layer (see map_layer.build_map_layer)
     '''
-    from geopy.geocoders import GoogleV3
+    err, snapshot = get_snapshot()
+    if err:
+        return err, None
+    layer = map_layers.get(snapshot.reports, snapshot.version)
+    if layer is None:
+        return "The map is being prepared, please try again in a few minutes", None
+    return None, layer
 
-    if key is None:
-        key = os.getenv('MAPS_API_KEY')
 
-    # Initialize the GoogleV3 geocoder with your API key
-    geolocator = GoogleV3(api_key=key)
-    
-    # Geocode the location
-    location = geolocator.geocode(location,components={"country": "IL"})
-    
-    if location:
-        return location.latitude, location.longitude
-    else:
-        return None, None
+@app.before_request
+def start_refresher():
+    if SNAPSHOT_REFRESH:
+        refresher.start()
 
 
-def process_website(url):
-    print('process website')
-    """Processes a website to extract flowering reports and generate JSON.
-    
-    Parameters:
-    -----------
-    url: str
-        the URL of the website to process
-        
+def get_snapshot():
+    '''Get the snapshot currently served
+
     Returns:
     --------
-    json_output: json
-        the JSON containing the extracted flowering reports
-        list of dictionaries, each containing the following fields:
-        - flowers: (list of str) The names of the flowers at the location.
-        - locations (list of str): The locations where the flowers were found.
-        - maps_query_locations (list of str): location names formatted for Google Maps queries (e.g. ignoring "near", "between" etc. so more likely to return a valid results when querying Google Maps).
-        - date (str): The date of the observation
-        - original_report (str): The original report text.
-        - observer (str): The name of the person who reported the observation.
-    """
-    try:
-        response = requests.get(url)
-        response.raise_for_status()  # Raise HTTPError for bad responses (4xx or 5xx)
-        html_content = response.content.decode('utf-8')
-    except requests.exceptions.RequestException as e:
-        print(f"Error fetching URL: {e}")
-        return None
-
-    print('got html content. length: %d' % len(html_content))
-    # print(html_content)
-
-    # reports = extract_reports_from_html(html_content)
-
-    # if reports is None:
-    #     return None
-
-    # json_output = generate_json_with_gemini(reports)
-
-    json_output = generate_json_with_gemini(html_content)
-    return json_output
-
-
-@app.route('/')
-def hello_world():
-    return 'Hello from Flask!'
+    err: str
+        error message, if no snapshot is available yet
+    snapshot: Snapshot
+        the reports and their data version
+    '''
+    snapshot = refresher.snapshot
+    if snapshot is None:
+        if not SNAPSHOT_REFRESH:
+            return "No report snapshot available", None
+        # nothing to serve yet: the first snapshot is being built in the background
+        refresher.refresh_in_background()
+        return "Reports are being prepared, please try again in a few minutes", None
+    return None, snapshot
 
 
 def get_latest_reports(num_reports,force=False):
@@ -192,98 +103,56 @@ def get_latest_reports(num_reports,force=False):
     -----------
     num_reports: int
         the number of reports to retrieve or 0 for all reports
+    force: bool
+        if True, rebuild the snapshot now (blocking) instead of returning the current one
     
     Returns:
     --------
     err: str
         error message, if any
     reports: json
-        the JSON containing the extracted flowering reports
-        list of dictionaries, each containing the following fields:
-        - flowers: (list of str) The names of the flowers at the location.
-        - locations (list of str): The locations where the flowers were found.
-        - maps_query_locations (list of str): location names formatted for Google Maps queries (e.g. ignoring "near", "between" etc. so more likely to return a valid results when querying Google Maps).
-        - date (str): The date of the observation
-        - original_report (str): The original report text.
-        - observer (str): The name of the person who reported the observation.
+        the JSON containing the extracted flowering reports (see scrape_latest_reports)
     '''
-    # scrape the website https://www.wildflowers.co.il/hebrew/flash.asp
-    # get the website content
     print('get latest reports')
+    if force:
+        refresher.refresh()
+        if refresher.last_refresh_error:
+            return refresher.last_refresh_error, {}
 
-    # check the creation time of the reports file, and if it is older than 1 hour, reprocess the website
-    if not force:
-        try:
-            file_time = os.path.getmtime('static/reports.json')
-            if time.time() - file_time < 3600:
-                print('file is recent. loading from file')
-                with open('reports.json', 'r') as f:
-                    json_result = json.load(f)
-                return None, json_result
-        except FileNotFoundError:
-            print('file not found. processing website')
-            pass
-
-    print('processing website')
-    json_result = []
-    website_url = "https://www.wildflowers.co.il/hebrew/flash.asp/"
-    for cpage in range(1,10):
-        print('page %d' % cpage)
-        website_url = 'https://www.wildflowers.co.il/hebrew/flash.asp?page=%d' % cpage
-        cjson_result = process_website(website_url)
-        if cjson_result is None:
-            break
-        # get the 3 latest dates from the reports
-        dates = [x['date'] for x in cjson_result]
-        # convert the dates to datetime objects
-        dates = [datetime.strptime(x,'%d/%m/%Y') for x in dates]
-        dates.sort(reverse=True)
-
-        json_result.extend(cjson_result)
-
-    if len(json_result)==0:
-        return "Error processing website", {}
-
-    print('got %d reports' % len(json_result))
-
-    # save the reports to a file
-    with open('static/reports.json', 'w') as f:
-        json.dump(json_result, f)
+    err, snapshot = get_snapshot()
+    if err:
+        return err, {}
 
+    json_result = snapshot.reports
     if num_reports > 0:
         json_result = json_result[:num_reports]
     return None, json_result
 
 
+@app.route('/healthz')
+def healthz():
+    '''Report the age of the served snapshot and the outcome of the last refresh'''
+    health = refresher.health()
+    health['response_cache'] = response_cache.stats()
+    return jsonify(health), 200 if refresher.snapshot is not None else 503
+
+
 @app.route('/reports')
+@response_cache.cached(layer_version)
 def reports():
     '''Render the flowering reports
 
     uses the reports.html template
     '''
-    err, reports = get_latest_reports(0)
+    err, layer = get_layer()
     if err:
         return "error encountered: %s" % err
-    
-    new_reports = []
-    # get the lat and lon for each location
-    for creport in reports:
-        maps_query_locations = creport['maps_query_locations']
-        if len(maps_query_locations) > 0:
-            for cloc in maps_query_locations:
-                lat, lon = get_lat_lon_from_location(cloc)
-                if lat is not None and lon is not None:
-                    creport['lat'] = lat
-                    creport['lon'] = lon
-                    creport['locations'] = cloc
-                    new_reports.append(creport)
-                else:
-                    print('location not found: %s' % cloc)
-    
-    return render_template('report.html', reports=new_reports)
+
+    return render_template('report.html', reports=layer['reports'])
 
 
 @app.route('/map')
+@response_cache.cached(layer_version)
 def map():
     '''Render the flowering report map
     shows markers for each flowering report
@@ -291,30 +160,11 @@ def map():
     uses the map.html template
     '''
     print('get map')
-    coords = []
-    report_ids = []
-    descriptions = []
 
-    # get the latest flowering reports
-    err, reports = get_latest_reports(0)
+    # the geocoded points of the latest flowering reports, precomputed once per data version
+    err, layer = get_layer()
     if err:
         return "error encountered: %s" % err
-    
-    print('got %d reports' % len(reports))
-    # get the lat and lon for each location
-    for creport in reports:
-        maps_query_locations = creport['maps_query_locations']
-        if len(maps_query_locations) > 0:
-            for cloc in maps_query_locations:
-                lat, lon = get_lat_lon_from_location(cloc)
-                if lat is not None and lon is not None:
-                    coords.append([lat, lon])
-                    # convert the flowers to a string for the marker
-                    cid = ', '.join(creport['flowers'])
-                    cid += '\n'+str(creport['date'])
-                    report_ids.append(cid)
-                    descriptions.append(creport['original_report'])
-                else:
-                    print('location not found: %s' % cloc)
-    print('got %d coords' % len(coords))
-    return render_template('map.html', coords_list=coords, flower_ids=json.dumps(report_ids), descriptions=json.dumps(descriptions))
+
+    print('got %d coords' % len(layer['coords']))
+    return render_template('map.html', coords_list=layer['coords'], flower_ids=layer['flower_ids'], descriptions=layer['descriptions'])
@@ -0,0 +1,294 @@
+import csv
+import json
+import os
+import re
+import threading
+
+# Sources the gazetteer is built from. The dump file is optional and may be either
+# a GeoNames country extract (tab separated, e.g. IL.txt) or a CSV with the same
+# location,latitude,longitude columns as location_cache.csv.
+LOCATION_CACHE_FILE = "location_cache.csv"
+TIULI_REPORTS_FILE = "tiuli_reports.json"
+TIULI_HTML_DIR = "tiuli_scraped_reports"
+GAZETTEER_FILE = "gazetteer.csv"
+DUMP_FILE = os.getenv("GAZETTEER_DUMP_FILE")
+
+# Minimal trigram (Dice) similarity for a fuzzy match to be accepted
+DEFAULT_THRESHOLD = float(os.getenv("GAZETTEER_THRESHOLD", "0.8"))
+# Shorter normalized names only match exactly: a few shared trigrams (or a stripped
+# one-letter prefix) are too weak evidence that two short names are the same place
+MIN_FUZZY_LENGTH = 4
+
+NIQQUD_RE = re.compile(r"[֑-ׇ]")
+PUNCTUATION_RE = re.compile(r"[\"'`׳״()\[\],.;:!?\-–_/\\]+")
+FINAL_LETTERS = str.maketrans("ךםןףץ", "כמנפצ")
+# Single-letter Hebrew prefixes ("in", "to", "from", "and", "the") tried when a name has no exact match
+HEBREW_PREFIXES = "בלמוה"
+
+
+def normalize_name(name):
+    """Normalizes a place name for indexing.
+
+    Lower-cases, removes niqqud and punctuation, folds Hebrew final letters and
+    collapses whitespace, so that "נחל עמוד" and "נַחַל עמוד," map to the same key.
+    """
+    if not name:
+        return ""
+    name = NIQQUD_RE.sub("", str(name)).lower()
+    name = PUNCTUATION_RE.sub(" ", name).translate(FINAL_LETTERS)
+    return " ".join(name.split())
+
+
+def trigrams(text):
+    """Returns the set of character trigrams of an already normalized string."""
+    padded = f"  {text} "
+    return {padded[i:i + 3] for i in range(len(padded) - 2)}
+
+
+class Gazetteer:
+    def __init__(self, threshold=DEFAULT_THRESHOLD):
+        """In-memory place-name index with exact and fuzzy (trigram) lookup.
+
+        Args:
+            threshold (float): Minimal Dice similarity (0-1) for a fuzzy match.
+        """
+        self.threshold = threshold
+        self.names = []
+        self.coords = []
+        self.sources = []
+        self.exact = {}
+        self.postings = {}
+        self.gram_counts = []
+
+    def __len__(self):
+        return len(self.names)
+
+    def add(self, name, latitude, longitude, source=""):
+        """Adds a place to the index. The first coordinates seen for a name win."""
+        key = normalize_name(name)
+        if not key or key in self.exact:
+            return False
+        try:
+            latitude, longitude = float(latitude), float(longitude)
+        except (TypeError, ValueError):
+            return False
+
+        idx = len(self.names)
+        grams = trigrams(key)
+        self.names.append(name)
+        self.coords.append((latitude, longitude))
+        self.sources.append(source)
+        self.exact[key] = idx
+        self.gram_counts.append(len(grams))
+        for gram in grams:
+            self.postings.setdefault(gram, []).append(idx)
+        return True
+
+    def search(self, name, limit=5, threshold=None):
+        """Returns up to `limit` (name, score, coordinates) tuples, best match first."""
+        if threshold is None:
+            threshold = self.threshold
+        key = normalize_name(name)
+        if not key:
+            return []
+
+        idx = self.exact.get(key)
+        if idx is None and len(key) > MIN_FUZZY_LENGTH and key[0] in HEBREW_PREFIXES:
+            idx = self.exact.get(key[1:])
+        if idx is not None:
+            return [(self.names[idx], 1.0, self._coords(idx))]
+        if len(key) < MIN_FUZZY_LENGTH:
+            return []
+
+        grams = trigrams(key)
+        shared = {}
+        for gram in grams:
+            for idx in self.postings.get(gram, ()):
+                shared[idx] = shared.get(idx, 0) + 1
+
+        matches = []
+        for idx, count in shared.items():
+            score = 2.0 * count / (len(grams) + self.gram_counts[idx])
+            if score >= threshold:
+                matches.append((score, idx))
+        matches.sort(key=lambda m: (-m[0], m[1]))
+        return [(self.names[idx], score, self._coords(idx)) for score, idx in matches[:limit]]
+
+    def lookup(self, name, threshold=None):
+        """Returns {"latitude", "longitude"} of the best match, or None."""
+        matches = self.search(name, limit=1, threshold=threshold)
+        if not matches:
+            return None
+        return matches[0][2]
+
+    def _coords(self, idx):
+        latitude, longitude = self.coords[idx]
+        return {"latitude": latitude, "longitude": longitude}
+
+    def load_location_cache(self, cache_file=LOCATION_CACHE_FILE):
+        """Loads the successful entries of a location_cache.csv style file."""
+        added = 0
+        with open(cache_file, "r", encoding="utf-8", newline="") as f:
+            for row in csv.DictReader(f):
+                if row.get("status", "success") != "success":
+                    continue
+                if self.add(row["location"], row.get("latitude"), row.get("longitude"), source=cache_file):
+                    added += 1
+        return added
+
+    def load_tiuli_reports(self, reports_file=TIULI_REPORTS_FILE):
+        """Loads the exact marker coordinates of a tiuli_parse.py output file."""
+        with open(reports_file, "r", encoding="utf-8") as f:
+            data = json.load(f)
+        return self._add_geocoded_reports(data.get("reports", []), reports_file)
+
+    def load_tiuli_html(self, html_dir=TIULI_HTML_DIR):
+        """Loads marker coordinates directly from the scraped tiuli HTML pages."""
+        from tiuli_parse import extract_data_from_html
+
+        added = 0
+        for filename in sorted(os.listdir(html_dir)):
+            if filename.endswith(".html"):
+                filepath = os.path.join(html_dir, filename)
+                try:
+                    with open(filepath, "r", encoding="utf-8") as f:
+                        reports = extract_data_from_html(f.read(), filepath)
+                except Exception as e:
+                    print(f"Error processing {filename}: {e}")
+                    continue
+                added += self._add_geocoded_reports(reports, html_dir)
+        return added
+
+    def load_dump(self, dump_file):
+        """Loads a place-name dump: a GeoNames extract (.txt/.tsv) or a CSV file.
+
+        For GeoNames, both the main name and every alternate name (which include the
+        Hebrew ones) are indexed with the same coordinates.
+        """
+        added = 0
+        if dump_file.endswith((".txt", ".tsv")):
+            with open(dump_file, "r", encoding="utf-8") as f:
+                for line in f:
+                    fields = line.rstrip("\n").split("\t")
+                    if len(fields) < 6:
+                        continue
+                    names = [fields[1], fields[2]] + fields[3].split(",")
+                    for name in names:
+                        if self.add(name, fields[4], fields[5], source=dump_file):
+                            added += 1
+            return added
+
+        with open(dump_file, "r", encoding="utf-8", newline="") as f:
+            for row in csv.DictReader(f):
+                name = row.get("location") or row.get("name")
+                if self.add(name, row.get("latitude") or row.get("lat"),
+                            row.get("longitude") or row.get("lon"), source=dump_file):
+                    added += 1
+        return added
+
+    def load(self, gazetteer_file=GAZETTEER_FILE):
+        """Loads a gazetteer previously written by `save`."""
+        with open(gazetteer_file, "r", encoding="utf-8", newline="") as f:
+            for row in csv.DictReader(f):
+                self.add(row["location"], row["latitude"], row["longitude"], source=row.get("source", ""))
+        return len(self)
+
+    def save(self, gazetteer_file=GAZETTEER_FILE):
+        """Writes the gazetteer to a CSV file so it can be loaded without re-parsing sources."""
+        with open(gazetteer_file, "w", encoding="utf-8", newline="") as f:
+            writer = csv.DictWriter(f, fieldnames=["location", "latitude", "longitude", "source"])
+            writer.writeheader()
+            for name, (latitude, longitude), source in zip(self.names, self.coords, self.sources):
+                writer.writerow({"location": name, "latitude": latitude, "longitude": longitude, "source": source})
+
+    def _add_geocoded_reports(self, reports, source):
+        added = 0
+        for report in reports:
+            for name, coords in (report.get("geocoded_locations") or {}).items():
+                if coords and self.add(name, coords.get("latitude"), coords.get("longitude"), source=source):
+                    added += 1
+        return added
+
+
+def build_gazetteer(cache_file=LOCATION_CACHE_FILE, tiuli_file=TIULI_REPORTS_FILE,
+                    tiuli_dir=TIULI_HTML_DIR, dump_file=DUMP_FILE, threshold=DEFAULT_THRESHOLD):
+    """Builds a gazetteer from every available local source.
+
+    Exact tiuli marker coordinates are loaded first so they take precedence over
+    geocoder results; the tiuli HTML pages are only parsed when tiuli_reports.json
+    does not exist. Missing sources are skipped.
+    """
+    gazetteer = Gazetteer(threshold=threshold)
+    if tiuli_file and os.path.exists(tiuli_file):
+        gazetteer.load_tiuli_reports(tiuli_file)
+    elif tiuli_dir and os.path.isdir(tiuli_dir):
+        gazetteer.load_tiuli_html(tiuli_dir)
+    if cache_file and os.path.exists(cache_file):
+        gazetteer.load_location_cache(cache_file)
+    if dump_file and os.path.exists(dump_file):
+        gazetteer.load_dump(dump_file)
+    return gazetteer
+
+
+_gazetteer = None
+_gazetteer_lock = threading.Lock()
+
+
+def get_gazetteer():
+    """Returns the process-wide gazetteer, loading gazetteer.csv or building (and saving) it on first use.
+
+    If that fails, the error is printed once and an empty gazetteer is kept, so later
+    lookups miss instead of rebuilding it every time.
+    """
+    global _gazetteer
+    if _gazetteer is None:
+        with _gazetteer_lock:
+            if _gazetteer is None:
+                try:
+                    if os.path.exists(GAZETTEER_FILE):
+                        gazetteer = Gazetteer()
+                        gazetteer.load(GAZETTEER_FILE)
+                    else:
+                        gazetteer = build_gazetteer()
+                        gazetteer.save(GAZETTEER_FILE)
+                except Exception as e:
+                    print(f"Could not load the gazetteer, place names will not be resolved offline: {e}")
+                    gazetteer = Gazetteer()
+                _gazetteer = gazetteer
+    return _gazetteer
+
+
+def lookup_place(location_name):
+    """Resolves a place name offline. Returns {"latitude", "longitude"} or None.
+
+    Meant to sit in front of the network geocoders; a gazetteer that failed to load
+    simply results in misses.
+    """
+    return get_gazetteer().lookup(location_name)
+
+
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Build or query the offline gazetteer")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    build_parser = subparsers.add_parser("build", help=f"Build {GAZETTEER_FILE} from the local sources")
+    build_parser.add_argument("--dump-file", default=DUMP_FILE, help="Optional place-name dump (GeoNames .txt or CSV)")
+    build_parser.add_argument("--output-file", default=GAZETTEER_FILE)
+    lookup_parser = subparsers.add_parser("lookup", help="Look up place names")
+    lookup_parser.add_argument("names", nargs="+")
+    lookup_parser.add_argument("--threshold", type=float, default=DEFAULT_THRESHOLD)
+    args = parser.parse_args()
+
+    if args.command == "build":
+        gazetteer = build_gazetteer(dump_file=args.dump_file)
+        gazetteer.save(args.output_file)
+        print(f"Saved {len(gazetteer)} places to {args.output_file}")
+    else:
+        gazetteer = get_gazetteer()
+        for name in args.names:
+            matches = gazetteer.search(name, threshold=args.threshold)
+            if not matches:
+                print(f"{name}: no match")
+            for match_name, score, coords in matches:
+                print(f"{name}: {match_name} ({score:.2f}) {coords['latitude']}, {coords['longitude']}")
@@ -1,12 +1,217 @@
 # generate_data.py
-import os
+import hashlib
 import json
-from flask_app import get_latest_reports
+import os
 
-if __name__ == "__main__":
-    err, reports = get_latest_reports(0, force=True)
+from json_stream import iter_reports
+from map_layer import GeocodeCache, MapLayerCache
+from report_store import format_day, parse_day
+from snapshot import REPORTS_FILE, write_atomic
+from static_files import remove_with_variants, write_with_variants
+from stats_cube import month_of
+
+# The sources the static site (index.html / FlowerMap.js) shows, with their `source` tag;
+# of several files, the first existing one is used (the LocationIQ-geocoded tiuli reports if available)
+SITE_SOURCES = (("tiuli", ("tiuli_reports_with_coords.json", "tiuli_reports.json")), ("merged", "merged_reports.json"))
+SITE_DATA_DIR = "site_data"
+MANIFEST_FILE = "manifest.json"
+UNDATED_SHARD = "undated"
+# Number of past releases a client can catch up from with delta files
+MAX_DELTAS = 20
+
+
+def scrape_flask_reports(reports_file=REPORTS_FILE):
+    '''Scrape the latest reports (see ingest.scrape_latest_reports) into the Flask snapshot
+
+    The map layer of the new snapshot is built and saved too, so the app starts
+    serving it without geocoding anything.
+    '''
+    from ingest import get_lat_lon_from_location, scrape_latest_reports
+
+    err, reports = scrape_latest_reports()
     if err:
         print(err)
-    else:
-        with open('static/reports.json', 'w') as f:
-            json.dump(reports, f)
+        return False
+    write_atomic(reports_file, reports)
+    MapLayerCache(GeocodeCache(get_lat_lon_from_location)).build(reports)
+    return True
+
+
+def report_id(report):
+    '''Content hash identifying a site report (and its source) across releases'''
+    content = {key: value for key, value in report.items() if key != 'id'}
+    return hashlib.sha1(json.dumps(content, ensure_ascii=False, sort_keys=True).encode('utf-8')).hexdigest()[:16]
+
+
+def shard_reports(sources=SITE_SOURCES):
+    '''Group the site reports by month
+
+    Returns:
+    --------
+    shards: dict
+        {"YYYY-MM" (or "undated"): [(day, report)]}, each report tagged with its source and id
+    '''
+    shards = {}
+    for source, paths in sources:
+        paths = (paths,) if isinstance(paths, str) else paths
+        path = next((path for path in paths if os.path.exists(path)), None)
+        if path is None:
+            print('skipping missing source file %s' % ' / '.join(paths))
+            continue
+        for report in iter_reports(path):
+            report['source'] = source
+            report['id'] = report_id(report)
+            day = parse_day(report.get('date'))
+            shards.setdefault(month_of(day) or UNDATED_SHARD, []).append((day, report))
+    return shards
+
+
+def encode_shard(entries):
+    '''Serialise a shard deterministically (reports ordered by day, then source, then input order)'''
+    entries = sorted(entries, key=lambda entry: (entry[0] if entry[0] is not None else -1, entry[1]['source']))
+    reports = [report for _, report in entries]
+    return json.dumps({'reports': reports}, ensure_ascii=False, separators=(',', ':')).encode('utf-8')
+
+
+def load_manifest(manifest_path):
+    if not os.path.exists(manifest_path):
+        return None
+    try:
+        with open(manifest_path, 'r', encoding='utf-8') as f:
+            return json.load(f)
+    except (OSError, json.JSONDecodeError) as e:
+        print('ignoring unreadable manifest %s: %s' % (manifest_path, e))
+        return None
+
+
+def load_release_ids(out_dir, manifest):
+    '''The report ids of a release, read from its shards. None if a shard is missing.'''
+    ids = set()
+    for shard in manifest.get('shards', []):
+        path = os.path.join(out_dir, shard['file'])
+        if not os.path.exists(path):
+            return None
+        ids.update(report.get('id') or report_id(report) for report in iter_reports(path))
+    return ids
+
+
+def write_delta(out_dir, previous, manifest, shards):
+    '''Write the changes from the previous release to this one as a delta file
+
+    Returns:
+    --------
+    delta: dict or None
+        the manifest entry (from, to, file, added, removed counts), None if the
+        previous release's shards are no longer available
+    '''
+    previous_ids = load_release_ids(out_dir, previous)
+    if previous_ids is None:
+        print('previous release %s is incomplete, no delta written' % previous.get('version'))
+        return None
+    reports = [report for entries in shards.values() for _, report in entries]
+    current_ids = {report['id'] for report in reports}
+    delta = {
+        'from': previous['version'],
+        'to': manifest['version'],
+        'added': [report for report in reports if report['id'] not in previous_ids],
+        'removed': sorted(previous_ids - current_ids),
+    }
+    filename = 'deltas/%s-%s.json' % (delta['from'], delta['to'])
+    os.makedirs(os.path.join(out_dir, 'deltas'), exist_ok=True)
+    write_with_variants(os.path.join(out_dir, filename),
+                        json.dumps(delta, ensure_ascii=False, separators=(',', ':')).encode('utf-8'))
+    return {'from': delta['from'], 'to': delta['to'], 'file': filename,
+            'added': len(delta['added']), 'removed': len(delta['removed'])}
+
+
+def build_site_data(out_dir=SITE_DATA_DIR, sources=SITE_SOURCES):
+    '''Write the site reports as monthly shards with content-hashed names, and their manifest
+
+    Each shard is written (with .gz/.br variants) only if no shard with the same
+    content exists, so unchanged months keep their file names (and CDN caches) across
+    builds. Shards of the previous manifest stay on disk for one more build, so clients
+    holding the old manifest can still fetch them; older ones are deleted.
+
+    A delta file with the reports added and the ids removed since the previous release
+    is written as well. A returning client at release `v` applies the listed deltas
+    from `v` onwards (each report has a content-hash `id`) instead of refetching shards.
+
+    Returns:
+    --------
+    manifest: dict
+        version, total count, a list of shards (key, from, to, count, per-source
+        counts, file, bytes), oldest month first and "undated" last, and the deltas
+        (from, to, file, added, removed) of the last MAX_DELTAS releases, newest first
+    stats: dict
+        counts of written, unchanged and removed shards
+    '''
+    shard_dir = os.path.join(out_dir, 'shards')
+    os.makedirs(shard_dir, exist_ok=True)
+    manifest_path = os.path.join(out_dir, MANIFEST_FILE)
+    previous = load_manifest(manifest_path)
+
+    stats = {'written': 0, 'unchanged': 0, 'removed': 0}
+    shards = []
+    grouped = shard_reports(sources)
+    for key, entries in sorted(grouped.items(), key=lambda item: (item[0] == UNDATED_SHARD, item[0])):
+        data = encode_shard(entries)
+        digest = hashlib.sha256(data).hexdigest()
+        filename = 'shards/%s.%s.json' % (key, digest[:10])
+        if write_with_variants(os.path.join(out_dir, filename), data):
+            stats['written'] += 1
+        else:
+            stats['unchanged'] += 1
+        days = [day for day, _ in entries if day is not None]
+        counts = {}
+        for _, report in entries:
+            counts[report['source']] = counts.get(report['source'], 0) + 1
+        shards.append({
+            'key': key,
+            'from': format_day(min(days)) if days else None,
+            'to': format_day(max(days)) if days else None,
+            'count': len(entries),
+            'sources': counts,
+            'file': filename,
+            'bytes': len(data),
+        })
+
+    manifest = {
+        'version': hashlib.sha256(''.join(shard['file'] for shard in shards).encode('utf-8')).hexdigest()[:12],
+        'count': sum(shard['count'] for shard in shards),
+        'shards': shards,
+        'deltas': previous.get('deltas', []) if previous else [],
+    }
+    if previous and previous.get('version') != manifest['version']:
+        delta = write_delta(out_dir, previous, manifest, grouped)
+        manifest['deltas'] = ([delta] if delta else []) + manifest['deltas'][:MAX_DELTAS - 1]
+    write_with_variants(manifest_path, json.dumps(manifest, ensure_ascii=False, separators=(',', ':')).encode('utf-8'))
+
+    keep = {shard['file'] for shard in shards}
+    if previous:
+        keep.update(shard['file'] for shard in previous.get('shards', []))
+    for filename in os.listdir(shard_dir):
+        if filename.endswith('.json') and 'shards/' + filename not in keep:
+            remove_with_variants(os.path.join(shard_dir, filename))
+            stats['removed'] += 1
+    delta_dir = os.path.join(out_dir, 'deltas')
+    deltas = {delta['file'] for delta in manifest['deltas']}
+    for filename in os.listdir(delta_dir) if os.path.isdir(delta_dir) else []:
+        if filename.endswith('.json') and 'deltas/' + filename not in deltas:
+            remove_with_variants(os.path.join(delta_dir, filename))
+    return manifest, stats
+
+
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser(description='Build the static site data (monthly report shards and their manifest)')
+    parser.add_argument('--out-dir', default=SITE_DATA_DIR)
+    parser.add_argument('--scrape', action='store_true',
+                        help='First scrape the latest reports into static/reports.json (needs the API keys)')
+    args = parser.parse_args()
+
+    if args.scrape:
+        scrape_flask_reports()
+    manifest, stats = build_site_data(args.out_dir)
+    print('Built %d shards (%d reports) in %s: %d written, %d unchanged, %d removed' % (
+        len(manifest['shards']), manifest['count'], args.out_dir, stats['written'], stats['unchanged'], stats['removed']))
@@ -10,8 +10,15 @@ from requests.exceptions import ReadTimeout
 from tqdm import tqdm
 import traceback
 
+from gazetteer import lookup_place
+from instrument import add_profile_argument, count, profiling, span
+from json_stream import iter_reports, write_reports
+from replay import wrap_geocode, wrap_session
+
 # Initialize Nominatim geocoder (OSM)
 geolocator = Nominatim(user_agent="my_geocoder")
+geocode_osm = wrap_geocode(geolocator.geocode, 'nominatim')
+http = wrap_session(requests.Session())
 
 GOOGLE_MAPS_API_KEY = os.getenv("GOOGLE_MAPS_API_KEY")
 
@@ -24,7 +31,7 @@ use_google_maps = bool(GOOGLE_MAPS_API_KEY)  # check if the google maps api key
 def get_coordinates_osm(location_name, max_retries=3, base_delay=1):
     for attempt in range(max_retries):
         try:
-            location = geolocator.geocode(location_name, timeout=10)
+            location = geocode_osm(location_name, timeout=10)
             if location:
                 return {"latitude": location.latitude, "longitude": location.longitude}
         except ReadTimeout:
@@ -40,7 +47,7 @@ def get_coordinates_google(location_name, api_key):
         "key": api_key
     }
     try:
-      response = requests.get(base_url, params=params, timeout=10)
+      response = http.get(base_url, params=params, timeout=10)
       response.raise_for_status()
       data = response.json()
       if data["status"] == "OK" and data["results"]:
@@ -51,12 +58,21 @@ def get_coordinates_google(location_name, api_key):
     return None
 
 def get_coordinates(location_name):
-    """Get coordinates, using cache first, then OSM, then Google Maps (if key available)."""
+    """Get coordinates, using cache first, then the offline gazetteer, then OSM, then Google Maps (if key available)."""
     if location_name in cache:
+        count("cache_hits")
         return cache[location_name]
 
+    coordinates = lookup_place(location_name)
+    if coordinates:
+        count("gazetteer_hits")
+        cache[location_name] = coordinates
+        return coordinates
+
     # Try OSM
-    coordinates = get_coordinates_osm(location_name)
+    count("osm_calls")
+    with span("osm"):
+        coordinates = get_coordinates_osm(location_name)
     if coordinates:
         cache[location_name] = coordinates
         return coordinates
@@ -64,26 +80,17 @@ def get_coordinates(location_name):
     # If OSM fails and Google Maps API Key is available, try Google Maps
     global use_google_maps
     if use_google_maps:
-      coordinates = get_coordinates_google(location_name, GOOGLE_MAPS_API_KEY)
+      count("google_calls")
+      with span("google"):
+          coordinates = get_coordinates_google(location_name, GOOGLE_MAPS_API_KEY)
       if coordinates:
         cache[location_name] = coordinates
         return coordinates
     return None
 
-def add_coordinates(reports_file):
-    """Adds coordinates to each location in the reports data."""
-    try:
-        with open(reports_file, 'r', encoding='utf-8') as f:
-            reports = json.load(f)
-    except FileNotFoundError:
-        print(f"Error: File not found: {reports_file}")
-        return
-    except json.JSONDecodeError as e:
-        print(f"Error decoding JSON: {e}")
-        return
-    
-    reports_list = reports.get("reports", [])
-    for i, report in enumerate(tqdm(reports_list, desc="Processing reports")):
+def geocode_reports(reports):
+    """Generator stage: yields each report with its `geocoded_locations` filled in."""
+    for i, report in enumerate(reports):
         report["geocoded_locations"] = {}  # Initialize a dict for coordinates
         try:
             if "locations" in report:
@@ -104,17 +111,39 @@ def add_coordinates(reports_file):
         except Exception as e:
                 print(f"Error processing report at line {i + 1} : {e}")
                 traceback.print_exc()
+        yield report
+
+@span("add_coordinates")
+def add_coordinates(reports_file, output_file=None):
+    """Adds coordinates to each location in the reports data.
+
+    Reports are streamed through the geocoding stage one at a time and written to a
+    temporary file that replaces output_file (reports_file by default), so memory use
+    does not grow with the corpus.
+    """
+    if not os.path.exists(reports_file):
+        print(f"Error: File not found: {reports_file}")
+        return
 
     try:
-        with open(reports_file, 'w', encoding='utf-8') as f:
-            json.dump(reports, f, indent=2, ensure_ascii=False)
+        reports = tqdm(iter_reports(reports_file), desc="Processing reports")
+        write_reports(output_file or reports_file, geocode_reports(reports))
+    except json.JSONDecodeError as e:
+        print(f"Error decoding JSON: {e}")
     except Exception as e:
           print(f"Error when writing to json file: {e}")
-          return
 
 # Main execution
 if __name__ == "__main__":
-    reports_file = "merged_reports.json"
-    add_coordinates(reports_file)
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Add coordinates to the locations of merged_reports.json")
+    parser.add_argument("--input-file", default="merged_reports.json")
+    parser.add_argument("--output-file", help="Default: update the input file in place")
+    add_profile_argument(parser)
+    args = parser.parse_args()
+
+    with profiling("geocoder", args.profile):
+        add_coordinates(args.input_file, args.output_file)
     cache.close()  # Close the cache when done
-    print("merged_reports.json updated")
\ No newline at end of file
+    print(f"{args.output_file or args.input_file} updated")
\ No newline at end of file
@@ -1,15 +1,23 @@
 import requests
-from bs4 import BeautifulSoup, NavigableString
 import json
 import os
 import time
 import logging
 import csv
+import itertools
+import threading
 from requests.adapters import HTTPAdapter
 from requests.packages.urllib3.util.retry import Retry
 import google.generativeai as genai
 from google.api_core import exceptions
 
+from gazetteer import lookup_place
+from instrument import add_profile_argument, count, profiling, span
+from jsonl_store import open_report_log, report_fingerprint
+from replay import transport, wrap_model, wrap_session
+from streaming import RateLimiter, Stage, StreamPipeline
+from wildflowers_parse import parse_page
+
 # Set up logging
 logging.basicConfig(
     level=logging.INFO,
@@ -22,7 +30,7 @@ GEMINI_API_KEY = os.getenv('GEMINI_API_KEY')
 LOCATIONIQ_API_KEY = os.getenv('LOCATIONIQ_API_KEY')
 GEMINI_MODEL = os.getenv('GEMINI_MODEL', 'gemini-2.0-flash')
 
-if not GEMINI_API_KEY or not LOCATIONIQ_API_KEY:
+if (not GEMINI_API_KEY or not LOCATIONIQ_API_KEY) and not transport.replaying:
     logger.error("Missing API keys. Please set GEMINI_API_KEY and LOCATIONIQ_API_KEY environment variables.")
     raise ValueError("API keys not found in environment variables")
 
@@ -30,15 +38,23 @@ if not GEMINI_API_KEY or not LOCATIONIQ_API_KEY:
 genai.configure(api_key=GEMINI_API_KEY)
 logger.info(f"Using Gemini model: {GEMINI_MODEL}")
 try:
-    model = genai.GenerativeModel(GEMINI_MODEL)
+    model = wrap_model(genai.GenerativeModel(GEMINI_MODEL), quota_error=exceptions.ResourceExhausted)
 except Exception as e:
     logger.error(f"Failed to initialize Gemini model '{GEMINI_MODEL}': {e}")
     raise
 
 # Files
-DATA_FILE = "wildflowers_data.json"
+DATA_FILE = "wildflowers_data.json"  # compacted snapshot, rebuilt by `python jsonl_store.py compact`
+LOG_FILE = "wildflowers_data.jsonl"
+INDEX_FILE = "wildflowers_data.idx"
 GEOCACHE_FILE = "geocache.csv"
 
+# Streaming mode (--stream): request rates of the external services, in calls per second
+FETCH_RATE = 0.5  # one page every 2 s, like the sequential loop
+GEMINI_RATE = float(os.getenv('GEMINI_RPM', '15')) / 60
+LOCATIONIQ_RATE = float(os.getenv('LOCATIONIQ_RPS', '1'))
+REPORTS_PER_PAGE = 10
+
 # Set up requests session with retries
 session = requests.Session()
 retry_strategy = Retry(
@@ -48,6 +64,7 @@ retry_strategy = Retry(
 )
 adapter = HTTPAdapter(max_retries=retry_strategy)
 session.mount("https://", adapter)
+wrap_session(session)
 
 # Load geocache from CSV
 def load_geocache():
@@ -74,7 +91,8 @@ def save_geocache(geocache):
         with open(GEOCACHE_FILE, 'w', encoding='utf-8', newline='') as f:
             writer = csv.DictWriter(f, fieldnames=['location', 'lat', 'lon'])
             writer.writeheader()
-            for location, coords in geocache.items():
+            # a snapshot: other threads may add locations meanwhile
+            for location, coords in list(geocache.items()):
                 writer.writerow({
                     'location': location,
                     'lat': coords['lat'] if coords else '',
@@ -84,101 +102,51 @@ def save_geocache(geocache):
     except Exception as e:
         logger.error(f"Error saving geocache: {e}")
 
-# Global geocache
+# Global geocache, shared by the geocoding threads in streaming mode
 geocache = load_geocache()
+geocache_lock = threading.Lock()
 
 def load_existing_data():
-    if os.path.exists(DATA_FILE):
-        try:
-            with open(DATA_FILE, 'r', encoding='utf-8') as f:
-                content = f.read().strip()
-                if not content:
-                    logger.warning(f"{DATA_FILE} is empty, starting fresh")
-                    return []
-                data = json.loads(content)
-                logger.info(f"Loaded {len(data)} existing reports from {DATA_FILE}")
-                return data
-        except json.JSONDecodeError as e:
-            logger.error(f"Error loading existing data, invalid JSON: {e}")
-            return []
-        except Exception as e:
-            logger.error(f"Error loading existing data: {e}")
-            return []
-    logger.info(f"No existing data file found at {DATA_FILE}")
-    return []
+    # The append-only log is seeded from DATA_FILE on first use; only its fingerprint index is read here
+    report_log = open_report_log(LOG_FILE, INDEX_FILE, DATA_FILE)
+    logger.info(f"Loaded {len(report_log)} existing reports from {LOG_FILE}")
+    return report_log
 
-def save_data(data):
+def save_data(report_log, new_data):
     try:
-        with open(DATA_FILE, 'w', encoding='utf-8') as f:
-            json.dump(data, f, ensure_ascii=False, indent=2)
-        logger.info(f"Saved {len(data)} reports to {DATA_FILE}")
+        added = report_log.append(new_data)
+        logger.info(f"Appended {added} reports to {LOG_FILE} ({len(report_log)} total)")
     except Exception as e:
         logger.error(f"Error saving data: {e}")
 
-def scrape_page(page_num):
+@span("fetch_page")
+def fetch_page(page_num):
+    """Downloads a page of reports. Returns its HTML, None on a network error."""
     url = f"https://www.wildflowers.co.il/hebrew/flash.asp?page={page_num}"
     logger.info(f"Scraping page: {url}")
     
     try:
         response = session.get(url, timeout=45)
         response.raise_for_status()
-        
-        soup = BeautifulSoup(response.text, 'html.parser')
-        content = soup.find('div', class_='aboutBody')
-        if not content:
-            logger.warning(f"No content found with class 'aboutBody' on page {page_num}")
-            return []
-            
-        bold_tags = content.find_all('b')
-        logger.info(f"Found {len(bold_tags)} bold tags on page {page_num}")
-        
-        reports = []
-        for bold_tag in bold_tags:
-            report = {
-                'title': bold_tag.get_text(strip=True),
-                'date': '',
-                'description': [],
-                'reporter': '',
-                'links': []
-            }
-            
-            current = bold_tag.next_sibling
-            while current:
-                if isinstance(current, BeautifulSoup) and current.name == 'b':
-                    break
-                if isinstance(current, NavigableString):
-                    text = current.strip()
-                    if text:
-                        if text.startswith('תאריך:'):
-                            report['date'] = text.replace('תאריך:', '').strip()
-                        else:
-                            report['description'].append(text)
-                elif isinstance(current, BeautifulSoup):
-                    if current.name == 'a':
-                        if 'mailto:' in current.get('href', ''):
-                            report['reporter'] = current.get_text(strip=True)
-                        elif 'http' in current.get('href', ''):
-                            report['links'].append({
-                                'text': current.get_text(strip=True),
-                                'url': current['href']
-                            })
-                    elif current.name == 'br':
-                        next_sib = current.next_sibling
-                        if next_sib and isinstance(next_sib, BeautifulSoup) and next_sib.name == 'br':
-                            break
-                
-                current = current.next_sibling if current else None
-            
-            if report['title'] and report['date'] and not report['title'].startswith(('סך הכל:', '[', 'דווחים')):
-                reports.append(report)
-        
-        logger.info(f"Extracted {len(reports)} valid reports from page {page_num}")
-        return reports
+        return response.text
     except requests.exceptions.RequestException as e:
         logger.error(f"Error scraping page {page_num}: {e}")
         return None
 
-def extract_flower_and_location(report):
+@span("scrape_page")
+def scrape_page(page_num):
+    html = fetch_page(page_num)
+    if html is None:
+        return None
+    return parse_page(html, page_num)
+
+@span("extract_flower_and_location")
+def extract_flower_and_location(report, limiter=None):
+    """Asks Gemini for the flowers and locations of a report. Returns (flowers, locations).
+
+    Without a limiter, sleeps 4 s after a successful call to stay under the quota; with
+    one (streaming mode), acquires it before every call instead.
+    """
     report_text = f"{report['title']}\n" + "\n".join(report['description'])
     
     # Primary prompt - providing more explicit instructions and examples
@@ -242,8 +210,13 @@ def extract_flower_and_location(report):
             try:
                 logger.info(f"Sending request to Gemini API for report: {report['title']} (prompt {prompt_index+1})")
                 logger.debug(f"Text sent to Gemini: {report_text}")
-                response = model.generate_content(prompt)
-                text = response.text
+                if limiter:
+                    with span("rate_limit"):
+                        limiter.acquire()
+                with span("gemini"):
+                    response = model.generate_content(prompt)
+                    text = response.text
+                count("gemini_calls")
                 
                 flowers = []
                 locations = []
@@ -259,7 +232,9 @@ def extract_flower_and_location(report):
                 if flowers or locations:  # Success if either list is non-empty
                     logger.info(f"Extracted flowers: {flowers}, locations: {locations}")
                     logger.info(f"Extraction stats: {error_stats}")
-                    time.sleep(4)
+                    if not limiter:
+                        with span("sleep"):
+                            time.sleep(4)
                     return flowers, locations
                 else:
                     error_stats["empty_results"] += 1
@@ -267,24 +242,32 @@ def extract_flower_and_location(report):
                     if prompt_index == len(prompts) - 1 and attempt < max_retries - 1:
                         wait_time = 5 * (2 ** attempt)
                         logger.warning(f"All prompts failed, waiting {wait_time} seconds before next attempt")
-                        time.sleep(wait_time)
+                        with span("sleep"):
+                            time.sleep(wait_time)
             except exceptions.ResourceExhausted as e:
                 error_stats["resource_exhausted"] += 1
+                count("quota_errors")
                 wait_time = 5 * (2 ** attempt)
                 logger.warning(f"Gemini API quota exceeded (attempt {attempt+1}/{max_retries}): {e}. Waiting {wait_time} seconds. Error count: {error_stats['resource_exhausted']}")
-                time.sleep(wait_time)
+                with span("sleep"):
+                    time.sleep(wait_time)
             except Exception as e:
                 error_stats["other_errors"] += 1
                 logger.error(f"Error with Gemini API: {e}. Error count: {error_stats['other_errors']}")
                 logger.error(f"Error type: {type(e).__name__}, Error details: {str(e)}")
-                time.sleep(2)
+                with span("sleep"):
+                    time.sleep(2)
                 
                 # Try one more approach with a minimal prompt if we've had multiple errors
                 if error_stats["other_errors"] >= 3:
                     try:
                         logger.info("Attempting minimal fallback prompt as last resort")
                         minimal_prompt = f"Extract flower names and location names from this text: {report['title']}"
-                        fallback_response = model.generate_content(minimal_prompt)
+                        if limiter:
+                            with span("rate_limit"):
+                                limiter.acquire()
+                        with span("gemini"):
+                            fallback_response = model.generate_content(minimal_prompt)
                         logger.info(f"Fallback response: {fallback_response.text}")
                         # Extract whatever we can from the response
                         # At this point, any data is better than nothing
@@ -298,7 +281,13 @@ def extract_flower_and_location(report):
     # Report would be empty, not useful to add it
     return [], []
 
-def get_coordinates(locations):
+@span("get_coordinates")
+def get_coordinates(locations, limiter=None):
+    """Coordinates ({lat, lon} or None) of each location, from the geocache, the gazetteer or LocationIQ.
+
+    Without a limiter, sleeps 1 s after each LocationIQ request; with one (streaming
+    mode), acquires it before the request instead.
+    """
     if not locations:
         return []
     
@@ -309,7 +298,18 @@ def get_coordinates(locations):
         if location in geocache:
             coords = geocache[location]
             logger.info(f"Using cached coordinates for {location}: {coords}")
+            count("cache_hits")
             coordinates.append(coords)
+            continue
+
+        gazetteer_coords = lookup_place(location)
+        if gazetteer_coords:
+            coords = {'lat': gazetteer_coords['latitude'], 'lon': gazetteer_coords['longitude']}
+            logger.info(f"Using gazetteer coordinates for {location}: {coords}")
+            count("gazetteer_hits")
+            geocache[location] = coords
+            coordinates.append(coords)
+            new_entries = True
         else:
             url = "https://api.locationiq.com/v1/autocomplete.php"
             params = {
@@ -321,9 +321,14 @@ def get_coordinates(locations):
             
             try:
                 logger.info(f"Requesting coordinates for location: {location}")
-                response = session.get(url, params=params)
-                response.raise_for_status()
-                data = response.json()
+                if limiter:
+                    with span("rate_limit"):
+                        limiter.acquire()
+                count("api_calls")
+                with span("locationiq"):
+                    response = session.get(url, params=params)
+                    response.raise_for_status()
+                    data = response.json()
                 
                 if data and isinstance(data, list) and len(data) > 0:
                     coords = {'lat': float(data[0]['lat']), 'lon': float(data[0]['lon'])}
@@ -341,27 +346,33 @@ def get_coordinates(locations):
                 geocache[location] = None
                 new_entries = True
             
-            time.sleep(1)
+            if not limiter:
+                with span("sleep"):
+                    time.sleep(1)
     
     if new_entries:
-        save_geocache(geocache)
+        with geocache_lock, span("save_geocache"):
+            save_geocache(geocache)
     
     return coordinates
 
-def main():
-    existing_data = load_existing_data()
-    existing_titles_dates = {(r['title'], r['date']) for r in existing_data}
-    
-    if existing_data:
-        reports_per_page = 10
-        last_processed_page = (len(existing_data) // reports_per_page)
+def first_page(report_log):
+    if len(report_log):
+        last_processed_page = (len(report_log) // REPORTS_PER_PAGE)
         page_num = last_processed_page + 1
-        logger.info(f"Starting from page {page_num} based on {len(existing_data)} existing reports")
+        logger.info(f"Starting from page {page_num} based on {len(report_log)} existing reports")
     else:
         page_num = 1
         logger.info("Starting from page 1 as no existing data found")
+    return page_num
+
+def main():
+    report_log = load_existing_data()
+    page_num = first_page(report_log)
     
     new_data = []
+    # (title, date) fingerprints handled this run; the log only knows the saved ones
+    seen = set()
     max_retries = 3
     retry_count = 0
     
@@ -384,8 +395,9 @@ def main():
         
         page_has_new_data = False
         for report in reports:
-            title_date = (report['title'], report['date'])
-            if title_date not in existing_titles_dates:
+            fingerprint = report_fingerprint(report['title'], report['date'])
+            if fingerprint not in seen and not report_log.contains(report['title'], report['date']):
+                seen.add(fingerprint)
                 logger.info(f"Processing new report: {report['title']}")
                 flowers, locations = extract_flower_and_location(report)
                 coordinates = get_coordinates(locations)
@@ -402,7 +414,6 @@ def main():
                 }
                 
                 new_data.append(processed_report)
-                existing_titles_dates.add(title_date)
                 page_has_new_data = True
         
         if page_has_new_data:
@@ -412,8 +423,7 @@ def main():
             page_num += 1
         
         if new_data:
-            all_data = existing_data + new_data
-            save_data(all_data)
+            save_data(report_log, new_data)
             logger.info(f"Processed page {page_num-1}, added {len(new_data)} new reports")
             new_data = []
         
@@ -421,5 +431,98 @@ def main():
     
     logger.info("Scraping completed")
 
+def stream_main(fetch_workers=2, extract_workers=4, geocode_workers=2, batch_size=REPORTS_PER_PAGE):
+    """Streaming version of main(): fetch, segment, extract, geocode and persist run as concurrent stages.
+
+    Pages are fetched ahead (as far as the bounded queues allow) until one has no
+    reports or cannot be fetched. Each stage only waits for its own service's rate
+    limit, so the Gemini calls of one report overlap with the geocoding of the
+    previous ones and the download of the next pages.
+    """
+    report_log = load_existing_data()
+    fetch_limiter = RateLimiter(FETCH_RATE)
+    gemini_limiter = RateLimiter(GEMINI_RATE)
+    locationiq_limiter = RateLimiter(LOCATIONIQ_RATE)
+    max_retries = 3
+    pending = []
+    # (title, date) fingerprints sent down the stream this run; the log only knows the saved ones
+    seen = set()
+    seen_lock = threading.Lock()
+
+    def fetch(page_num):
+        for attempt in range(max_retries + 1):
+            fetch_limiter.acquire()
+            html = fetch_page(page_num)
+            if html is not None:
+                return [(page_num, html)]
+            if attempt < max_retries:
+                logger.info(f"Retrying page {page_num} (attempt {attempt + 1}/{max_retries})")
+                time.sleep(5)
+        logger.error(f"Max retries ({max_retries}) reached, stopping at page {page_num}")
+        stream.stop()
+        return None
+
+    def segment(page):
+        page_num, html = page
+        reports = parse_page(html, page_num)
+        if not reports:
+            logger.info(f"No more reports found on page {page_num}, stopping")
+            stream.stop()
+        new_reports = []
+        with seen_lock:
+            for report in reports:
+                fingerprint = report_fingerprint(report['title'], report['date'])
+                if fingerprint not in seen and not report_log.contains(report['title'], report['date']):
+                    seen.add(fingerprint)
+                    new_reports.append(report)
+        return new_reports
+
+    def extract(report):
+        logger.info(f"Processing new report: {report['title']}")
+        flowers, locations = extract_flower_and_location(report, gemini_limiter)
+        return [dict(report, flowers=flowers, locations=locations)]
+
+    def geocode(report):
+        report['coordinates'] = get_coordinates(report['locations'], locationiq_limiter)
+        return [report]
+
+    def persist(report):
+        pending.append(report)
+        if len(pending) >= batch_size:
+            flush()
+
+    def flush():
+        if pending:
+            save_data(report_log, pending)
+            pending.clear()
+
+    stream = StreamPipeline([
+        Stage('fetch', fetch, fetch_workers, fetch_limiter),
+        Stage('segment', segment),
+        Stage('extract', extract, extract_workers, gemini_limiter),
+        Stage('geocode', geocode, geocode_workers, locationiq_limiter),
+        Stage('persist', persist, close=flush),
+    ], logger)
+    elapsed = stream.run(itertools.count(first_page(report_log)))
+    for line in stream.summary(elapsed):
+        logger.info(line)
+    logger.info(f"Scraping completed in {elapsed:.0f}s")
+
 if __name__ == "__main__":
-    main()
+    import argparse
+
+    parser = argparse.ArgumentParser(description='Scrape new wildflowers.co.il reports, extract their flowers and locations with Gemini and geocode them')
+    parser.add_argument('--stream', action='store_true',
+                        help='Run fetching, extraction, geocoding and saving as concurrent stages '
+                             '(rates: GEMINI_RPM, LOCATIONIQ_RPS environment variables)')
+    parser.add_argument('--fetch-workers', type=int, default=2)
+    parser.add_argument('--extract-workers', type=int, default=4)
+    parser.add_argument('--geocode-workers', type=int, default=2)
+    add_profile_argument(parser)
+    args = parser.parse_args()
+
+    with profiling('grok', args.profile):
+        if args.stream:
+            stream_main(args.fetch_workers, args.extract_workers, args.geocode_workers)
+        else:
+            main()
@@ -9,11 +9,11 @@ from requests.adapters import HTTPAdapter
 from requests.packages.urllib3.util.retry import Retry
 import google.generativeai as genai
 
-# Set up logging
-logging.basicConfig(
-    level=logging.DEBUG,
-    format='%(asctime)s - %(levelname)s - %(message)s'
-)
+from gazetteer import lookup_place
+from logs import configure, event
+
+# Set up logging (LOG_LEVEL=DEBUG for a record per parsed report)
+configure()
 logger = logging.getLogger(__name__)
 
 # Read API keys and model from environment variables
@@ -121,7 +121,7 @@ def scrape_page(page_num):
     try:
         response = session.get(url, timeout=45)
         response.raise_for_status()
-        logger.debug(f"Successfully fetched page {page_num}, status code: {response.status_code}")
+        logger.debug("Successfully fetched page %d, status code: %d", page_num, response.status_code)
         
         soup = BeautifulSoup(response.text, 'html.parser')
         content = soup.find('div', class_='aboutBody')
@@ -130,7 +130,7 @@ def scrape_page(page_num):
             return []
             
         bold_tags = content.find_all('b')
-        logger.info(f"Found {len(bold_tags)} bold tags on page {page_num}")
+        logger.debug("Found %d bold tags on page %d", len(bold_tags), page_num)
         
         reports = []
         for i, bold_tag in enumerate(bold_tags):
@@ -141,7 +141,6 @@ def scrape_page(page_num):
                 'reporter': '',
                 'links': []
             }
-            logger.debug(f"Processing bold tag {i} - Title: {report['title']}")
             
             current = bold_tag.next_sibling
             while current:
@@ -152,38 +151,33 @@ def scrape_page(page_num):
                     if text:
                         if text.startswith('תאריך:'):
                             report['date'] = text.replace('תאריך:', '').strip()
-                            logger.debug(f"Report {i} - Date: {report['date']}")
                         else:
                             report['description'].append(text)
-                            logger.debug(f"Report {i} - Description: {text}")
                 elif isinstance(current, BeautifulSoup):
                     if current.name == 'a':
                         if 'mailto:' in current.get('href', ''):
                             report['reporter'] = current.get_text(strip=True)
-                            logger.debug(f"Report {i} - Reporter: {report['reporter']}")
                         elif 'http' in current.get('href', ''):
                             report['links'].append({
                                 'text': current.get_text(strip=True),
                                 'url': current['href']
                             })
-                            logger.debug(f"Report {i} - Link: {report['links'][-1]}")
                     elif current.name == 'br':
                         next_sib = current.next_sibling
                         if next_sib and isinstance(next_sib, BeautifulSoup) and next_sib.name == 'br':
-                            logger.debug(f"Report {i} - Double <br> detected, ending report")
                             break
                 
                 current = current.next_sibling if current else None
             
-            logger.debug(f"Report {i} constructed: {report}")
-            
-            if report['title'] and report['date'] and not report['title'].startswith(('סך הכל:', '[', 'דווחים')):
-                logger.info(f"Valid report found on page {page_num} - Title: {report['title']}")
+            # one record per report instead of one per node; formatted only when DEBUG is on
+            valid = bool(report['title'] and report['date'] and not report['title'].startswith(('סך הכל:', '[', 'דווחים')))
+            event(logger, logging.DEBUG, "report_parsed", rate=20, page=page_num, index=i, valid=valid,
+                  title=report['title'], date=report['date'], lines=len(report['description']),
+                  reporter=report['reporter'], links=len(report['links']))
+            if valid:
                 reports.append(report)
-            else:
-                logger.debug(f"Report {i} skipped - Invalid or metadata: Title: '{report['title']}', Date: '{report['date']}'")
         
-        logger.info(f"Extracted {len(reports)} valid reports from page {page_num}")
+        logger.info("Extracted %d valid reports of %d bold tags from page %d", len(reports), len(bold_tags), page_num)
         return reports
     except requests.exceptions.RequestException as e:
         logger.error(f"Error scraping page {page_num}: {e}")
@@ -238,6 +232,15 @@ def get_coordinates(locations):
             coords = geocache[location]
             logger.info(f"Using cached coordinates for {location}: {coords}")
             coordinates.append(coords)
+            continue
+
+        gazetteer_coords = lookup_place(location)
+        if gazetteer_coords:
+            coords = {'lat': gazetteer_coords['latitude'], 'lon': gazetteer_coords['longitude']}
+            logger.info(f"Using gazetteer coordinates for {location}: {coords}")
+            geocache[location] = coords
+            coordinates.append(coords)
+            new_entries = True
         else:
             url = "https://api.locationiq.com/v1/autocomplete.php"
             params = {
@@ -0,0 +1,242 @@
+import json
+import os
+from datetime import datetime
+
+from replay import transport, wrap_geocode, wrap_model, wrap_session
+
+# The ingest path: scraping the flowering reports website, extracting the reports with
+# Gemini and geocoding them. The heavy libraries (requests, bs4, geopy,
+# google.generativeai) are imported inside the functions that use them, so the serving
+# path (flask_app.py) can import this module without paying for them.
+
+API_KEYS = ('MAPS_API_KEY', 'GEMINI_API_KEY')
+
+
+def missing_api_keys():
+    '''Names of the API keys missing from the environment (none are needed to replay recorded responses)'''
+    if transport.replaying:
+        return []
+    return [key for key in API_KEYS if os.getenv(key) is None]
+
+
+def extract_reports_from_html(html_content):
+    """Extracts flowering reports from HTML content using BeautifulSoup."""
+    from bs4 import BeautifulSoup
+
+    soup = BeautifulSoup(html_content, "html.parser")
+    reports = []
+    # Adjust this selector to target the report elements accurately. Inspect the website's HTML!
+    report_elements = soup.find_all("div", class_="aboutBody")  # Example selector
+
+    if not report_elements:
+        print("No report elements found. Check your CSS selector.")
+        return None
+
+    for report_element in report_elements:
+        reports.append(report_element.text)
+
+    return reports
+
+def generate_json_with_gemini(reports):
+    """Generates JSON from flowring reports website using the Gemini API.
+    
+    Parameters:
+    -----------
+    reports: str
+        the reports to process (scraped from the website)
+        
+    Returns:
+    --------
+    json_output: str
+        the JSON output from the Gemini API
+        """
+
+    if not reports:
+        return "No reports to process."
+
+    prompt = f"""
+    Extract flower names and locations (into a structed JSON) using the the following website html code (originating from a flowering report website which is in hebrew):
+
+    {reports}
+
+    The JSON format should contain the following fields:
+    - flowers: The name of the flower.
+    - locations: The location where the flower was found.
+    - maps_query_locations: location names formatted for Google Maps queries (e.g. ignoring "near", "between" etc. so more likely to return a valid results when querying Google Maps).
+    - date: The date of the observation
+    - original_report: The original report text.
+    - observer: The name of the person who reported the observation.
+
+    the "flowers" and "locations" fields should be an array of strings (even if only one flower or location is mentioned).
+
+    If a report doesn't have flower or location information, leave the corresponding field empty.
+    """
+
+    print('generate json with gemini')
+    try:
+        import google.generativeai as genai
+
+        # get the google api key from the environment variable
+        gemini_api_key = os.environ.get("GEMINI_API_KEY")
+
+        # Set your Gemini API key
+        genai.configure(api_key=gemini_api_key)
+
+        # model = genai.GenerativeModel('gemini-pro')
+        model = wrap_model(genai.GenerativeModel("gemini-1.5-flash"))
+        print('running model')
+        response = model.generate_content(prompt)
+        print('got response')
+        json_output = response.text
+
+        if json_output.startswith("```json"):
+            json_output = json_output[7:]
+            json_output = json_output[:-4]
+
+        try:
+            # Validate JSON output
+            parsed_json = json.loads(json_output)
+            print('parsed json. total reports: %d' % len(parsed_json))
+            return parsed_json
+        except json.JSONDecodeError as e:
+            print(f"Gemini returned invalid JSON: {e}")
+            # print(f"Raw Gemini Output:\n{json_output}") #print the raw output for debugging
+            return json_output
+
+    except Exception as e:
+        print(f"Error calling Gemini API: {e}")
+        return None
+
+def get_lat_lon_from_location(location, key=None):
+    '''Get the latitude and longitude of a location using the Google Maps API
+    
+    Parameters:
+    -----------
+    location: str
+        the location to query
+    key: str or None
+        the Google Maps API key to use. If None, the key is read from the GOOGLE_MAPS_API_KEY environment variable.
+    
+    Returns:
+    --------
+    lat: float
+        the latitude of the location
+    lon: float
+        the longitude of the location
+    '''
+    from gazetteer import lookup_place
+
+    coords = lookup_place(location)
+    if coords:
+        return coords['latitude'], coords['longitude']
+
+    # geopy is only paid for when the offline gazetteer does not know the place
+    from geopy.geocoders import GoogleV3
+
+    if key is None:
+        key = os.getenv('MAPS_API_KEY')
+
+    # Initialize the GoogleV3 geocoder with your API key
+    geolocator = GoogleV3(api_key=key)
+    
+    # Geocode the location
+    location = wrap_geocode(geolocator.geocode, 'google_maps')(location,components={"country": "IL"})
+    
+    if location:
+        return location.latitude, location.longitude
+    else:
+        return None, None
+
+
+def process_website(url):
+    print('process website')
+    """Processes a website to extract flowering reports and generate JSON.
+    
+    Parameters:
+    -----------
+    url: str
+        the URL of the website to process
+        
+    Returns:
+    --------
+    json_output: json
+        the JSON containing the extracted flowering reports
+        list of dictionaries, each containing the following fields:
+        - flowers: (list of str) The names of the flowers at the location.
+        - locations (list of str): The locations where the flowers were found.
+        - maps_query_locations (list of str): location names formatted for Google Maps queries (e.g. ignoring "near", "between" etc. so more likely to return a valid results when querying Google Maps).
+        - date (str): The date of the observation
+        - original_report (str): The original report text.
+        - observer (str): The name of the person who reported the observation.
+    """
+    import requests
+
+    try:
+        response = wrap_session(requests.Session()).get(url)
+        response.raise_for_status()  # Raise HTTPError for bad responses (4xx or 5xx)
+        html_content = response.content.decode('utf-8')
+    except requests.exceptions.RequestException as e:
+        print(f"Error fetching URL: {e}")
+        return None
+
+    print('got html content. length: %d' % len(html_content))
+    # print(html_content)
+
+    # reports = extract_reports_from_html(html_content)
+
+    # if reports is None:
+    #     return None
+
+    # json_output = generate_json_with_gemini(reports)
+
+    json_output = generate_json_with_gemini(html_content)
+    return json_output
+
+
+def scrape_latest_reports():
+    '''Scrape the latest flowering reports from the website and extract them with Gemini
+
+    Slow (minutes): called by the background refresher, never on a request thread.
+
+    Returns:
+    --------
+    err: str
+        error message, if any
+    reports: json
+        the JSON containing the extracted flowering reports
+        list of dictionaries, each containing the following fields:
+        - flowers: (list of str) The names of the flowers at the location.
+        - locations (list of str): The locations where the flowers were found.
+        - maps_query_locations (list of str): location names formatted for Google Maps queries (e.g. ignoring "near", "between" etc. so more likely to return a valid results when querying Google Maps).
+        - date (str): The date of the observation
+        - original_report (str): The original report text.
+        - observer (str): The name of the person who reported the observation.
+    '''
+    missing = missing_api_keys()
+    if missing:
+        return "%s not found in environment variables" % ', '.join(missing), {}
+
+    # scrape the website https://www.wildflowers.co.il/hebrew/flash.asp
+    # get the website content
+    print('processing website')
+    json_result = []
+    website_url = "https://www.wildflowers.co.il/hebrew/flash.asp/"
+    for cpage in range(1,10):
+        print('page %d' % cpage)
+        website_url = 'https://www.wildflowers.co.il/hebrew/flash.asp?page=%d' % cpage
+        cjson_result = process_website(website_url)
+        if cjson_result is None:
+            break
+        # get the 3 latest dates from the reports
+        dates = [x['date'] for x in cjson_result]
+        # convert the dates to datetime objects
+        dates = [datetime.strptime(x,'%d/%m/%Y') for x in dates]
+        dates.sort(reverse=True)
+
+        json_result.extend(cjson_result)
+
+    if len(json_result)==0:
+        return "Error processing website", {}
+
+    print('got %d reports' % len(json_result))
+    return None, json_result
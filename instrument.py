@@ -0,0 +1,217 @@
+import cProfile
+import functools
+import json
+import os
+import sys
+import threading
+import time
+import tracemalloc
+from collections import Counter
+from contextlib import contextmanager
+
+# Spans time the stages of the ingest scripts:
+#
+#   with span("llm"):                     @span("parse_page")
+#       response = model.generate(...)   def parse_page(html): ...
+#   count("cache_hits")
+#
+# Spans nest per thread ("scrape_page/parse"), and counters are attributed to the
+# innermost open span. Recording a span costs two clock reads and a dict update, so they
+# stay on; report() summarises them. profiling() (the scripts' --profile flag) also runs
+# cProfile, a stack sampler for flame graphs and tracemalloc, for a peak per span.
+PROFILE_DIR = "profiles"
+SAMPLE_INTERVAL = 0.005
+
+_stats = {}
+_stats_lock = threading.Lock()
+_local = threading.local()
+
+
+class _Stat:
+    __slots__ = ("calls", "total", "max", "peak", "counters")
+
+    def __init__(self):
+        self.calls = 0
+        self.total = 0.0
+        self.max = 0.0
+        self.peak = 0
+        self.counters = Counter()
+
+
+def _stack():
+    stack = getattr(_local, "stack", None)
+    if stack is None:
+        stack = _local.stack = []
+    return stack
+
+
+def _stat(path):
+    stat = _stats.get(path)
+    if stat is None:
+        stat = _stats[path] = _Stat()
+    return stat
+
+
+class span:
+    def __init__(self, name):
+        """Times a block (`with span(name):`) or every call of a function (`@span(name)`)."""
+        self.name = name
+
+    def __enter__(self):
+        stack = _stack()
+        path = stack[-1][0] + "/" + self.name if stack else self.name
+        memory = None
+        if tracemalloc.is_tracing():
+            current, peak = tracemalloc.get_traced_memory()
+            if stack:
+                stack[-1][3] = max(stack[-1][3], peak)
+            tracemalloc.reset_peak()
+            memory = current
+        stack.append([path, time.perf_counter(), memory, 0])
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        path, started, memory, child_peak = _stack().pop()
+        elapsed = time.perf_counter() - started
+        peak = 0
+        if memory is not None and tracemalloc.is_tracing():
+            peak = max(tracemalloc.get_traced_memory()[1], child_peak)
+            stack = _stack()
+            if stack:
+                # the enclosing span's peak includes this one
+                stack[-1][3] = max(stack[-1][3], peak)
+            peak -= memory
+        with _stats_lock:
+            stat = _stat(path)
+            stat.calls += 1
+            stat.total += elapsed
+            stat.max = max(stat.max, elapsed)
+            stat.peak = max(stat.peak, peak)
+        return False
+
+    def __call__(self, func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            with span(self.name):
+                return func(*args, **kwargs)
+        return wrapper
+
+
+def count(name, n=1):
+    """Adds n to a counter of the innermost open span."""
+    stack = _stack()
+    path = stack[-1][0] if stack else ""
+    with _stats_lock:
+        _stat(path).counters[name] += n
+
+
+def reset():
+    with _stats_lock:
+        _stats.clear()
+
+
+def snapshot():
+    """{span path: {calls, total_s, max_s, peak_bytes, counters}}"""
+    with _stats_lock:
+        return {path: {"calls": stat.calls, "total_s": stat.total, "max_s": stat.max, "peak_bytes": stat.peak,
+                       "counters": dict(stat.counters)}
+                for path, stat in sorted(_stats.items())}
+
+
+def report():
+    """The spans as a table: calls, total and mean time, peak memory (under profiling) and counters."""
+    stats = snapshot()
+    if not stats:
+        return ["no spans recorded"]
+    width = max(len(path) for path in stats) + 2
+    lines = ["%-*s %8s %10s %10s %10s  %s" % (width, "span", "calls", "total s", "mean ms", "peak MiB", "counters")]
+    for path, stat in stats.items():
+        depth = path.count("/")
+        name = "  " * depth + (path.rsplit("/", 1)[-1] or "(no span)")
+        counters = ", ".join("%s=%d" % item for item in sorted(stat["counters"].items()))
+        mean = 1000 * stat["total_s"] / stat["calls"] if stat["calls"] else 0.0
+        lines.append("%-*s %8d %10.2f %10.2f %10s  %s" % (
+            width, name, stat["calls"], stat["total_s"], mean,
+            "%.1f" % (stat["peak_bytes"] / 2 ** 20) if stat["peak_bytes"] else "-", counters))
+    return lines
+
+
+class StackSampler:
+    def __init__(self, interval=SAMPLE_INTERVAL):
+        """Samples the Python stacks of every thread, for a collapsed-stack (flame graph) file."""
+        self.interval = interval
+        self.samples = Counter()
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, name="stack-sampler", daemon=True)
+
+    def _run(self):
+        own = threading.get_ident()
+        names = {}
+        while not self._stop.wait(self.interval):
+            for ident, frame in sys._current_frames().items():
+                if ident == own:
+                    continue
+                stack = []
+                while frame is not None:
+                    code = frame.f_code
+                    stack.append("%s (%s:%d)" % (code.co_name, os.path.basename(code.co_filename), code.co_firstlineno))
+                    frame = frame.f_back
+                if ident not in names:
+                    names = {thread.ident: thread.name for thread in threading.enumerate()}
+                stack.append(names.get(ident, "thread"))
+                self.samples[";".join(reversed(stack))] += 1
+
+    def start(self):
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        self._thread.join()
+
+    def write(self, path):
+        """Writes "frame;frame;frame count" lines, the input of flamegraph.pl / speedscope."""
+        with open(path, "w", encoding="utf-8") as f:
+            for stack, samples in sorted(self.samples.items()):
+                f.write("%s %d\n" % (stack, samples))
+
+
+@contextmanager
+def profiling(name, enabled=True, directory=PROFILE_DIR):
+    """Profiles the block when enabled: cProfile stats, sampled stacks and tracemalloc peaks per span.
+
+    Writes <directory>/<name>-<time>.pstats (for pstats / snakeviz), .collapsed (for
+    flame graphs) and .spans.json, and prints the span report and the top functions.
+    """
+    if not enabled:
+        yield
+        return
+    import pstats
+
+    os.makedirs(directory, exist_ok=True)
+    prefix = os.path.join(directory, "%s-%s" % (name, time.strftime("%Y%m%d-%H%M%S")))
+    reset()
+    sampler = StackSampler()
+    profiler = cProfile.Profile()
+    tracemalloc.start()
+    sampler.start()
+    profiler.enable()
+    try:
+        with span(name):
+            yield
+    finally:
+        profiler.disable()
+        sampler.stop()
+        tracemalloc.stop()
+        profiler.dump_stats(prefix + ".pstats")
+        sampler.write(prefix + ".collapsed")
+        with open(prefix + ".spans.json", "w", encoding="utf-8") as f:
+            json.dump(snapshot(), f, indent=2, ensure_ascii=False)
+        print("\n".join(report()))
+        pstats.Stats(profiler).sort_stats("cumulative").print_stats(15)
+        print("Profile written to %s.{pstats,collapsed,spans.json}" % prefix)
+
+
+def add_profile_argument(parser):
+    parser.add_argument("--profile", action="store_true",
+                        help="Profile the run: span timings, cProfile stats, a collapsed-stack file for flame graphs "
+                             "and tracemalloc peaks per stage (written to %s/)" % PROFILE_DIR)
@@ -0,0 +1,155 @@
+import json
+import os
+
+CHUNK_SIZE = 64 * 1024
+WHITESPACE = " \t\n\r"
+
+_decoder = json.JSONDecoder()
+
+
+class _Buffer:
+    """A growing window over a text file, consumed from the front."""
+
+    def __init__(self, f, chunk_size):
+        self.f = f
+        self.chunk_size = chunk_size
+        self.text = ""
+        self.pos = 0
+        self.eof = False
+
+    def fill(self):
+        if self.eof:
+            return False
+        chunk = self.f.read(self.chunk_size)
+        if not chunk:
+            self.eof = True
+            return False
+        # Drop the consumed prefix so memory stays bounded by the largest single value
+        self.text = self.text[self.pos:] + chunk
+        self.pos = 0
+        return True
+
+    def peek(self):
+        """Returns the next non-whitespace character (without consuming it), or '' at EOF."""
+        while True:
+            while self.pos < len(self.text) and self.text[self.pos] in WHITESPACE:
+                self.pos += 1
+            if self.pos < len(self.text):
+                return self.text[self.pos]
+            if not self.fill():
+                return ""
+
+    def expect(self, char):
+        found = self.peek()
+        if found != char:
+            raise ValueError(f"Expected {char!r} at offset {self.pos}, found {found!r}")
+        self.pos += 1
+
+    def decode(self):
+        """Decodes the next JSON value, reading more input until it is complete."""
+        self.peek()
+        while True:
+            try:
+                value, end = _decoder.raw_decode(self.text, self.pos)
+                # A number (or literal) ending exactly at the buffer end may continue in the next chunk
+                if end < len(self.text) or self.eof or not self.fill():
+                    self.pos = end
+                    return value
+            except json.JSONDecodeError:
+                if not self.fill():
+                    raise
+
+
+def iter_reports(path, key="reports", chunk_size=CHUNK_SIZE):
+    """Yields the items of a report file one at a time, without loading the whole array.
+
+    Accepts both `{"reports": [...]}` documents (other top-level keys are skipped)
+    and bare top-level arrays such as wildflowers_data.json.
+
+    Args:
+        path (str): The JSON file to read.
+        key (str): The top-level key holding the array.
+        chunk_size (int): Characters read from the file at a time.
+    """
+    with open(path, "r", encoding="utf-8") as f:
+        buf = _Buffer(f, chunk_size)
+        first = buf.peek()
+        if first == "{":
+            buf.expect("{")
+            while True:
+                if buf.peek() == "}":
+                    return
+                name = buf.decode()
+                buf.expect(":")
+                if name == key:
+                    break
+                buf.decode()
+                if buf.peek() == ",":
+                    buf.expect(",")
+        elif first != "[":
+            raise ValueError(f"{path} is neither a JSON object nor an array")
+
+        buf.expect("[")
+        if buf.peek() == "]":
+            return
+        while True:
+            yield buf.decode()
+            separator = buf.peek()
+            if separator == "]":
+                return
+            buf.expect(",")
+
+
+class ReportWriter:
+    def __init__(self, path, key="reports", indent=2):
+        """Streams reports into a `{"reports": [...]}` document.
+
+        Output goes to a temporary file that replaces `path` on a clean close, so a
+        file can be rewritten while it is being read with `iter_reports`. The layout
+        matches merge.py's output (one indented report per item).
+
+        Args:
+            path (str): The output file.
+            key (str): The top-level key holding the array.
+            indent (int or None): Indentation of each report, None for one line per report.
+        """
+        self.path = path
+        self.tmp_path = path + ".tmp"
+        self.indent = indent
+        self.count = 0
+        self.f = open(self.tmp_path, "w", encoding="utf-8")
+        self.f.write("{\n  %s: [\n" % json.dumps(key))
+
+    def write(self, report):
+        if self.count:
+            self.f.write(",\n")
+        self.f.write(json.dumps(report, indent=self.indent, ensure_ascii=False))
+        self.count += 1
+
+    def close(self):
+        if self.count:
+            self.f.write("\n")
+        self.f.write("  ]\n}")
+        self.f.close()
+        os.replace(self.tmp_path, self.path)
+
+    def abort(self):
+        self.f.close()
+        os.remove(self.tmp_path)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        if exc_type is None:
+            self.close()
+        else:
+            self.abort()
+
+
+def write_reports(path, reports, key="reports", indent=2):
+    """Drains an iterable of reports into `path`. Returns the number of reports written."""
+    with ReportWriter(path, key=key, indent=indent) as writer:
+        for report in reports:
+            writer.write(report)
+    return writer.count
@@ -0,0 +1,199 @@
+import hashlib
+import json
+import os
+
+# Append-only log of grok.py reports, its fingerprint index and the compacted snapshot
+LOG_FILE = "wildflowers_data.jsonl"
+INDEX_FILE = "wildflowers_data.idx"
+SNAPSHOT_FILE = "wildflowers_data.json"
+
+
+def report_fingerprint(title, date):
+    """Identity of a scraped report; grok.py considers (title, date) pairs duplicates."""
+    return hashlib.sha1(f"{title}\x00{date}".encode("utf-8")).hexdigest()[:16]
+
+
+def _report_key(report):
+    return report_fingerprint(report.get("title", ""), report.get("date", ""))
+
+
+class ReportLog:
+    def __init__(self, log_file=LOG_FILE, index_file=INDEX_FILE):
+        """Append-only JSONL report log with an on-disk fingerprint index.
+
+        Every line of the log is one report. The index file holds one
+        "<fingerprint>\\t<end offset>" line per log record, so startup only reads the
+        (small) index instead of decoding the whole log. If the log grew past the last
+        indexed offset (e.g. a crash between the two writes), only the tail is scanned;
+        if it shrank, the index is rebuilt.
+        """
+        self.log_file = log_file
+        self.index_file = index_file
+        self.fingerprints = set()
+        self._load_index()
+
+    def __len__(self):
+        return len(self.fingerprints)
+
+    def __contains__(self, report):
+        return _report_key(report) in self.fingerprints
+
+    def contains(self, title, date):
+        return report_fingerprint(title, date) in self.fingerprints
+
+    def _load_index(self):
+        log_size = os.path.getsize(self.log_file) if os.path.exists(self.log_file) else 0
+        indexed_size = 0
+        valid = True
+        if os.path.exists(self.index_file):
+            with open(self.index_file, "r", encoding="utf-8") as f:
+                for line in f:
+                    fingerprint, _, offset = line.rstrip("\n").partition("\t")
+                    if not line.endswith("\n") or not offset.isdigit():
+                        valid = False
+                        break
+                    self.fingerprints.add(fingerprint)
+                    indexed_size = int(offset)
+
+        if not valid or indexed_size > log_size:
+            print(f"Index {self.index_file} does not match {self.log_file}, rebuilding it")
+            self.fingerprints = set()
+            indexed_size = 0
+            open(self.index_file, "w").close()
+        if indexed_size < log_size:
+            self._index_tail(indexed_size)
+
+    def _index_tail(self, offset):
+        """Indexes the log records from `offset` on, truncating a torn last line."""
+        entries = []
+        with open(self.log_file, "rb") as f:
+            f.seek(offset)
+            for line in f:
+                try:
+                    report = json.loads(line)
+                except ValueError:
+                    if line.endswith(b"\n"):
+                        raise
+                    print(f"Dropping incomplete last record of {self.log_file}")
+                    break
+                offset += len(line)
+                entries.append((_report_key(report), offset))
+        if os.path.getsize(self.log_file) != offset:
+            with open(self.log_file, "r+b") as f:
+                f.truncate(offset)
+        self._write_index(entries)
+
+    def _write_index(self, entries):
+        with open(self.index_file, "a", encoding="utf-8") as f:
+            for fingerprint, offset in entries:
+                f.write(f"{fingerprint}\t{offset}\n")
+                self.fingerprints.add(fingerprint)
+            f.flush()
+            os.fsync(f.fileno())
+
+    def append(self, reports):
+        """Appends the reports that are not in the log yet, as one fsync'd batch. Returns the number added."""
+        lines = []
+        batch = set()
+        for report in reports:
+            fingerprint = _report_key(report)
+            if fingerprint in self.fingerprints or fingerprint in batch:
+                continue
+            batch.add(fingerprint)
+            lines.append((fingerprint, (json.dumps(report, ensure_ascii=False) + "\n").encode("utf-8")))
+        if not lines:
+            return 0
+
+        entries = []
+        with open(self.log_file, "ab") as f:
+            offset = f.tell()
+            for fingerprint, line in lines:
+                f.write(line)
+                offset += len(line)
+                entries.append((fingerprint, offset))
+            f.flush()
+            os.fsync(f.fileno())
+        self._write_index(entries)
+        return len(entries)
+
+    def iter_reports(self):
+        """Yields the logged reports in append order."""
+        if not os.path.exists(self.log_file):
+            return
+        with open(self.log_file, "r", encoding="utf-8") as f:
+            for line in f:
+                yield json.loads(line)
+
+    def import_snapshot(self, snapshot_file=SNAPSHOT_FILE):
+        """Seeds the log from an existing JSON array snapshot (e.g. an old wildflowers_data.json)."""
+        with open(snapshot_file, "r", encoding="utf-8") as f:
+            content = f.read().strip()
+        return self.append(json.loads(content) if content else [])
+
+    def compact(self, snapshot_file=SNAPSHOT_FILE):
+        """Rewrites the log deduplicated and sorted, and writes a single JSON snapshot of it.
+
+        Reports are sorted newest first, then by title. Both files are written to a
+        temporary path and atomically renamed over the old ones.
+        """
+        from report_store import parse_day
+
+        reports = {}
+        for report in self.iter_reports():
+            reports.setdefault(_report_key(report), report)
+        ordered = sorted(reports.values(), key=lambda r: (-(parse_day(r.get("date")) or 0), r.get("title", "")))
+
+        tmp_log = self.log_file + ".tmp"
+        entries = []
+        offset = 0
+        with open(tmp_log, "wb") as f:
+            for report in ordered:
+                line = (json.dumps(report, ensure_ascii=False) + "\n").encode("utf-8")
+                f.write(line)
+                offset += len(line)
+                entries.append((_report_key(report), offset))
+            f.flush()
+            os.fsync(f.fileno())
+
+        tmp_snapshot = snapshot_file + ".tmp"
+        with open(tmp_snapshot, "w", encoding="utf-8") as f:
+            json.dump(ordered, f, ensure_ascii=False, indent=2)
+            f.flush()
+            os.fsync(f.fileno())
+
+        os.replace(tmp_log, self.log_file)
+        open(self.index_file, "w").close()
+        self.fingerprints = set()
+        self._write_index(entries)
+        os.replace(tmp_snapshot, snapshot_file)
+        return len(ordered)
+
+
+def open_report_log(log_file=LOG_FILE, index_file=INDEX_FILE, snapshot_file=SNAPSHOT_FILE):
+    """Opens the report log, seeding it from the JSON snapshot the first time."""
+    seed = not os.path.exists(log_file) and os.path.exists(snapshot_file)
+    report_log = ReportLog(log_file, index_file)
+    if seed:
+        added = report_log.import_snapshot(snapshot_file)
+        print(f"Imported {added} reports from {snapshot_file} into {log_file}")
+    return report_log
+
+
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Maintain the append-only grok.py report log")
+    parser.add_argument("--log-file", default=LOG_FILE)
+    parser.add_argument("--index-file", default=INDEX_FILE)
+    parser.add_argument("--snapshot-file", default=SNAPSHOT_FILE)
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    subparsers.add_parser("compact", help="Deduplicate and sort the log and write the JSON snapshot")
+    subparsers.add_parser("stats", help="Print the number of logged reports")
+    args = parser.parse_args()
+
+    report_log = open_report_log(args.log_file, args.index_file, args.snapshot_file)
+    if args.command == "compact":
+        total = report_log.compact(args.snapshot_file)
+        print(f"Compacted {total} reports into {args.snapshot_file}")
+    else:
+        print(f"{len(report_log)} reports in {args.log_file}")
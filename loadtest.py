@@ -0,0 +1,361 @@
+import hashlib
+import json
+import os
+import random
+import threading
+import time
+
+# The app never reaches the network under load: the API clients replay recorded fixtures
+# (see replay.py) and the snapshot is served as it is, without background scraping
+os.environ.setdefault("API_REPLAY", "replay")
+os.environ.setdefault("SNAPSHOT_REFRESH", "0")
+
+# Routes requested and their relative weights: mostly page views, some API traffic
+MIX = (
+    ("/map", 4),
+    ("/reports", 2),
+    ("/api/reports?limit=50", 2),
+    ("/api/clusters?bbox=34.2,29.5,35.9,33.3&zoom=8", 2),
+    ("/api/nearby?lat=32.79&lon=35.0&km=10", 1),
+    ("/api/search?q=%D7%9B%D7%9C%D7%A0%D7%99%D7%95%D7%AA", 1),
+    ("/api/stats", 1),
+)
+SWEEP_LEVELS = (1, 2, 4, 8, 16, 32, 64)
+# A sweep stops at the first level gaining less than this over the previous level's throughput
+SATURATION_GAIN = 0.10
+STUB_LATENCY = 0.05
+# Seconds a warm-up request waits for a route still being prepared
+WARMUP_TIMEOUT = 30.0
+
+
+def parse_mix(entries):
+    """["ROUTE@WEIGHT", "ROUTE", ...] -> ((route, weight), ...); the weight defaults to 1."""
+    mix = []
+    for entry in entries:
+        route, _, weight = entry.rpartition("@")
+        if not route:
+            route, weight = weight, "1"
+        try:
+            weight = float(weight)
+        except ValueError:
+            raise ValueError("bad weight in %r (expected ROUTE@WEIGHT)" % entry)
+        if not route.startswith("/") or weight <= 0:
+            raise ValueError("bad mix entry %r (expected /route@positive weight)" % entry)
+        mix.append((route, weight))
+    return tuple(mix)
+
+
+def stub_geocode(latency=STUB_LATENCY):
+    """A geocoder taking `latency` seconds and placing each location at a fixed point in Israel."""
+    def geocode(location):
+        time.sleep(latency)
+        digest = hashlib.sha1(location.encode("utf-8")).digest()
+        return 29.5 + 3.8 * digest[0] / 255, 34.3 + 1.5 * digest[1] / 255
+    return geocode
+
+
+def load_app(backend="replay", stub_latency=STUB_LATENCY, response_cache=True, workdir=None):
+    """Imports flask_app with the chosen backend. Returns the Flask app.
+
+    Either way the map layer is built into memory only, through a geocode cache in
+    workdir, so the app's layer file and geocode cache are left alone.
+
+    Args:
+        backend (str): "replay": a geocode cache seeded from the app's, with geocoder
+            misses served from the recorded fixtures; falls back to "stub" if none were
+            recorded (see replay.py). "stub": an empty geocode cache in front of
+            stub_geocode, so the map layer build pays `stub_latency` per location.
+        response_cache (bool): False to render /map and /reports on every request.
+        workdir (str or None): Directory of the geocode cache file (default: a new temporary one).
+    """
+    import tempfile
+
+    import flask_app
+    from ingest import get_lat_lon_from_location
+    from map_layer import GEOCODE_CACHE_FILE, SEED_CACHE_FILES, GeocodeCache, MapLayerCache
+    from replay import transport
+
+    if backend not in ("replay", "stub"):
+        raise ValueError("backend must be replay or stub, not %r" % backend)
+    if backend == "replay" and not transport.has_fixtures():
+        print(f"no recorded API fixtures in {transport.fixtures_dir}, using the stub backend")
+        backend = "stub"
+    workdir = workdir or tempfile.mkdtemp(prefix="flowers-load-")
+    cache_file = os.path.join(workdir, "geocode_cache.csv")
+    if backend == "stub":
+        geocode_cache = GeocodeCache(stub_geocode(stub_latency), cache_file, seed_files=())
+    else:
+        geocode_cache = GeocodeCache(get_lat_lon_from_location, cache_file,
+                                     seed_files=SEED_CACHE_FILES + (GEOCODE_CACHE_FILE,))
+    flask_app.map_layers = MapLayerCache(geocode_cache, layer_file=None)
+    if not response_cache:
+        flask_app.response_cache.max_bytes = 0
+    # the app builds the map layer in the background; the load is measured once it is served
+    snapshot = flask_app.refresher.snapshot
+    if snapshot is not None:
+        started = time.perf_counter()
+        flask_app.map_layers.build(snapshot.reports, snapshot.version)
+        print(f"map layer ready in {(time.perf_counter() - started) * 1000:.0f}ms")
+    return flask_app.app
+
+
+class InProcessClient:
+    def __init__(self, app):
+        """Requests through the Flask test client (one per worker thread): no sockets, the app's cost only."""
+        self.client = app.test_client()
+
+    def get(self, route):
+        response = self.client.get(route)
+        response.get_data()
+        return response.status_code
+
+
+class HttpClient:
+    def __init__(self, base_url):
+        """Requests to a running server over HTTP, with a keep-alive connection per worker thread."""
+        import requests
+
+        self.base_url = base_url.rstrip("/")
+        self.session = requests.Session()
+
+    def get(self, route):
+        response = self.session.get(self.base_url + route, timeout=60)
+        return response.status_code
+
+
+def serve(app, host="127.0.0.1", port=0):
+    """Serves the app from a background thread (the threaded development server). Returns (server, base URL)."""
+    import logging
+
+    from werkzeug.serving import make_server
+
+    # a log line per request would be a good part of what is measured
+    logging.getLogger("werkzeug").setLevel(logging.WARNING)
+    server = make_server(host, port, app, threaded=True)
+    threading.Thread(target=server.serve_forever, name="loadtest-server", daemon=True).start()
+    return server, "http://%s:%d" % (host, server.server_port)
+
+
+def percentile(values, fraction):
+    """Nearest-rank percentile of sorted values."""
+    if not values:
+        return None
+    return values[min(len(values) - 1, max(0, int(round(fraction * len(values))) - 1))]
+
+
+def summarize(samples, elapsed):
+    """{requests, errors, error_rate, throughput, p50/p95/p99/max (s), statuses} of (route, seconds, status) samples.
+
+    A status of None is a failed request (exception); it and HTTP statuses >= 400 are errors.
+    """
+    latencies = sorted(seconds for _, seconds, _ in samples)
+    errors = sum(1 for _, _, status in samples if status is None or status >= 400)
+    statuses = {}
+    for _, _, status in samples:
+        key = str(status) if status is not None else "exception"
+        statuses[key] = statuses.get(key, 0) + 1
+    return {
+        "requests": len(samples),
+        "errors": errors,
+        "error_rate": errors / len(samples) if samples else 0.0,
+        "throughput": len(samples) / elapsed if elapsed else 0.0,
+        "p50": percentile(latencies, 0.50),
+        "p95": percentile(latencies, 0.95),
+        "p99": percentile(latencies, 0.99),
+        "max": latencies[-1] if latencies else None,
+        "statuses": statuses,
+    }
+
+
+def run_load(make_client, mix=MIX, concurrency=8, duration=10.0, requests=None, seed=0):
+    """Closed-loop load: `concurrency` workers each send a request as soon as their last one returns.
+
+    Args:
+        make_client (callable): () -> a client with get(route) -> HTTP status; called once per worker.
+        mix (tuple): (route, weight) pairs the routes are drawn from.
+        duration (float): Seconds to run, unless `requests` is given.
+        requests (int or None): Total requests to send instead of running for `duration`.
+        seed (int): Seed of the route choices (each worker draws its own sequence).
+
+    Returns:
+        dict: The summary of all requests, with a summary per route under "routes".
+    """
+    routes = [route for route, _ in mix]
+    weights = [weight for _, weight in mix]
+    samples = []
+    samples_lock = threading.Lock()
+    remaining = [requests]
+    started = time.perf_counter()
+    deadline = None if requests else started + duration
+
+    def worker(index):
+        client = make_client()
+        rng = random.Random("%s:%d" % (seed, index))
+        own = []
+        while True:
+            if deadline is not None:
+                if time.perf_counter() >= deadline:
+                    break
+            else:
+                with samples_lock:
+                    if remaining[0] <= 0:
+                        break
+                    remaining[0] -= 1
+            route = rng.choices(routes, weights)[0]
+            sent = time.perf_counter()
+            try:
+                status = client.get(route)
+            except Exception:
+                status = None
+            own.append((route, time.perf_counter() - sent, status))
+        with samples_lock:
+            samples.extend(own)
+
+    threads = [threading.Thread(target=worker, args=(index,), name="loadtest-%d" % index)
+               for index in range(concurrency)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = time.perf_counter() - started
+
+    summary = summarize(samples, elapsed)
+    summary["concurrency"] = concurrency
+    summary["elapsed_s"] = elapsed
+    summary["routes"] = {route: summarize([sample for sample in samples if sample[0] == route], elapsed)
+                         for route in routes}
+    return summary
+
+
+def sweep(make_client, levels=SWEEP_LEVELS, mix=MIX, duration=10.0, seed=0, gain=SATURATION_GAIN,
+          max_p99=None, max_error_rate=0.01, on_level=None):
+    """Runs run_load at increasing concurrency until the service saturates.
+
+    The saturation point is the last level before throughput grows by less than `gain`,
+    p99 exceeds `max_p99` seconds or the error rate exceeds `max_error_rate`: more
+    concurrent users beyond it only queue up.
+
+    Returns:
+        (results, saturation): the summary of each level run, and the saturation level (None if not reached).
+    """
+    results = []
+    saturation = None
+    for concurrency in levels:
+        result = run_load(make_client, mix, concurrency, duration, seed=seed)
+        results.append(result)
+        if on_level:
+            on_level(result)
+        breached = (result["error_rate"] > max_error_rate
+                    or (max_p99 is not None and result["p99"] is not None and result["p99"] > max_p99))
+        if len(results) > 1:
+            previous = results[-2]
+            if breached or result["throughput"] < previous["throughput"] * (1 + gain):
+                saturation = previous["concurrency"]
+                break
+        elif breached:
+            saturation = concurrency
+            break
+    return results, saturation
+
+
+def _ms(seconds):
+    return "-" if seconds is None else "%.1f" % (seconds * 1000)
+
+
+def format_summary(result):
+    lines = ["concurrency %d: %d requests in %.1fs, %.1f req/s, p50 %sms, p95 %sms, p99 %sms, max %sms, "
+             "%.2f%% errors" % (result["concurrency"], result["requests"], result["elapsed_s"], result["throughput"],
+                                _ms(result["p50"]), _ms(result["p95"]), _ms(result["p99"]), _ms(result["max"]),
+                                100 * result["error_rate"])]
+    width = max(len(route) for route in result["routes"])
+    for route, stats in result["routes"].items():
+        lines.append("  %-*s %7d req %8.1f req/s  p50 %8s  p95 %8s  p99 %8s ms  %5.1f%% errors" % (
+            width, route, stats["requests"], stats["throughput"], _ms(stats["p50"]), _ms(stats["p95"]),
+            _ms(stats["p99"]), 100 * stats["error_rate"]))
+    return lines
+
+
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Load-test the Flask app: throughput, latency percentiles and "
+                                                 "error rate per concurrency level")
+    target = parser.add_mutually_exclusive_group()
+    target.add_argument("--url", help="Base URL of a running server (default: drive the app in-process)")
+    target.add_argument("--serve", action="store_true",
+                        help="Serve the app on a local port (threaded development server) and load it over HTTP")
+    parser.add_argument("--backend", choices=("replay", "stub"), default="replay",
+                        help="In-process / --serve backends: recorded API fixtures (the stub if none "
+                             "were recorded), or a stub geocoder")
+    parser.add_argument("--stub-latency", type=float, default=STUB_LATENCY, help="Seconds per stub geocoder call")
+    parser.add_argument("--no-response-cache", action="store_true", help="Render /map and /reports on every request")
+    parser.add_argument("--mix", nargs="+", metavar="ROUTE@WEIGHT",
+                        # argparse %-formats help texts, and the search route is URL-encoded
+                        help="Routes and weights (default: %s)"
+                             % " ".join("%s@%g" % item for item in MIX).replace("%", "%%"))
+    parser.add_argument("--concurrency", type=int, default=8, help="Concurrent simulated users")
+    parser.add_argument("--duration", type=float, default=10.0, help="Seconds per run (per level when sweeping)")
+    parser.add_argument("--requests", type=int, help="Send this many requests instead of running for --duration")
+    parser.add_argument("--sweep", nargs="*", type=int, metavar="LEVEL",
+                        help="Run increasing concurrency levels (default: %s) and report the saturation point"
+                             % " ".join(map(str, SWEEP_LEVELS)))
+    parser.add_argument("--max-p99", type=float, help="Latency objective for the sweep, in milliseconds")
+    parser.add_argument("--max-error-rate", type=float, default=0.01)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--output", help="Also write the results to this JSON file")
+    args = parser.parse_args()
+
+    try:
+        mix = parse_mix(args.mix) if args.mix else MIX
+    except ValueError as e:
+        parser.error(str(e))
+
+    server = None
+    if args.url:
+        base_url = args.url
+        make_client = lambda: HttpClient(base_url)
+    else:
+        os.chdir(os.path.dirname(os.path.abspath(__file__)))
+        app = load_app(args.backend, args.stub_latency, not args.no_response_cache)
+        if args.serve:
+            server, base_url = serve(app)
+            make_client = lambda: HttpClient(base_url)
+        else:
+            make_client = lambda: InProcessClient(app)
+        # the first requests build the indexes; the steady state is what is measured
+        client = make_client()
+        for route, _ in mix:
+            started = time.perf_counter()
+            status = client.get(route)
+            # routes prepared in the background (statistics, payload) answer 503 until ready
+            while status == 503 and time.perf_counter() - started < WARMUP_TIMEOUT:
+                time.sleep(0.1)
+                status = client.get(route)
+            print(f"warm-up {route}: HTTP {status} in {(time.perf_counter() - started) * 1000:.0f}ms")
+
+    try:
+        if args.sweep is not None:
+            levels = args.sweep or SWEEP_LEVELS
+            max_p99 = args.max_p99 / 1000 if args.max_p99 is not None else None
+            results, saturation = sweep(make_client, levels, mix, args.duration, args.seed,
+                                        max_p99=max_p99, max_error_rate=args.max_error_rate,
+                                        on_level=lambda result: print("\n".join(format_summary(result)), flush=True))
+            if saturation is None:
+                print(f"Not saturated at concurrency {levels[-1]}")
+            else:
+                best = next(result for result in results if result["concurrency"] == saturation)
+                print(f"Saturates at concurrency {saturation}: {best['throughput']:.1f} req/s, "
+                      f"p99 {_ms(best['p99'])}ms")
+            output = {"mix": mix, "levels": results, "saturation": saturation}
+        else:
+            result = run_load(make_client, mix, args.concurrency, args.duration, args.requests, args.seed)
+            print("\n".join(format_summary(result)))
+            output = {"mix": mix, "levels": [result]}
+    finally:
+        if server is not None:
+            server.shutdown()
+
+    if args.output:
+        output.update(target=args.url or ("serve" if args.serve else "in-process"), backend=args.backend)
+        with open(args.output, "w", encoding="utf-8") as f:
+            json.dump(output, f, indent=2)
@@ -1,10 +1,18 @@
 import json
+import logging
 import pandas as pd
 import requests
 import time
 from typing import Dict, Optional
 import os
 
+from gazetteer import lookup_place
+from json_stream import iter_reports, write_reports
+from logs import Progress, configure
+from replay import transport, wrap_session
+
+logger = logging.getLogger(__name__)
+
 class LocationGeocoder:
     def __init__(self, api_key: str, cache_file: str = 'location_cache.csv'):
         """Initialize the geocoder with API key and cache file path."""
@@ -12,12 +20,15 @@ class LocationGeocoder:
         self.cache_file = cache_file
         self.cache = self._load_cache()
         self.base_url = "https://us1.locationiq.com/v1/search"
+        self.session = wrap_session(requests.Session())
+        # cache hits, gazetteer hits and API outcomes, logged every few seconds instead of per location
+        self.progress = Progress(logger, "geocode_progress")
         
     def _load_cache(self) -> Dict[str, Optional[Dict[str, float]]]:
         """Load existing cache from CSV file or create new cache."""
         try:
             if os.path.exists(self.cache_file):
-                print(f"Loading existing cache from {self.cache_file}")
+                logger.info("Loading existing cache from %s", self.cache_file)
                 df = pd.read_csv(self.cache_file)
                 cache = {}
                 
@@ -28,7 +39,6 @@ class LocationGeocoder:
                 for _, row in df.iterrows():
                     if row['status'] == 'failed' or pd.isna(row['latitude']) or pd.isna(row['longitude']):
                         # This was a failed geocoding attempt
-                        print(f"Loading failed attempt for: {row['location']}")
                         cache[row['location']] = None
                     else:
                         cache[row['location']] = {
@@ -38,11 +48,11 @@ class LocationGeocoder:
                 
                 successful = sum(1 for v in cache.values() if v is not None)
                 failed = sum(1 for v in cache.values() if v is None)
-                print(f"Loaded {len(cache)} cached locations ({successful} successful, {failed} failed)")
+                logger.info("Loaded %d cached locations (%d successful, %d failed)", len(cache), successful, failed)
                 return cache
             return {}
         except Exception as e:
-            print(f"Error loading cache: {e}")
+            logger.error("Error loading cache: %s", e)
             return {}
 
     def _save_cache(self):
@@ -50,12 +60,10 @@ class LocationGeocoder:
         try:
             # Convert cache to list of dictionaries including failed attempts
             cache_list = []
-            print(f"Current cache size: {len(self.cache)} entries")
             
             for loc, coords in self.cache.items():
                 if coords is None:
                     # Failed attempt
-                    print(f"Saving failed attempt for: {loc}")
                     cache_list.append({
                         'location': loc,
                         'latitude': None,
@@ -71,19 +79,27 @@ class LocationGeocoder:
                     })
             
             df = pd.DataFrame(cache_list)
-            print(f"Saving cache with {len(df)} entries ({len(df[df['status'] == 'failed'])} failed, {len(df[df['status'] == 'success'])} successful)")
+            logger.debug("Saving cache with %d entries", len(df))
             df.to_csv(self.cache_file, index=False)
         except Exception as e:
-            print(f"Error saving cache: {e}")
+            logger.error("Error saving cache: %s", e)
 
     def geocode_location(self, location: str) -> Optional[Dict[str, float]]:
         """Geocode a single location, using cache if available."""
         if location in self.cache:
             result = self.cache[location]
-            status = "successful" if result is not None else "failed"
-            print(f"Cache hit for location: {location} (previously {status})")
+            if result is not None:
+                self.progress.add(cache_hits=1)
+            else:
+                self.progress.add(cached_failures=1)
             return result
 
+        coords = lookup_place(location)
+        if coords:
+            self.progress.add(gazetteer_hits=1)
+            self.cache[location] = coords
+            return coords
+
         try:
             params = {
                 'key': self.api_key,
@@ -92,7 +108,7 @@ class LocationGeocoder:
                 'accept-language': 'he,en'
             }
             
-            response = requests.get(self.base_url, params=params)
+            response = self.session.get(self.base_url, params=params)
             
             # Hide API key in error message if request fails
             try:
@@ -112,24 +128,26 @@ class LocationGeocoder:
                 }
                 self.cache[location] = coords
                 self._save_cache()
-                print(f"Successfully geocoded: {location}")
+                self.progress.add(geocoded=1)
                 return coords
             
-            print(f"No results found for location: {location}")
+            logger.debug("No results found for location: %s", location)
+            self.progress.add(not_found=1)
             # Cache the failed attempt
-            print(f"Caching failed attempt for location: {location}")
             self.cache[location] = None
             self._save_cache()
             return None
 
         except requests.exceptions.RequestException as e:
-            print(f"API error for location {location}: {e}")
+            logger.warning("API error for location %s: %s", location, e)
+            self.progress.add(errors=1)
             # Cache the failed attempt
         except Exception as e:
             sanitized_error = str(e)
             if self.api_key in sanitized_error:
                 sanitized_error = sanitized_error.replace(self.api_key, "API_KEY_HIDDEN")
-            print(f"Error geocoding location {location}: {sanitized_error}")
+            logger.warning("Error geocoding location %s: %s", location, sanitized_error)
+            self.progress.add(errors=1)
             # Cache the failed attempt
             self.cache[location] = None
             self._save_cache()
@@ -139,51 +157,54 @@ class LocationGeocoder:
             # Respect rate limits
             time.sleep(1)
 
+def geocode_reports(reports, geocoder: LocationGeocoder, stats: Dict[str, int]):
+    """Generator stage: yields each report with missing coordinates added, counting into stats."""
+    for report in reports:
+        if 'geocoded_locations' not in report:
+            report['geocoded_locations'] = {}
+
+        for location in report['locations']:
+            stats['total_locations'] += 1
+            location_name = location['location_name']
+            if location_name not in report['geocoded_locations']:
+                coords = geocoder.geocode_location(location_name)
+                if coords:
+                    report['geocoded_locations'][location_name] = coords
+                    stats['processed_locations'] += 1
+        yield report
+
 def process_json_file(input_file: str, output_file: str, geocoder: LocationGeocoder):
-    """Process JSON file and add coordinates where missing."""
+    """Process JSON file and add coordinates where missing.
+
+    Reports are streamed from input_file through the geocoder into output_file one at a
+    time (input and output may be the same file).
+    """
     try:
-        # Read JSON file
-        with open(input_file, 'r', encoding='utf-8') as f:
-            data = json.load(f)
+        stats = {'total_locations': 0, 'processed_locations': 0}
+        write_reports(output_file, geocode_reports(iter_reports(input_file), geocoder, stats))
+        geocoder.progress.close()
 
-        total_locations = 0
-        processed_locations = 0
-        
-        # Process each report
-        for report in data['reports']:
-            if 'geocoded_locations' not in report:
-                report['geocoded_locations'] = {}
-
-            for location in report['locations']:
-                total_locations += 1
-                location_name = location['location_name']
-                if location_name not in report['geocoded_locations']:
-                    coords = geocoder.geocode_location(location_name)
-                    if coords:
-                        report['geocoded_locations'][location_name] = coords
-                        processed_locations += 1
-
-        # Save updated JSON
-        with open(output_file, 'w', encoding='utf-8') as f:
-            json.dump(data, f, ensure_ascii=False, indent=2)
-            
-        print(f"Successfully processed {processed_locations} out of {total_locations} locations")
-        print(f"Results saved to {output_file}")
+        logger.info("Successfully processed %d out of %d locations", stats['processed_locations'], stats['total_locations'])
+        logger.info("Results saved to %s", output_file)
 
     except Exception as e:
-        print(f"Error processing JSON file: {e}")
+        logger.error("Error processing JSON file: %s", e)
 
 def main():
     """Main function to run the geocoding process."""
     import argparse
     
     parser = argparse.ArgumentParser(description='Geocode locations from a JSON file')
-    parser.add_argument('--api-key', required=True, help='LocationIQ API key')
+    parser.add_argument('--api-key', default=os.getenv('LOCATIONIQ_API_KEY'),
+                        help='LocationIQ API key (default: LOCATIONIQ_API_KEY; not needed with API_REPLAY=replay)')
     parser.add_argument('--input-file', default='tiuli_reports.json', help='Input JSON file')
     parser.add_argument('--output-file', default='tiuli_reports_with_coords.json', help='Output JSON file')
     parser.add_argument('--cache-file', default='location_cache.csv', help='Cache file to use/create')
     
     args = parser.parse_args()
+    if not args.api_key and not transport.replaying:
+        parser.error('--api-key or LOCATIONIQ_API_KEY is required')
+    configure()
     
     geocoder = LocationGeocoder(args.api_key, args.cache_file)
     process_json_file(args.input_file, args.output_file, geocoder)
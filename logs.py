@@ -0,0 +1,185 @@
+import atexit
+import json
+import logging
+import os
+import queue
+import threading
+import time
+from collections import Counter
+from logging.handlers import QueueHandler, QueueListener
+
+# Logging for the ingest loops, which run over thousands of pages, reports and locations:
+#
+#   configure(log_file="processing.log")   handlers run in a background thread
+#   event(logger, logging.DEBUG, "report_parsed", rate=5, title=title, links=len(links))
+#   progress = Progress(logger, "geocode"); progress.add(cache_hits=1); progress.close()
+#
+# An event is formatted only if a handler emits it, and at most `rate` per second are logged
+# per key (the next one logged carries the number suppressed). Per-item messages are better
+# counted with Progress, which logs the running totals every PROGRESS_INTERVAL seconds.
+# LOG_LEVEL sets the level and LOG_FORMAT=json writes one JSON object per record.
+LOG_LEVEL = os.getenv("LOG_LEVEL", "INFO")
+LOG_FORMAT = os.getenv("LOG_FORMAT", "text")
+TEXT_FORMAT = "%(asctime)s - %(levelname)s - %(message)s"
+PROGRESS_INTERVAL = 10.0
+
+
+class Event:
+    def __init__(self, key, fields):
+        """The message of a structured record: a key and fields, rendered as text only when emitted."""
+        self.key = key
+        self.fields = fields
+
+    def __str__(self):
+        return " ".join([self.key] + ["%s=%r" % (name, value) if isinstance(value, str) else "%s=%s" % (name, value)
+                                      for name, value in self.fields.items()])
+
+
+class JsonFormatter(logging.Formatter):
+    def format(self, record):
+        entry = {"time": self.formatTime(record), "level": record.levelname, "logger": record.name}
+        if isinstance(record.msg, Event):
+            entry["event"] = record.msg.key
+            entry.update(record.msg.fields)
+        else:
+            entry["message"] = record.getMessage()
+        if record.exc_info and not record.exc_text:
+            record.exc_text = self.formatException(record.exc_info)
+        if record.exc_text:
+            entry["exception"] = record.exc_text
+        return json.dumps(entry, ensure_ascii=False, default=str)
+
+
+class _QueueHandler(QueueHandler):
+    def prepare(self, record):
+        # QueueHandler formats the record in the logging thread; here only the traceback is
+        # rendered, while its frames are alive, and the message is formatted by the listener.
+        # Logged arguments must therefore not be modified after the call.
+        if record.exc_info:
+            record.exc_text = logging.Formatter().formatException(record.exc_info)
+            record.exc_info = None
+        return record
+
+
+def configure(level=LOG_LEVEL, log_file=None, stream=True, fmt=LOG_FORMAT):
+    """Sets up the root logger to hand records to a queue, written by a background thread.
+
+    Like logging.basicConfig, does nothing if the root logger already has handlers.
+
+    Args:
+        level (int or str): Root logger level.
+        log_file (str or None): Also write the records to this file.
+        stream (bool): Write the records to stderr.
+        fmt (str): "text" or "json".
+
+    Returns:
+        QueueListener or None: The listener writing the records; it is stopped (and the
+        queue flushed) at exit.
+    """
+    root = logging.getLogger()
+    if root.handlers:
+        return None
+    formatter = JsonFormatter() if fmt == "json" else logging.Formatter(TEXT_FORMAT)
+    handlers = []
+    if log_file:
+        handlers.append(logging.FileHandler(log_file, encoding="utf-8"))
+    if stream:
+        handlers.append(logging.StreamHandler())
+    for handler in handlers:
+        handler.setFormatter(formatter)
+    records = queue.SimpleQueue()
+    listener = QueueListener(records, *handlers, respect_handler_level=True)
+    root.addHandler(_QueueHandler(records))
+    root.setLevel(level.upper() if isinstance(level, str) else level)
+    listener.start()
+    atexit.register(listener.stop)
+    return listener
+
+
+class RateSampler:
+    def __init__(self):
+        """Per-key token buckets deciding which of a frequent message's records are logged."""
+        self.buckets = {}
+        self.lock = threading.Lock()
+
+    def allow(self, key, rate):
+        """Returns (allowed, suppressed): whether to log this record, and how many were dropped since the last one."""
+        now = time.monotonic()
+        with self.lock:
+            bucket = self.buckets.get(key)
+            if bucket is None:
+                bucket = self.buckets[key] = [max(1.0, rate), now, 0]
+            tokens, updated, suppressed = bucket
+            tokens = min(max(1.0, rate), tokens + (now - updated) * rate)
+            if tokens < 1:
+                bucket[:] = [tokens, now, suppressed + 1]
+                return False, 0
+            bucket[:] = [tokens - 1, now, 0]
+            return True, suppressed
+
+
+sampler = RateSampler()
+
+
+def event(logger, level, key, rate=None, **fields):
+    """Logs a structured record. Costs one level check when the level is disabled.
+
+    Args:
+        key (str): What happened, e.g. "cache_hit"; also the sampling key.
+        rate (float or None): At most this many records per second for the key.
+        fields: Values of the record; a sampled record gets `suppressed` too.
+
+    Returns:
+        bool: Whether the record was logged.
+    """
+    if not logger.isEnabledFor(level):
+        return False
+    if rate is not None:
+        allowed, suppressed = sampler.allow(key, rate)
+        if not allowed:
+            return False
+        if suppressed:
+            fields["suppressed"] = suppressed
+    logger.log(level, Event(key, fields), stacklevel=2)
+    return True
+
+
+class Progress:
+    def __init__(self, logger, key, interval=PROGRESS_INTERVAL, level=logging.INFO):
+        """Counters of a loop, logged as one aggregated record every `interval` seconds and at close()."""
+        self.logger = logger
+        self.key = key
+        self.interval = interval
+        self.level = level
+        self.counts = Counter()
+        self.started = time.monotonic()
+        self.logged = self.started
+        self.lock = threading.Lock()
+
+    def add(self, **counts):
+        with self.lock:
+            self.counts.update(counts)
+            now = time.monotonic()
+            if now - self.logged < self.interval:
+                return
+            self.logged = now
+            fields = dict(self.counts)
+        self._log(fields, now)
+
+    def _log(self, fields, now, final=False):
+        fields["elapsed_s"] = round(now - self.started, 1)
+        if final:
+            fields["done"] = True
+        event(self.logger, self.level, self.key, **fields)
+
+    def close(self):
+        with self.lock:
+            fields = dict(self.counts)
+        self._log(fields, time.monotonic(), final=True)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.close()
+        return False
@@ -0,0 +1,278 @@
+import csv
+import hashlib
+import json
+import os
+import threading
+import time
+
+REPORTS_FILE = "static/reports.json"
+# The layer of the last served snapshot, loaded at startup instead of geocoding again
+MAP_LAYER_FILE = "static/map_layer.json"
+# Same location,latitude,longitude,status layout as location_cache.csv
+GEOCODE_CACHE_FILE = "geocode_cache.csv"
+SEED_CACHE_FILES = ("location_cache.csv",)
+# Locations the geocoder found nothing for are asked again after this many seconds;
+# failed calls (quota, network, bad key) sooner, and only the answers are saved
+NOT_FOUND_TTL = 30 * 24 * 3600
+ERROR_TTL = 3600
+
+
+class GeocodeError(Exception):
+    """The geocoder failed for a location (as opposed to finding nothing); worth asking again later."""
+
+
+class GeocodeCache:
+    def __init__(self, geocode, cache_file=GEOCODE_CACHE_FILE, seed_files=SEED_CACHE_FILES):
+        """Persistent cache in front of a geocoding function.
+
+        Negative results are cached too, until they expire: (None, None) answers for
+        NOT_FOUND_TTL seconds (from the `checked` time saved with them, or from loading
+        if there is none) and geocoder errors for ERROR_TTL seconds, in memory only.
+        An errored location raises GeocodeError until then.
+
+        Args:
+            geocode (callable): location -> (lat, lon), with (None, None) for no result.
+            cache_file (str): CSV file the cache is loaded from and appended to.
+            seed_files (tuple): Read-only caches in the same format (e.g. location_cache.csv).
+        """
+        self.geocode = geocode
+        self.cache_file = cache_file
+        self.cache = {}
+        # {location: time its negative entry expires}
+        self.expires = {}
+        # {location: (error message, time it expires)}
+        self.errors = {}
+        self.lock = threading.Lock()
+        for path in tuple(seed_files) + (cache_file,):
+            if path and os.path.exists(path):
+                self._load(path)
+
+    def _load(self, path):
+        with open(path, "r", encoding="utf-8", newline="") as f:
+            for row in csv.DictReader(f):
+                if row.get("status", "success") == "success" and row.get("latitude") and row.get("longitude"):
+                    self.cache[row["location"]] = (float(row["latitude"]), float(row["longitude"]))
+                    self.expires.pop(row["location"], None)
+                else:
+                    self.cache[row["location"]] = (None, None)
+                    checked = float(row["checked"]) if row.get("checked") else time.time()
+                    self.expires[row["location"]] = checked + NOT_FOUND_TTL
+
+    def _append(self, location, lat, lon):
+        fieldnames = ["location", "latitude", "longitude", "status", "checked"]
+        if os.path.exists(self.cache_file):
+            # files written before `checked` was saved keep their columns
+            with open(self.cache_file, "r", encoding="utf-8", newline="") as f:
+                fieldnames = next(csv.reader(f), None) or fieldnames
+        new_file = not os.path.exists(self.cache_file)
+        with open(self.cache_file, "a", encoding="utf-8", newline="") as f:
+            writer = csv.DictWriter(f, fieldnames=fieldnames, extrasaction="ignore")
+            if new_file:
+                writer.writeheader()
+            writer.writerow({"location": location, "latitude": lat, "longitude": lon,
+                             "status": "failed" if lat is None else "success", "checked": int(time.time())})
+
+    def _fresh(self, location):
+        return location in self.cache and self.expires.get(location, float("inf")) > time.time()
+
+    def _error(self, location):
+        message, expires = self.errors.get(location, (None, 0))
+        return message if expires > time.time() else None
+
+    def __call__(self, location):
+        """Returns (lat, lon) for a location, calling the geocoder only on a miss or an expired failure.
+
+        Raises GeocodeError if the geocoder failed for the location in the last ERROR_TTL seconds.
+        """
+        if self._fresh(location):
+            return self.cache[location]
+        with self.lock:
+            if not self._fresh(location):
+                message = self._error(location)
+                if message is None:
+                    try:
+                        lat, lon = self.geocode(location)
+                    except Exception as e:
+                        message = f"{type(e).__name__}: {e}"
+                        self.errors[location] = (message, time.time() + ERROR_TTL)
+                if message is not None:
+                    raise GeocodeError(message)
+                self.errors.pop(location, None)
+                self.cache[location] = (lat, lon)
+                if lat is None:
+                    self.expires[location] = time.time() + NOT_FOUND_TTL
+                else:
+                    self.expires.pop(location, None)
+                self._append(location, lat, lon)
+        return self.cache[location]
+
+
+def data_version(reports):
+    """Short content hash of a report list, used to key precomputed layers."""
+    return hashlib.sha1(json.dumps(reports, sort_keys=True, ensure_ascii=False).encode("utf-8")).hexdigest()[:12]
+
+
+def build_map_layer(reports, geocode, version=None):
+    """Resolves every report location once into ready-to-serve map data.
+
+    Parameters:
+    -----------
+    reports: list
+        flowering reports in the flask_app.py format (flowers, maps_query_locations, date, original_report, ...)
+    geocode: callable
+        location -> (lat, lon), (None, None) if not found. Should be cached (see GeocodeCache).
+        Only used for locations missing from the report's geocoded_locations. Locations
+        it raises for are left out and counted in the layer's `errors`.
+    version: str or None
+        the data version of the reports. Computed from their content if None.
+
+    Returns:
+    --------
+    layer: dict
+        - version (str): the data version the layer was built from.
+        - coords (list of [lat, lon]): one point per geocoded report location, for map.html.
+        - flower_ids (str): JSON list of the marker labels (flowers and date), parallel to coords.
+        - descriptions (str): JSON list of the original reports, parallel to coords.
+        - reports (list of dict): one copy of the report per geocoded location, with lat, lon
+          and locations set to that location, for report.html.
+        - errors (int): the number of locations the geocoder failed for; the layer is
+          incomplete if it is not 0.
+    """
+    errors = 0
+    coords = []
+    report_ids = []
+    descriptions = []
+    located_reports = []
+    for creport in reports:
+        geocoded = creport.get('geocoded_locations') or {}
+        for cloc in creport.get('maps_query_locations') or []:
+            if geocoded.get(cloc):
+                lat, lon = geocoded[cloc]['latitude'], geocoded[cloc]['longitude']
+            else:
+                try:
+                    lat, lon = geocode(cloc)
+                except Exception as e:
+                    print('error geocoding %s: %s' % (cloc, e))
+                    errors += 1
+                    continue
+            if lat is None or lon is None:
+                print('location not found: %s' % cloc)
+                continue
+            coords.append([lat, lon])
+            # convert the flowers to a string for the marker
+            cid = ', '.join(creport['flowers'])
+            cid += '\n'+str(creport['date'])
+            report_ids.append(cid)
+            descriptions.append(creport['original_report'])
+            located_reports.append(dict(creport, lat=lat, lon=lon, locations=cloc))
+
+    return {
+        'version': version or data_version(reports),
+        'coords': coords,
+        'flower_ids': json.dumps(report_ids),
+        'descriptions': json.dumps(descriptions),
+        'reports': located_reports,
+        'errors': errors,
+    }
+
+
+class MapLayerCache:
+    def __init__(self, geocode, layer_file=MAP_LAYER_FILE):
+        """Holds the map layer of the current data version in memory.
+
+        The layer is rebuilt (through the geocode cache) only when the version changes,
+        by one build at a time. Requests never wait for it: get() serves the last good
+        layer while the new one is built in a background thread. Built layers are saved
+        to layer_file, so a new process serving the same version just loads it.
+
+        A layer missing points because the geocoder failed is served but not saved, and
+        is rebuilt after ERROR_TTL seconds, when the geocode cache asks again.
+        """
+        self.geocode = geocode
+        self.layer_file = layer_file
+        self.layer = None
+        # when an incomplete layer is rebuilt
+        self.retry_at = 0
+        self.lock = threading.Lock()
+
+    def _load(self, version):
+        """Returns the saved layer if it is of `version`, else None."""
+        if not self.layer_file or not os.path.exists(self.layer_file):
+            return None
+        try:
+            with open(self.layer_file, "r", encoding="utf-8") as f:
+                layer = json.load(f)
+        except (OSError, json.JSONDecodeError) as e:
+            print(f"Ignoring unreadable map layer {self.layer_file}: {e}")
+            return None
+        return layer if layer.get("version") == version and not layer.get("errors") else None
+
+    def _save(self, layer):
+        if not self.layer_file:
+            return
+        tmp_file = self.layer_file + ".tmp"
+        with open(tmp_file, "w", encoding="utf-8") as f:
+            json.dump(layer, f, ensure_ascii=False)
+        os.replace(tmp_file, self.layer_file)
+
+    def _current(self, version):
+        """Whether the layer held is of `version` and, if incomplete, not yet due for a rebuild."""
+        layer = self.layer
+        return layer is not None and layer['version'] == version and (
+            not layer.get('errors') or time.time() < self.retry_at)
+
+    def build(self, reports, version=None, wait=True):
+        """Makes the layer of `version` current, loading the saved one or building it, and returns it.
+
+        Without `wait`, does nothing and returns the current layer if another build is running.
+        """
+        if version is None:
+            version = data_version(reports)
+        if not self.lock.acquire(blocking=wait):
+            return self.layer
+        try:
+            if not self._current(version):
+                layer = self._load(version)
+                if layer is None:
+                    layer = build_map_layer(reports, self.geocode, version)
+                    if layer['errors']:
+                        print(f"Map layer {version} misses {layer['errors']} locations the geocoder failed for; "
+                              f"not saving it, rebuilding in {ERROR_TTL}s")
+                        self.retry_at = time.time() + ERROR_TTL
+                    else:
+                        self._save(layer)
+                self.layer = layer
+            return self.layer
+        finally:
+            self.lock.release()
+
+    def _build_in_background(self, reports, version):
+        try:
+            self.build(reports, version, wait=False)
+        except Exception as e:
+            print(f"Failed to build the map layer {version}: {e}")
+
+    def get(self, reports, version=None):
+        """Returns the layer of `version`, else the last good one (None if there is none yet).
+
+        A missing, stale or incomplete layer is (re)built in a background thread (see build).
+        """
+        if version is None:
+            version = data_version(reports)
+        layer = self.layer
+        if self._current(version):
+            return layer
+        if not self.lock.locked():
+            threading.Thread(target=self._build_in_background, args=(reports, version),
+                             name="map-layer-build", daemon=True).start()
+        return layer
+
+
+if __name__ == "__main__":
+    from ingest import get_lat_lon_from_location
+
+    with open(REPORTS_FILE, "r", encoding="utf-8") as f:
+        reports = json.load(f)
+    # run at deploy time, so the app starts with the layer of its snapshot
+    layer = MapLayerCache(GeocodeCache(get_lat_lon_from_location)).build(reports)
+    print(f"Map layer {layer['version']} has {len(layer['coords'])} points from {len(reports)} reports")
@@ -0,0 +1,174 @@
+import hashlib
+import json
+import os
+import re
+import shutil
+import sys
+from array import array
+
+from report_index import sighting_points
+from static_files import write_with_variants
+
+PAYLOAD_DIR = "static/payload"
+# Sentinels for missing flowers / places / days
+NONE_U16 = 0xFFFF
+NONE_U32 = 0xFFFFFFFF
+NONE_I32 = -0x80000000
+# Names of the version directories of write_payload
+VERSION_RE = re.compile(r"^[0-9a-f]{12}$")
+
+# Column name, array typecode, JavaScript typed array. 4-byte columns come first so
+# every column starts at an offset aligned for its typed array view.
+COLUMNS = (
+    ("lat", "f", "Float32Array"),
+    ("lon", "f", "Float32Array"),
+    ("report", "I", "Uint32Array"),
+    ("place", "I", "Uint32Array"),
+    # signed: reports from before 1970 have negative day numbers
+    ("day", "i", "Int32Array"),
+    ("flower", "H", "Uint16Array"),
+)
+
+
+def _dictionary_id(ids, values, value):
+    if value is None:
+        return None
+    if value not in ids:
+        ids[value] = len(values)
+        values.append(value)
+    return ids[value]
+
+
+def build_payload(reports):
+    """Encodes the geocoded sightings of reports as a compact columnar payload.
+
+    Parameters:
+    -----------
+    reports: list
+        reports as returned by report_store.query_reports
+
+    Returns:
+    --------
+    meta: dict
+        version, count, the flower dictionary, the byte offset and type of every
+        column, and the names of the place and report text files
+    points: bytes
+        the little-endian columns, one value per sighting: float32 lat/lon, uint32
+        report and place IDs, int32 day number (days since 1970-01-01) and uint16
+        flower ID; missing values are 0xFFFFFFFF (place), -2**31 (day) and 0xFFFF (flower)
+    places: bytes
+        JSON list of {id, name} per place ID, fetched when a place name is shown
+    texts: bytes
+        JSON {report id: {date, source, observer, title, text}}, fetched only when a
+        report is opened
+    """
+    columns = {name: array(typecode) for name, typecode, _ in COLUMNS}
+    flower_ids, flowers = {}, []
+    place_ids, places = {}, []
+    # points at the same place are adjacent: their repeated coordinates compress to almost nothing
+    sightings = sorted(sighting_points(reports), key=lambda p: (p["place_id"] or "", p["day"] or 0, p["report_id"]))
+    for point in sightings:
+        columns["lat"].append(point["latitude"])
+        columns["lon"].append(point["longitude"])
+        columns["report"].append(point["report_id"])
+        place = _dictionary_id(place_ids, places, point["place_id"])
+        columns["place"].append(NONE_U32 if place is None else place)
+        columns["day"].append(NONE_I32 if point["day"] is None else point["day"])
+        flower = _dictionary_id(flower_ids, flowers, point["flower"] or None)
+        columns["flower"].append(NONE_U16 if flower is None else flower)
+    if len(flowers) >= NONE_U16:
+        raise ValueError("too many flowers for a uint16 dictionary: %d" % len(flowers))
+
+    place_names = {}
+    for report in reports:
+        for sighting in report["sightings"]:
+            if sighting["place_id"] in place_ids:
+                place_names.setdefault(sighting["place_id"], sighting["location_name"])
+
+    points = bytearray()
+    layout = []
+    for name, typecode, typed_array in COLUMNS:
+        column = columns[name]
+        if sys.byteorder == "big":
+            column.byteswap()
+        layout.append({"name": name, "type": typed_array, "offset": len(points)})
+        points += column.tobytes()
+    points = bytes(points)
+
+    places = json.dumps([{"id": place, "name": place_names.get(place)} for place in places],
+                        ensure_ascii=False, separators=(",", ":")).encode("utf-8")
+    texts = json.dumps({report["id"]: {key: report[key] for key in ("date", "source", "observer", "title", "text")}
+                        for report in reports}, ensure_ascii=False, separators=(",", ":")).encode("utf-8")
+    version = hashlib.sha1(points + places + texts).hexdigest()[:12]
+    meta = {
+        "version": version,
+        "count": len(columns["lat"]),
+        "day_epoch": "1970-01-01",
+        "flowers": flowers,
+        "columns": layout,
+        "missing": {"place": NONE_U32, "day": NONE_I32, "flower": NONE_U16},
+        "points": version + "/points.bin",
+        "places": version + "/places.json",
+        "texts": version + "/texts.json",
+    }
+    return meta, points, places, texts
+
+
+def _read_version(meta_path):
+    try:
+        with open(meta_path, "r", encoding="utf-8") as f:
+            return json.load(f).get("version")
+    except (OSError, ValueError):
+        return None
+
+
+def write_payload(reports, payload_dir=PAYLOAD_DIR):
+    """Writes the payload into payload_dir/<version>/ and then points payload_dir/meta.json at it. Returns the meta.
+
+    The files of a version never change once its directory exists (it is renamed into
+    place complete), and meta.json names them by version, so a client reading a
+    meta.json always fetches the columns it describes. The previous version is kept for
+    clients that read the previous meta.json; older versions are removed.
+    """
+    meta, points, places, texts = build_payload(reports)
+    version_dir = os.path.join(payload_dir, meta["version"])
+    if not os.path.isdir(version_dir):
+        tmp_dir = version_dir + ".tmp"
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+        os.makedirs(tmp_dir)
+        write_with_variants(os.path.join(tmp_dir, "points.bin"), points)
+        write_with_variants(os.path.join(tmp_dir, "places.json"), places)
+        write_with_variants(os.path.join(tmp_dir, "texts.json"), texts)
+        os.rename(tmp_dir, version_dir)
+
+    meta_path = os.path.join(payload_dir, "meta.json")
+    keep = {meta["version"], _read_version(meta_path)}
+    write_with_variants(meta_path, json.dumps(meta, ensure_ascii=False, separators=(",", ":")).encode("utf-8"))
+    for name in os.listdir(payload_dir):
+        path = os.path.join(payload_dir, name)
+        if name not in keep and os.path.isdir(path) and VERSION_RE.match(name.removesuffix(".tmp")):
+            shutil.rmtree(path, ignore_errors=True)
+        elif os.path.isfile(path) and name.split(".")[0] in ("points", "places", "texts"):
+            # unversioned files of payloads written before the version directories
+            os.remove(path)
+    return meta
+
+
+if __name__ == "__main__":
+    import argparse
+
+    import report_store
+
+    parser = argparse.ArgumentParser(description="Build the compact map payload from the report store")
+    parser.add_argument("--store-file", default=report_store.STORE_FILE)
+    parser.add_argument("--payload-dir", default=PAYLOAD_DIR)
+    args = parser.parse_args()
+
+    conn = report_store.connect(args.store_file)
+    meta = write_payload(report_store.query_reports(conn), args.payload_dir)
+    conn.close()
+    for name in ("meta.json", meta["points"], meta["places"], meta["texts"]):
+        sizes = ["%s %d" % (suffix or "raw", os.path.getsize(os.path.join(args.payload_dir, name + suffix)))
+                 for suffix in ("", ".gz", ".br") if os.path.exists(os.path.join(args.payload_dir, name + suffix))]
+        print(f"{name}: {', '.join(sizes)} bytes")
+    print(f"Wrote payload {meta['version']} with {meta['count']} points to {args.payload_dir}")
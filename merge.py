@@ -1,64 +1,226 @@
+import hashlib
 import json
 import os
+from concurrent.futures import ProcessPoolExecutor
 
-def merge_json_files(folder_path, output_file):
+from instrument import add_profile_argument, count, profiling, span
+
+MANIFEST_FILE = "merge_manifest.json"
+OUTPUT_HEADER = '{\n  "reports": [\n'
+OUTPUT_FOOTER = '  ]\n}'
+
+
+def load_reports(folder_path, filename):
+    """
+    Loads the reports of one LLM output file.
+    Removes first and last line (the ```json fence) and adds the original filename to each report.
+
+    Args:
+        folder_path (str): The path to the folder containing JSON files.
+        filename (str): The name of the file to load.
+
+    Returns:
+        list: The reports of the file (empty if the file has none or is invalid).
+    """
+    file_path = os.path.join(folder_path, filename)
+    try:
+        with open(file_path, 'r', encoding='utf-8') as f:
+            lines = f.readlines()
+        if len(lines) > 2:  # Ensure there are at least 3 lines to remove first and last
+            lines = lines[1:-1]  # Remove first and last line
+            file_content = "".join(lines)
+        elif len(lines) == 2:
+            file_content=""
+        elif len(lines) == 1:
+             file_content =""
+        else:
+          print(f"Warning: File {filename} is empty.")
+          return []
+
+        if not file_content.strip():  # Check if file is empty after removing lines
+            print(f"Warning: File {filename} is empty after removing first and last lines.")
+            return []
+
+        data = json.loads(file_content)
+        if 'reports' in data:
+            for report in data['reports']:
+                report['source_file'] = f"wildflowers/{filename}" # i change it after it manually to the actual link
+            return data['reports']
+        else:
+            print(f"Warning: No 'reports' key found in file: {filename}")
+
+    except json.JSONDecodeError as e:
+        print(f"Error decoding JSON in file: {filename}: {e}")
+    except Exception as e:
+        print(f"Error processing file: {filename}: {e}")
+    return []
+
+
+def file_digest(file_path):
+    with open(file_path, 'rb') as f:
+        return hashlib.sha256(f.read()).hexdigest()
+
+
+@span("render_file")
+def render_file(folder_path, filename):
+    """
+    Decodes one input file and renders its reports exactly as they appear in the merged output.
+
+    Returns:
+        dict: manifest entry with the file's size, mtime and content hash, its report IDs
+        ("<filename>#<index>") and the rendered `chunk` text.
+    """
+    file_path = os.path.join(folder_path, filename)
+    stat = os.stat(file_path)
+    reports = load_reports(folder_path, filename)
+    return {
+        'size': stat.st_size,
+        'mtime': stat.st_mtime,
+        'sha256': file_digest(file_path),
+        'report_ids': [f"{filename}#{i}" for i in range(len(reports))],
+        'chunk': ',\n'.join(json.dumps(report, indent=2, ensure_ascii=False) for report in reports),
+    }
+
+
+def _render_files(folder_path, filenames, workers):
+    """Yields (filename, rendered entry) in order, decoding in parallel processes when there are several files."""
+    if workers == 1 or len(filenames) < 2:
+        for filename in filenames:
+            yield filename, render_file(folder_path, filename)
+        return
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        yield from zip(filenames, executor.map(render_file, [folder_path] * len(filenames), filenames, chunksize=16))
+
+
+def _load_manifest(manifest_file, output_file):
+    """Returns the previous manifest, or None if it is missing or does not describe output_file."""
+    if not os.path.exists(manifest_file) or not os.path.exists(output_file):
+        return None
+    try:
+        with open(manifest_file, 'r', encoding='utf-8') as f:
+            manifest = json.load(f)
+    except (OSError, json.JSONDecodeError) as e:
+        print(f"Warning: Ignoring unreadable manifest {manifest_file}: {e}")
+        return None
+    if manifest.get('output_size') != os.path.getsize(output_file) or manifest.get('output_sha256') != file_digest(output_file):
+        print(f"Warning: {output_file} changed since the last merge, doing a full rebuild")
+        return None
+    return manifest
+
+
+@span("merge_json_files")
+def merge_json_files(folder_path, output_file, incremental=False, manifest_file=MANIFEST_FILE, workers=None):
     """
     Merges all JSON files in a folder into a single JSON file.
     Adds the original filename to each report.
     Removes first and last line from each file and adds commas between reports.
 
+    Files are merged in filename order. A manifest of every input file's size, mtime,
+    content hash, contributed report IDs and byte range in the output is written next
+    to it. In incremental mode only new or changed files are decoded; the reports of
+    unchanged files are copied from the previous output by byte range, so the result is
+    byte-identical to a full rebuild.
+
     Args:
         folder_path (str): The path to the folder containing JSON files.
         output_file (str): The path to the output JSON file.
+        incremental (bool): Reuse the previous output for unchanged input files.
+        manifest_file (str): The path to the merge manifest.
+        workers (int or None): Processes used to decode files (None: one per CPU).
+
+    Returns:
+        dict: counts of 'decoded' and 'reused' files and merged 'reports'.
     """
-    all_reports = []
-    for filename in os.listdir(folder_path):
-        if filename.endswith(".json"):
-            file_path = os.path.join(folder_path, filename)
-            try:
-                with open(file_path, 'r', encoding='utf-8') as f:
-                    lines = f.readlines()
-                if len(lines) > 2:  # Ensure there are at least 3 lines to remove first and last
-                    lines = lines[1:-1]  # Remove first and last line
-                    file_content = "".join(lines)
-                elif len(lines) == 2:
-                    file_content=""
-                elif len(lines) == 1:
-                     file_content =""
-                else:
-                  print(f"Warning: File {filename} is empty.")
-                  continue
+    with span("scan"):
+        filenames = sorted(filename for filename in os.listdir(folder_path) if filename.endswith(".json"))
+        previous = _load_manifest(manifest_file, output_file) if incremental else None
+        previous_files = previous['files'] if previous else {}
 
-                if not file_content.strip():  # Check if file is empty after removing lines
-                    print(f"Warning: File {filename} is empty after removing first and last lines.")
+        entries = {}
+        changed = []
+        for filename in filenames:
+            old = previous_files.get(filename)
+            if old is not None:
+                stat = os.stat(os.path.join(folder_path, filename))
+                if (old['size'], old['mtime']) == (stat.st_size, stat.st_mtime):
+                    entries[filename] = old
                     continue
+                if old['size'] == stat.st_size and old['sha256'] == file_digest(os.path.join(folder_path, filename)):
+                    entries[filename] = dict(old, mtime=stat.st_mtime)
+                    continue
+            changed.append(filename)
+    count("decoded", len(changed))
+    count("reused", len(filenames) - len(changed))
+    # Rendered chunks are consumed as they are written, so only a few are held in memory at a time
+    rendered = _render_files(folder_path, changed, workers)
 
-                data = json.loads(file_content)
-                if 'reports' in data:
-                    for report in data['reports']:
-                        report['source_file'] = f"wildflowers/{filename}" # i change it after it manually to the actual link
-                        all_reports.append(report)
+    tmp_file = output_file + ".tmp"
+    old_output = open(output_file, 'rb') if previous else None
+    try:
+        # includes decoding, which happens as the files are written
+        with span("write"), open(tmp_file, 'wb') as outfile:
+            outfile.write(OUTPUT_HEADER.encode('utf-8'))
+            offset = len(OUTPUT_HEADER.encode('utf-8'))
+            first = True
+            for filename in filenames:
+                if filename not in entries:
+                    entries[filename] = next(rendered)[1]
+                entry = entries[filename]
+                if not entry['report_ids']:
+                    entry['start'] = entry['end'] = offset
+                    entry.pop('chunk', None)
+                    continue
+                if not first:
+                    outfile.write(b',\n')
+                    offset += 2
+                first = False
+                if 'chunk' in entry:
+                    data = entry.pop('chunk').encode('utf-8')
                 else:
-                    print(f"Warning: No 'reports' key found in file: {filename}")
+                    old_output.seek(entry['start'])
+                    data = old_output.read(entry['end'] - entry['start'])
+                outfile.write(data)
+                entry['start'], entry['end'] = offset, offset + len(data)
+                offset += len(data)
+            if not first:
+                outfile.write(b'\n')
+            outfile.write(OUTPUT_FOOTER.encode('utf-8'))
+    finally:
+        rendered.close()
+        if old_output is not None:
+            old_output.close()
+    os.replace(tmp_file, output_file)
 
-            except json.JSONDecodeError as e:
-                print(f"Error decoding JSON in file: {filename}: {e}")
-            except Exception as e:
-                print(f"Error processing file: {filename}: {e}")
+    with span("manifest"):
+        manifest = {
+            'output_size': os.path.getsize(output_file),
+            'output_sha256': file_digest(output_file),
+            'files': {filename: entries[filename] for filename in filenames},
+        }
+        with open(manifest_file, 'w', encoding='utf-8') as f:
+            json.dump(manifest, f, ensure_ascii=False)
 
-    with open(output_file, 'w', encoding='utf-8') as outfile:
-        outfile.write('{\n  "reports": [\n')
-        for i, report in enumerate(all_reports):
-            json.dump(report, outfile, indent=2, ensure_ascii=False)
-            if i < len(all_reports) - 1:
-                outfile.write(',\n')
-            else:
-                outfile.write('\n')
-        outfile.write('  ]\n}')
+    return {
+        'decoded': len(changed),
+        'reused': len(filenames) - len(changed),
+        'reports': sum(len(entry['report_ids']) for entry in entries.values()),
+    }
 
 
 if __name__ == "__main__":
-    folder_path = "output"  # Replace with the path to your folder
-    output_file = "merged_reports.json"  # Replace with your desired output file path
-    merge_json_files(folder_path, output_file)
-    print(f"Merged JSON files into {output_file}")
\ No newline at end of file
+    import argparse
+
+    parser = argparse.ArgumentParser(description='Merge the LLM output files into a single JSON file')
+    parser.add_argument('--folder-path', default='output', help='Folder with the LLM output JSON files')
+    parser.add_argument('--output-file', default='merged_reports.json', help='Merged output file')
+    parser.add_argument('--manifest-file', default=MANIFEST_FILE, help='Manifest of the previous merge')
+    parser.add_argument('--incremental', action='store_true', help='Only decode files changed since the last merge')
+    parser.add_argument('--workers', type=int, default=None, help='Decoding processes (default: one per CPU)')
+    add_profile_argument(parser)
+    args = parser.parse_args()
+
+    with profiling('merge', args.profile):
+        stats = merge_json_files(args.folder_path, args.output_file, incremental=args.incremental,
+                                 manifest_file=args.manifest_file, workers=args.workers)
+    print(f"Merged JSON files into {args.output_file} "
+          f"({stats['reports']} reports, {stats['decoded']} files decoded, {stats['reused']} reused)")
@@ -8,6 +8,8 @@ from google.generativeai.types import GenerateContentResponse
 import ast
 from requests.exceptions import ReadTimeout
 
+from replay import wrap_model
+
 # Define a file to load the API KEY
 API_KEY_FILE = "GEMINI_API_KEY"
 
@@ -26,7 +28,7 @@ def process_messages(text, api_key, prompt_path):
     print("process_messages function")
     genai.configure(api_key=api_key)
     # Use the gemini-pro model
-    model = genai.GenerativeModel('gemini-2.0-flash-exp')
+    model = wrap_model(genai.GenerativeModel('gemini-2.0-flash-exp'))
     processed_messages = []
 
     # Read the prompt from the specified file
@@ -0,0 +1,275 @@
+import glob
+import hashlib
+import json
+import os
+import subprocess
+import sys
+import threading
+import time
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+
+ROOT = os.path.dirname(os.path.abspath(__file__))
+STATE_FILE = ".pipeline_state.json"
+
+
+class Stage:
+    def __init__(self, name, command, inputs, outputs, env=(), optional=(), max_age=None):
+        """One step of the data pipeline.
+
+        Args:
+            name (str): Stage name, used on the command line and in the summary.
+            command (list): Arguments run with the current interpreter, e.g. ["merge.py"].
+            inputs (list): Files or glob patterns the stage reads. The script itself
+                should be listed, so editing it reruns the stage.
+            outputs (list): Files or glob patterns the stage writes. A stage reading
+                another stage's output runs after it.
+            env (tuple): Environment variables the stage needs; it is not run without them.
+                They reach the stage through its environment, never its command line.
+            optional (tuple): Inputs used if present: they are part of the key and order
+                the stages, but a stage is neither blocked by their absence nor by the
+                failure of the stage writing them.
+            max_age (float or None): Seconds after which the stage reruns even if its
+                inputs did not change, for stages reading from outside the repository.
+        """
+        self.name = name
+        self.command = command
+        self.inputs = inputs
+        self.outputs = outputs
+        self.env = env
+        self.optional = optional
+        self.max_age = max_age
+
+    def argv(self):
+        return [sys.executable] + list(self.command)
+
+
+STAGES = (
+    # the forum is the scrape's real input, so it is refetched daily
+    Stage("scrape", ["data/scrape.py"], ["data/scrape.py"], ["data/page_*.html"], max_age=24 * 3600),
+    Stage("extract", ["processor.py"], ["processor.py", "prompt.txt", "data/page_*.html"], ["output/page_*.json"]),
+    # merge.py writes a file of its own, so its incremental manifest still matches it after geocoding
+    Stage("merge", ["merge.py", "--incremental", "--output-file", "merged_reports_raw.json"],
+          ["merge.py", "output/page_*.json"], ["merged_reports_raw.json"]),
+    Stage("geocode", ["geocoder.py", "--input-file", "merged_reports_raw.json", "--output-file", "merged_reports.json"],
+          ["geocoder.py", "gazetteer.csv", "merged_reports_raw.json"], ["merged_reports.json"]),
+    Stage("tiuli_parse", ["tiuli_parse.py"], ["tiuli_parse.py", "tiuli_scraped_reports/*.html"], ["tiuli_reports.json"]),
+    # the offline place index the geocoding stages consult before any API
+    Stage("gazetteer", ["gazetteer.py", "build"], ["gazetteer.py", "tiuli_reports.json", "location_cache.csv"],
+          ["gazetteer.csv"]),
+    # locationiq_geocode.py reads the key from LOCATIONIQ_API_KEY
+    Stage("tiuli_geocode", ["locationiq_geocode.py"],
+          ["locationiq_geocode.py", "gazetteer.csv", "tiuli_reports.json"], ["tiuli_reports_with_coords.json"],
+          env=("LOCATIONIQ_API_KEY",)),
+    # the site shows the geocoded tiuli reports when tiuli_geocode could run, the parsed ones otherwise
+    Stage("site", ["generate_data.py"], ["generate_data.py", "merged_reports.json", "tiuli_reports.json"],
+          ["site_data/manifest.json"], optional=("tiuli_reports_with_coords.json",)),
+    Stage("compact", ["jsonl_store.py", "compact"], ["jsonl_store.py", "wildflowers_data.jsonl"],
+          ["wildflowers_data.json"]),
+)
+
+
+def expand(patterns):
+    """Sorted paths (relative to ROOT) matching the patterns."""
+    paths = set()
+    for pattern in patterns:
+        paths.update(os.path.relpath(path, ROOT) for path in glob.glob(os.path.join(ROOT, pattern)))
+    return sorted(paths)
+
+
+def dependencies(stages, required=False):
+    """{stage name: names of the other stages writing one of its inputs (only required ones if `required`)}"""
+    return {stage.name: {other.name for other in stages
+                         if other is not stage
+                         and set(stage.inputs if required else stage.inputs + list(stage.optional)) & set(other.outputs)}
+            for stage in stages}
+
+
+class Pipeline:
+    def __init__(self, stages=STAGES, state_file=STATE_FILE):
+        """Runs the stages in dependency order, skipping those whose inputs did not change, make-style.
+
+        A stage's key is a hash of its command and of the content of its inputs. It is
+        recorded after a successful run; the next run skips the stage while the key is
+        the same and its outputs exist. File hashes are cached by (size, mtime), so
+        unchanged inputs are not reread. Independent stages run concurrently.
+        """
+        self.stages = {stage.name: stage for stage in stages}
+        self.deps = dependencies(stages)
+        self.required_deps = dependencies(stages, required=True)
+        self.state_path = os.path.join(ROOT, state_file)
+        self.state = self._load_state()
+        self.state_lock = threading.Lock()
+        self.print_lock = threading.Lock()
+
+    def _load_state(self):
+        try:
+            with open(self.state_path, "r", encoding="utf-8") as f:
+                state = json.load(f)
+        except (OSError, json.JSONDecodeError):
+            state = {}
+        state.setdefault("files", {})
+        state.setdefault("stages", {})
+        return state
+
+    def _save_state(self):
+        with self.state_lock:
+            tmp_path = self.state_path + ".tmp"
+            with open(tmp_path, "w", encoding="utf-8") as f:
+                json.dump(self.state, f, indent=1, sort_keys=True)
+            os.replace(tmp_path, self.state_path)
+
+    def file_hash(self, path):
+        stat = os.stat(os.path.join(ROOT, path))
+        with self.state_lock:
+            cached = self.state["files"].get(path)
+        if cached and cached[0] == stat.st_size and cached[1] == stat.st_mtime_ns:
+            return cached[2]
+        digest = hashlib.sha256()
+        with open(os.path.join(ROOT, path), "rb") as f:
+            for block in iter(lambda: f.read(1 << 20), b""):
+                digest.update(block)
+        with self.state_lock:
+            self.state["files"][path] = [stat.st_size, stat.st_mtime_ns, digest.hexdigest()]
+        return digest.hexdigest()
+
+    def stage_key(self, stage):
+        digest = hashlib.sha256(json.dumps(stage.command).encode("utf-8"))
+        for path in expand(stage.inputs + list(stage.optional)):
+            digest.update(("%s\0%s\0" % (path, self.file_hash(path))).encode("utf-8"))
+        return digest.hexdigest()
+
+    def upstream(self, targets):
+        """The targets and every stage they depend on, in definition order."""
+        selected, pending = set(), list(targets)
+        while pending:
+            name = pending.pop()
+            if name not in selected:
+                selected.add(name)
+                pending.extend(self.deps[name])
+        return [name for name in self.stages if name in selected]
+
+    def log(self, name, line):
+        with self.print_lock:
+            print("[%s] %s" % (name, line), flush=True)
+
+    def run_stage(self, stage, force=False, dry_run=False):
+        """Returns (status, seconds), status being cached, ran, would run, failed or blocked (...)."""
+        started = time.perf_counter()
+        missing = [var for var in stage.env if not os.getenv(var)]
+        if missing:
+            return "blocked (%s not set)" % ", ".join(missing), 0.0
+        if dry_run and force:
+            return "would run", 0.0
+        inputs = expand(stage.inputs)
+        absent = [pattern for pattern in stage.inputs if not expand([pattern])]
+        if absent:
+            return "blocked (no %s)" % ", ".join(absent), 0.0
+        key = self.stage_key(stage)
+        outputs_exist = all(expand([pattern]) for pattern in stage.outputs)
+        previous = self.state["stages"].get(stage.name, {})
+        expired = stage.max_age is not None and time.time() - previous.get("finished", 0) > stage.max_age
+        if not force and not expired and outputs_exist and previous.get("key") == key:
+            return "cached", time.perf_counter() - started
+        if dry_run:
+            return "would run", time.perf_counter() - started
+
+        self.log(stage.name, "running %s (%d input files)" % (" ".join(stage.command[:1]), len(inputs)))
+        process = subprocess.Popen(stage.argv(), cwd=ROOT, stdout=subprocess.PIPE, stderr=subprocess.STDOUT,
+                                   text=True, encoding="utf-8", errors="replace")
+        for line in process.stdout:
+            self.log(stage.name, line.rstrip())
+        if process.wait() != 0:
+            return "failed (exit %d)" % process.returncode, time.perf_counter() - started
+        # keyed on the inputs as left by the stage, so a stage rewriting its input does not rerun next time
+        key = self.stage_key(stage)
+        with self.state_lock:
+            self.state["stages"][stage.name] = {"key": key, "finished": time.time()}
+        self._save_state()
+        return "ran", time.perf_counter() - started
+
+    def run(self, targets=None, only=False, force=(), dry_run=False, workers=4):
+        """Runs the target stages (all by default) and, unless `only`, the stages they depend on.
+
+        Args:
+            targets (list or None): Stage names.
+            only (bool): Run just the targets, taking the files of their upstream stages as they are.
+            force (collection): Stages to run even if cached; "all" forces every stage.
+            dry_run (bool): Report what would run without running anything.
+            workers (int): Stages run at the same time.
+
+        Returns:
+            list: (name, status, seconds) per selected stage, in definition order.
+        """
+        targets = list(targets or self.stages)
+        unknown = [name for name in targets if name not in self.stages]
+        if unknown:
+            raise ValueError("unknown stages: %s (known: %s)" % (", ".join(unknown), ", ".join(self.stages)))
+        selected = [name for name in self.stages if name in targets] if only else self.upstream(targets)
+        deps = {name: self.deps[name] & set(selected) for name in selected}
+        results = {}
+        # a stage that reran (or would) makes its dependants stale even if their input files look the same yet
+        changed = set()
+
+        with ThreadPoolExecutor(max_workers=workers) as pool:
+            running = {}
+            while len(results) < len(selected):
+                for name in selected:
+                    if name in results or name in running.values() or not deps[name] <= set(results):
+                        continue
+                    failed = [dep for dep in deps[name] & self.required_deps[name]
+                              if results[dep][0] not in ("cached", "ran", "would run")]
+                    if failed:
+                        results[name] = ("blocked (%s)" % ", ".join(sorted(failed)), 0.0)
+                        continue
+                    forced = "all" in force or name in force or (dry_run and deps[name] & changed)
+                    running[pool.submit(self.run_stage, self.stages[name], forced, dry_run)] = name
+                if not running:
+                    continue
+                done, _ = wait(running, return_when=FIRST_COMPLETED)
+                for future in done:
+                    name = running.pop(future)
+                    try:
+                        results[name] = future.result()
+                    except Exception as e:
+                        results[name] = ("failed (%s)" % e, 0.0)
+                    if results[name][0] in ("ran", "would run"):
+                        changed.add(name)
+        self._save_state()
+        return [(name,) + results[name] for name in selected]
+
+
+def print_summary(results, elapsed):
+    width = max(len(name) for name, _, _ in results)
+    print("\n%-*s  %-9s  %s" % (width, "stage", "time", "status"))
+    for name, status, seconds in results:
+        print("%-*s  %8.2fs  %s" % (width, name, seconds, status))
+    cached = sum(1 for _, status, _ in results if status == "cached")
+    ran = sum(1 for _, status, _ in results if status == "ran")
+    print("%d stages: %d ran, %d cached, %d not run; %.2fs total" % (
+        len(results), ran, cached, len(results) - ran - cached, elapsed))
+
+
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser(
+        description="Run the data pipeline (scrape -> extract -> merge -> geocode, tiuli, site data), "
+                    "skipping stages whose inputs did not change")
+    parser.add_argument("stages", nargs="*", help="Stages to bring up to date, with their upstream stages "
+                        "(default: all of %s)" % ", ".join(stage.name for stage in STAGES))
+    parser.add_argument("--only", action="store_true", help="Run only the named stages, not their upstream stages")
+    parser.add_argument("--force", nargs="+", default=[], metavar="STAGE",
+                        help='Run these stages even if their inputs are unchanged ("all" for every stage)')
+    parser.add_argument("--dry-run", action="store_true", help="Show which stages would run")
+    parser.add_argument("--workers", type=int, default=4, help="Stages run concurrently")
+    parser.add_argument("--state-file", default=STATE_FILE)
+    args = parser.parse_args()
+
+    started = time.perf_counter()
+    try:
+        results = Pipeline(state_file=args.state_file).run(args.stages, args.only, set(args.force),
+                                                           args.dry_run, args.workers)
+    except ValueError as e:
+        parser.error(str(e))
+    print_summary(results, time.perf_counter() - started)
+    sys.exit(1 if any(status.startswith("failed") for _, status, _ in results) else 0)
@@ -0,0 +1,269 @@
+import hashlib
+import json
+import math
+import os
+
+from gazetteer import normalize_name, trigrams
+
+# Report sources that carry geocoded locations
+MERGED_REPORTS_FILE = "merged_reports.json"
+TIULI_REPORTS_FILE = "tiuli_reports.json"
+WILDFLOWERS_DATA_FILE = "wildflowers_data.json"
+PLACES_FILE = "places.json"
+CONSOLIDATED_REPORTS_FILE = "consolidated_reports.json"
+
+# Two aliases are the same place if they are this close and their names are this similar
+DEFAULT_RADIUS_KM = 0.5
+DEFAULT_NAME_SIMILARITY = 0.6
+# A name contained in another counts as the same place only if it has this many words;
+# a single word ("נחל", "ירושלים") is too generic to identify a spot on its own
+MIN_SUBSET_WORDS = 2
+
+EARTH_RADIUS_KM = 6371.0088
+KM_PER_DEGREE_LAT = 111.32
+
+
+def haversine_km(lat1, lon1, lat2, lon2):
+    """Great-circle distance between two points, in kilometres."""
+    lat1, lon1, lat2, lon2 = map(math.radians, (lat1, lon1, lat2, lon2))
+    a = math.sin((lat2 - lat1) / 2) ** 2 + math.cos(lat1) * math.cos(lat2) * math.sin((lon2 - lon1) / 2) ** 2
+    return 2 * EARTH_RADIUS_KM * math.asin(math.sqrt(a))
+
+
+def name_similarity(name1, name2):
+    """Similarity (0-1) of two place names.
+
+    Trigram Dice similarity of the normalized names, or 1.0 when every word of the
+    shorter name, if it has at least MIN_SUBSET_WORDS words, appears in the longer one
+    ("עמק הארזים" / "עמק הארזים, ירושלים"). A shorter generic name contained in the
+    longer one ("נחל" / "נחל עמוד") scores at most the share of the longer name's words
+    it covers, as its trigrams alone would make it look alike.
+    """
+    key1, key2 = normalize_name(name1), normalize_name(name2)
+    if not key1 or not key2:
+        return 0.0
+    if key1 == key2:
+        return 1.0
+    words1, words2 = set(key1.split()), set(key2.split())
+    subset = words1 <= words2 or words2 <= words1
+    if subset and min(len(words1), len(words2)) >= MIN_SUBSET_WORDS:
+        return 1.0
+    grams1, grams2 = trigrams(key1), trigrams(key2)
+    similarity = 2.0 * len(grams1 & grams2) / (len(grams1) + len(grams2))
+    if subset:
+        similarity = min(similarity, min(len(words1), len(words2)) / max(len(words1), len(words2)))
+    return similarity
+
+
+def place_id(name, latitude, longitude):
+    """Stable short ID of a place, derived from its canonical name and rounded coordinates."""
+    key = f"{normalize_name(name)}|{latitude:.3f}|{longitude:.3f}"
+    return "p" + hashlib.sha1(key.encode("utf-8")).hexdigest()[:10]
+
+
+def iter_geocoded_names(reports):
+    """Yields (location_name, latitude, longitude) for every geocoded location of a report list.
+
+    Handles both the merged/tiuli shape (`geocoded_locations` map) and the grok.py
+    shape (parallel `locations` / `coordinates` lists with lat/lon keys).
+    """
+    for report in reports:
+        for name, coords in (report.get("geocoded_locations") or {}).items():
+            if coords and coords.get("latitude") is not None and coords.get("longitude") is not None:
+                yield name, float(coords["latitude"]), float(coords["longitude"])
+        if isinstance(report.get("coordinates"), list):
+            for name, coords in zip(report.get("locations") or [], report["coordinates"]):
+                if isinstance(name, str) and coords and coords.get("lat") is not None and coords.get("lon") is not None:
+                    yield name, float(coords["lat"]), float(coords["lon"])
+
+
+class PlaceIndex:
+    def __init__(self, radius_km=DEFAULT_RADIUS_KM, name_similarity_threshold=DEFAULT_NAME_SIMILARITY):
+        """Clusters geocoded location names into canonical places.
+
+        Args:
+            radius_km (float): Maximal distance between an alias and its place.
+            name_similarity_threshold (float): Minimal `name_similarity` between an alias
+                and the place's canonical name.
+        """
+        self.radius_km = radius_km
+        self.name_similarity_threshold = name_similarity_threshold
+        self.places = {}
+        self.aliases = {}
+        self._grid = {}
+        self._cell_deg = radius_km / KM_PER_DEGREE_LAT
+
+    def _cell(self, latitude, longitude):
+        return int(math.floor(latitude / self._cell_deg)), int(math.floor(longitude / self._cell_deg))
+
+    def _nearby(self, latitude, longitude):
+        # Cells are radius-sized in latitude degrees; a longitude degree is shorter, so scan wider columns
+        row, col = self._cell(latitude, longitude)
+        col_span = int(math.ceil(1 / max(math.cos(math.radians(latitude)), 0.01)))
+        for d_row in (-1, 0, 1):
+            for d_col in range(-col_span, col_span + 1):
+                yield from self._grid.get((row + d_row, col + d_col), ())
+
+    def add_alias(self, name, latitude, longitude):
+        """Assigns a (name, coordinates) pair to a place, creating one if needed. Returns the place ID."""
+        alias_key = (name, round(latitude, 6), round(longitude, 6))
+        if alias_key in self.aliases:
+            return self.aliases[alias_key]
+
+        best_id, best_distance = None, None
+        for pid in self._nearby(latitude, longitude):
+            place = self.places[pid]
+            distance = haversine_km(latitude, longitude, place["latitude"], place["longitude"])
+            if distance > self.radius_km:
+                continue
+            if name_similarity(name, place["name"]) < self.name_similarity_threshold:
+                continue
+            if best_distance is None or distance < best_distance:
+                best_id, best_distance = pid, distance
+
+        if best_id is None:
+            best_id = place_id(name, latitude, longitude)
+            self.places[best_id] = {
+                "id": best_id,
+                "name": name,
+                "latitude": latitude,
+                "longitude": longitude,
+                "aliases": [],
+            }
+            self._grid.setdefault(self._cell(latitude, longitude), []).append(best_id)
+
+        # each alias keeps its own coordinates, so a loaded index still finds it by them
+        self.places[best_id]["aliases"].append({"name": name, "latitude": latitude, "longitude": longitude})
+        self.aliases[alias_key] = best_id
+        return best_id
+
+    def build(self, named_points):
+        """Clusters an iterable of (name, latitude, longitude).
+
+        The most frequent spelling of a spot is added first, so it becomes the
+        canonical name of its place.
+        """
+        counts = {}
+        for point in named_points:
+            counts[point] = counts.get(point, 0) + 1
+        for name, latitude, longitude in sorted(counts, key=lambda p: (-counts[p], p)):
+            self.add_alias(name, latitude, longitude)
+        return self
+
+    def add_place(self, place):
+        """Restores a previously built place ({id, name, latitude, longitude, aliases}).
+
+        Aliases are {name, latitude, longitude}; bare names (saved before aliases kept
+        their coordinates) are restored at the place's coordinates.
+        """
+        place["aliases"] = [alias if isinstance(alias, dict) else
+                            {"name": alias, "latitude": place["latitude"], "longitude": place["longitude"]}
+                            for alias in place["aliases"]]
+        self.places[place["id"]] = place
+        self._grid.setdefault(self._cell(place["latitude"], place["longitude"]), []).append(place["id"])
+        for alias in place["aliases"]:
+            alias_key = (alias["name"], round(alias["latitude"], 6), round(alias["longitude"], 6))
+            self.aliases.setdefault(alias_key, place["id"])
+
+    def lookup(self, name, latitude, longitude):
+        """Returns the place ID of an alias, or None if it was never added."""
+        return self.aliases.get((name, round(latitude, 6), round(longitude, 6)))
+
+    def to_json(self):
+        return {"places": sorted(self.places.values(), key=lambda p: p["id"])}
+
+    def save(self, places_file=PLACES_FILE):
+        with open(places_file, "w", encoding="utf-8") as f:
+            json.dump(self.to_json(), f, ensure_ascii=False, indent=2)
+
+    @classmethod
+    def load(cls, places_file=PLACES_FILE, **kwargs):
+        """Loads places written by `save`, restoring every alias at its own coordinates."""
+        index = cls(**kwargs)
+        with open(places_file, "r", encoding="utf-8") as f:
+            data = json.load(f)
+        for place in data.get("places", []):
+            index.add_place(place)
+        return index
+
+
+def assign_place_ids(reports, index):
+    """Replaces per-report coordinates by place IDs, in place.
+
+    merged/tiuli reports get a `place_id` on each entry of `locations` and lose
+    `geocoded_locations`; grok.py reports get a `place_ids` list parallel to
+    `locations` and lose `coordinates`. Ungeocoded locations get a None ID.
+    """
+    for report in reports:
+        geocoded = report.pop("geocoded_locations", None)
+        if geocoded is not None:
+            for location in report.get("locations") or []:
+                if not isinstance(location, dict):
+                    continue
+                coords = geocoded.get(location.get("location_name"))
+                location["place_id"] = None
+                if coords:
+                    location["place_id"] = index.add_alias(location["location_name"],
+                                                           float(coords["latitude"]), float(coords["longitude"]))
+        coordinates = report.pop("coordinates", None)
+        if isinstance(coordinates, list):
+            report["place_ids"] = [
+                index.add_alias(name, float(coords["lat"]), float(coords["lon"]))
+                if coords and coords.get("lat") is not None and coords.get("lon") is not None else None
+                for name, coords in zip(report.get("locations") or [], coordinates)
+            ]
+    return reports
+
+
+def load_report_sources(merged_file=MERGED_REPORTS_FILE, tiuli_file=TIULI_REPORTS_FILE,
+                        wildflowers_file=WILDFLOWERS_DATA_FILE):
+    """Loads every available report source. Returns a {source_name: reports} dict."""
+    sources = {}
+    for source, path in (("merged", merged_file), ("tiuli", tiuli_file), ("wildflowers", wildflowers_file)):
+        if not path or not os.path.exists(path):
+            continue
+        with open(path, "r", encoding="utf-8") as f:
+            data = json.load(f)
+        sources[source] = data.get("reports", []) if isinstance(data, dict) else data
+    return sources
+
+
+def consolidate_places(sources, radius_km=DEFAULT_RADIUS_KM, name_similarity_threshold=DEFAULT_NAME_SIMILARITY):
+    """Builds a PlaceIndex over all sources and rewrites their reports to reference place IDs.
+
+    Args:
+        sources (dict): {source_name: reports}, as returned by `load_report_sources`.
+
+    Returns:
+        (PlaceIndex, list): the index and all reports, each tagged with its `source`.
+    """
+    index = PlaceIndex(radius_km=radius_km, name_similarity_threshold=name_similarity_threshold)
+    index.build(point for reports in sources.values() for point in iter_geocoded_names(reports))
+
+    all_reports = []
+    for source, reports in sources.items():
+        for report in assign_place_ids(reports, index):
+            report["source"] = source
+            all_reports.append(report)
+    return index, all_reports
+
+
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Merge location aliases into canonical place IDs")
+    parser.add_argument("--radius-km", type=float, default=DEFAULT_RADIUS_KM)
+    parser.add_argument("--name-similarity", type=float, default=DEFAULT_NAME_SIMILARITY)
+    parser.add_argument("--places-file", default=PLACES_FILE)
+    parser.add_argument("--output-file", default=CONSOLIDATED_REPORTS_FILE)
+    args = parser.parse_args()
+
+    sources = load_report_sources()
+    total_aliases = len({point for reports in sources.values() for point in iter_geocoded_names(reports)})
+    index, reports = consolidate_places(sources, args.radius_km, args.name_similarity)
+    index.save(args.places_file)
+    with open(args.output_file, "w", encoding="utf-8") as f:
+        json.dump({"reports": reports}, f, ensure_ascii=False)
+
+    print(f"Merged {total_aliases} geocoded aliases into {len(index.places)} places, saved to {args.places_file}")
+    print(f"Saved {len(reports)} reports with place IDs to {args.output_file}")
@@ -2,15 +2,13 @@ import os
 import logging
 import google.generativeai as genai
 
-# Configure logging
-logging.basicConfig(
-    level=logging.INFO,
-    format='%(asctime)s - %(levelname)s - %(message)s',
-    handlers=[
-        logging.FileHandler('processing.log'),
-        logging.StreamHandler()
-    ]
-)
+from instrument import add_profile_argument, count, profiling, span
+from logs import Progress, configure
+from replay import transport, wrap_model
+
+# Configure logging: to processing.log and stderr, written from a background thread
+configure(log_file='processing.log')
+logger = logging.getLogger(__name__)
 
 class FlowerReportProcessor:
     def __init__(self, api_key: str, prompt_path: str):
@@ -32,10 +30,12 @@ class FlowerReportProcessor:
             "top_k": 40,
             "max_output_tokens": 8192,
         }
-        self.model = genai.GenerativeModel(
+        self.model = wrap_model(genai.GenerativeModel(
             model_name="gemini-2.0-flash-exp",
             generation_config=generation_config,
-        )
+        ))
+        # files saved / without a response, logged every few seconds instead of per file
+        self.progress = Progress(logger, "extract_progress")
 
     def _load_prompt(self) -> str:
         try:
@@ -48,12 +48,14 @@ class FlowerReportProcessor:
     def _call_gemini_api(self, text: str) -> str:
         full_prompt = f"{self.prompt_template}\n\nInput Text:\n{text}"
         try:
-            response = self.model.generate_content(full_prompt)
-            return response.text
+            with span("gemini"):
+                response = self.model.generate_content(full_prompt)
+                return response.text
         except Exception as e:
             logging.error(f"API call failed: {str(e)}")
             return None
 
+    @span("process_file")
     def process_file(self, html_content: str, filename: str) -> None:
         """
         Processes an HTML content file by sending it to the Gemini API and saving the response.
@@ -66,20 +68,23 @@ class FlowerReportProcessor:
         Returns:
             None
         """
-        print(">>> Processing file:", filename)
         raw_response_text = self._call_gemini_api(html_content)
         if raw_response_text:
             output_filename = filename.replace('.html', '.json')
             output_path = os.path.join("output", output_filename)  # Simplified output path
             
             try:
-                with open(output_path, 'w', encoding='utf-8') as outfile:
+                with span("write"), open(output_path, 'w', encoding='utf-8') as outfile:
                     outfile.write(raw_response_text)  # Save raw text
-                logging.info(f"Saved raw response to {output_path}")
+                count("saved")
+                self.progress.add(saved=1)
+                logging.debug("Saved raw response to %s", output_path)
             except Exception as e:
                 logging.error(f"Error saving raw response for {filename}: {e}")
         else:
-           logging.warning(f"No response for {filename}")
+           count("no_response")
+           self.progress.add(no_response=1)
+           logging.warning("No response for %s", filename)
 
 def main():
     """
@@ -105,8 +110,10 @@ def main():
         with open(API_KEY_FILE, "r") as f:
             api_key = f.read().strip()
     except FileNotFoundError:
-        logging.error(f"API key file {API_KEY_FILE} not found")
-        return
+        if not transport.replaying:
+            logging.error(f"API key file {API_KEY_FILE} not found")
+            return
+        api_key = None
 
     # Initialize processor
     processor = FlowerReportProcessor(api_key, PROMPT_PATH)
@@ -116,7 +123,7 @@ def main():
     for filename in os.listdir(DATA_DIR):
         if filename.endswith(".html"):
             file_path = os.path.join(DATA_DIR, filename)
-            logging.info(f"Processing {filename}...")
+            logging.debug("Processing %s...", filename)
 
             try:
                 with open(file_path, 'r', encoding='utf-8') as f:
@@ -124,6 +131,14 @@ def main():
                 processor.process_file(content, filename)
             except Exception as e:
                  logging.error(f"Critical error processing {filename}: {str(e)}")
+    processor.progress.close()
 
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Extract the reports of the scraped pages in data/ with Gemini")
+    add_profile_argument(parser)
+    args = parser.parse_args()
+
+    with profiling("processor", args.profile):
+        main()
\ No newline at end of file
@@ -0,0 +1,335 @@
+import base64
+import hashlib
+import http.client
+import json
+import os
+import threading
+import time
+from collections import namedtuple
+from urllib.parse import parse_qsl, urlencode, urlsplit, urlunsplit
+
+# Record/replay of the external API calls (Gemini, the geocoders, the scraped sites).
+#
+#   API_REPLAY=record   calls the live APIs and stores every request/response pair
+#   API_REPLAY=replay   serves the stored responses without any network access or API keys
+#
+# Fixtures are recorded by running an ingest step with the live keys, e.g. the geocoder
+# calls the map layer needs (what benchmark.py and loadtest.py replay):
+#
+#   API_REPLAY=record MAPS_API_KEY=... python map_layer.py
+#
+# In replay mode, API_REPLAY_LATENCY ("0.2", "0.1:0.5" or "recorded") simulates the
+# response time, and API_REPLAY_QUOTA_RATE / API_REPLAY_ERROR_RATE inject quota (429)
+# errors and failures. Injected faults are a function of API_REPLAY_SEED, the request
+# and how often it was made, so a run is reproducible regardless of thread timing.
+# Only the stdlib is imported here: requests is imported by the adapter when used.
+MODE = os.getenv("API_REPLAY", "off")
+FIXTURES_DIR = os.getenv("API_FIXTURES_DIR", "fixtures/api")
+LATENCY = os.getenv("API_REPLAY_LATENCY", "0")
+QUOTA_RATE = float(os.getenv("API_REPLAY_QUOTA_RATE", "0"))
+ERROR_RATE = float(os.getenv("API_REPLAY_ERROR_RATE", "0"))
+SEED = os.getenv("API_REPLAY_SEED", "0")
+
+# Query parameters never written to the fixtures (nor part of their keys)
+SECRET_PARAMS = {"key", "api_key", "apikey", "token"}
+
+Place = namedtuple("Place", "latitude longitude address")
+
+
+class ReplayMiss(LookupError):
+    """No recorded response for a request in replay mode."""
+
+
+class QuotaExceeded(RuntimeError):
+    """Injected quota error (HTTP 429) for services without a response object to carry it."""
+
+
+class ReplayError(RuntimeError):
+    """Injected failure of a service call."""
+
+
+def redact_url(url):
+    parts = urlsplit(url)
+    query = [(name, value) for name, value in parse_qsl(parts.query, keep_blank_values=True)
+             if name.lower() not in SECRET_PARAMS]
+    return urlunsplit((parts.scheme, parts.netloc, parts.path, urlencode(sorted(query)), ""))
+
+
+class Transport:
+    def __init__(self, mode=MODE, fixtures_dir=FIXTURES_DIR, latency=LATENCY, quota_rate=QUOTA_RATE,
+                 error_rate=ERROR_RATE, seed=SEED):
+        """Records or replays service calls, one JSONL fixture file per service.
+
+        Args:
+            mode (str): "off", "record" or "replay".
+            fixtures_dir (str): Directory of the <service>.jsonl fixture files.
+            latency (str): Simulated response time in replay mode: seconds, "min:max"
+                seconds (spread deterministically per request) or "recorded".
+            quota_rate, error_rate (float): Fraction of replayed calls failing with a
+                quota error / a connection error.
+            seed (str): Seed of the fault and latency choices.
+        """
+        if mode not in ("off", "record", "replay"):
+            raise ValueError("API_REPLAY must be off, record or replay, not %r" % mode)
+        self.mode = mode
+        self.fixtures_dir = fixtures_dir
+        self.latency = latency
+        self.quota_rate = quota_rate
+        self.error_rate = error_rate
+        self.seed = seed
+        self.fixtures = {}
+        self.attempts = {}
+        self.counts = {"recorded": 0, "replayed": 0, "missed": 0, "quota": 0, "errors": 0}
+        self.lock = threading.Lock()
+
+    @property
+    def enabled(self):
+        return self.mode != "off"
+
+    @property
+    def replaying(self):
+        return self.mode == "replay"
+
+    def has_fixtures(self):
+        """Whether any service has recorded fixtures."""
+        return os.path.isdir(self.fixtures_dir) and any(
+            name.endswith(".jsonl") for name in os.listdir(self.fixtures_dir))
+
+    def _path(self, service):
+        return os.path.join(self.fixtures_dir, service.replace("/", "_") + ".jsonl")
+
+    def _load(self, service):
+        fixtures = self.fixtures.get(service)
+        if fixtures is None:
+            fixtures = {}
+            if os.path.exists(self._path(service)):
+                with open(self._path(service), "r", encoding="utf-8") as f:
+                    for line in f:
+                        if line.strip():
+                            entry = json.loads(line)
+                            fixtures[entry["key"]] = entry
+            self.fixtures[service] = fixtures
+        return fixtures
+
+    @staticmethod
+    def key(service, request):
+        return hashlib.sha1(json.dumps([service, request], ensure_ascii=False, sort_keys=True)
+                            .encode("utf-8")).hexdigest()[:20]
+
+    def record(self, service, request, response, elapsed):
+        entry = {"key": self.key(service, request), "request": request, "response": response,
+                 "elapsed": round(elapsed, 4)}
+        with self.lock:
+            self._load(service)[entry["key"]] = entry
+            os.makedirs(self.fixtures_dir, exist_ok=True)
+            with open(self._path(service), "a", encoding="utf-8") as f:
+                f.write(json.dumps(entry, ensure_ascii=False) + "\n")
+            self.counts["recorded"] += 1
+
+    def _draw(self, key, attempt, purpose):
+        digest = hashlib.sha1(("%s:%s:%d:%s" % (self.seed, key, attempt, purpose)).encode("utf-8")).digest()
+        return int.from_bytes(digest[:8], "big") / 2 ** 64
+
+    def _latency(self, entry, key, attempt):
+        if self.latency == "recorded":
+            return entry.get("elapsed", 0.0)
+        low, _, high = self.latency.partition(":")
+        low = float(low or 0)
+        if not high:
+            return low
+        return low + (float(high) - low) * self._draw(key, attempt, "latency")
+
+    def replay(self, service, request):
+        """Looks up a recorded response after the simulated latency.
+
+        Returns:
+            (fault, response): fault is None, "quota" or "error" (response is then None).
+
+        Raises:
+            ReplayMiss: if the request was never recorded.
+        """
+        key = self.key(service, request)
+        with self.lock:
+            entry = self._load(service).get(key)
+            if entry is None:
+                self.counts["missed"] += 1
+                raise ReplayMiss("no recorded %s response for %s" % (
+                    service, json.dumps(request, ensure_ascii=False)[:200]))
+            attempt = self.attempts.get(key, 0)
+            self.attempts[key] = attempt + 1
+        delay = self._latency(entry, key, attempt)
+        if delay:
+            time.sleep(delay)
+        draw = self._draw(key, attempt, "fault")
+        fault = "quota" if draw < self.quota_rate else "error" if draw < self.quota_rate + self.error_rate else None
+        with self.lock:
+            self.counts[{"quota": "quota", "error": "errors", None: "replayed"}[fault]] += 1
+        if fault:
+            return fault, None
+        return None, entry["response"]
+
+    def call(self, service, request, perform, quota_error=QuotaExceeded, error=ReplayError):
+        """Runs perform() -> JSON-serialisable response, recording it, or replays it.
+
+        Args:
+            service (str): Fixture file name.
+            request (dict): What identifies the call (without secrets).
+            quota_error, error (type): Exceptions raised for injected faults.
+        """
+        if self.replaying:
+            fault, response = self.replay(service, request)
+            if fault == "quota":
+                raise quota_error("injected quota error (429) for %s" % service)
+            if fault == "error":
+                raise error("injected %s failure" % service)
+            return response
+        started = time.perf_counter()
+        response = perform()
+        if self.mode == "record":
+            self.record(service, request, response, time.perf_counter() - started)
+        return response
+
+    def stats(self):
+        with self.lock:
+            return dict(self.counts, mode=self.mode)
+
+
+transport = Transport()
+
+
+class ReplayAdapter:
+    def __init__(self, adapter, transport=transport):
+        """requests transport adapter recording / replaying the responses of the adapter it wraps.
+
+        Fixtures are grouped by host. API keys are removed from the recorded URLs. An
+        injected quota error is a 429 response with Retry-After; an injected failure
+        and a replay miss raise requests.ConnectionError, as an unreachable host would.
+        """
+        self.adapter = adapter
+        self.transport = transport
+
+    def send(self, request, **kwargs):
+        import requests
+
+        body = request.body
+        if isinstance(body, bytes):
+            body = body.decode("utf-8", errors="replace")
+        key = {"method": request.method, "url": redact_url(request.url), "body": body}
+        service = urlsplit(request.url).hostname or "http"
+        if self.transport.replaying:
+            try:
+                fault, stored = self.transport.replay(service, key)
+            except ReplayMiss as e:
+                raise requests.ConnectionError(str(e), request=request)
+            if fault == "error":
+                raise requests.ConnectionError("injected connection error", request=request)
+            if fault == "quota":
+                stored = {"status": 429, "headers": {"Retry-After": "1"}, "content": ""}
+            return self._build_response(request, stored)
+
+        started = time.perf_counter()
+        response = self.adapter.send(request, **kwargs)
+        if self.transport.mode == "record":
+            headers = {name: value for name, value in response.headers.items()
+                       if name.lower() in ("content-type", "retry-after")}
+            self.transport.record(service, key, {"status": response.status_code, "headers": headers,
+                                                 "content": base64.b64encode(response.content).decode("ascii")},
+                                  time.perf_counter() - started)
+        return response
+
+    @staticmethod
+    def _build_response(request, stored):
+        from requests import Response
+        from requests.structures import CaseInsensitiveDict
+        from requests.utils import get_encoding_from_headers
+
+        response = Response()
+        response.status_code = stored["status"]
+        response.reason = http.client.responses.get(stored["status"], "")
+        response.headers = CaseInsensitiveDict(stored.get("headers", {}))
+        response.encoding = get_encoding_from_headers(response.headers)
+        response._content = base64.b64decode(stored.get("content", ""))
+        response.url = request.url
+        response.request = request
+        return response
+
+    def close(self):
+        self.adapter.close()
+
+
+def wrap_session(session, transport=transport):
+    """Routes the requests of a requests.Session through the transport (a no-op when it is off). Returns the session."""
+    if transport.enabled:
+        for prefix, adapter in list(session.adapters.items()):
+            if not isinstance(adapter, ReplayAdapter):
+                session.mount(prefix, ReplayAdapter(adapter, transport))
+    return session
+
+
+class ReplayResponse:
+    def __init__(self, text):
+        self.text = text
+
+
+class ReplayModel:
+    def __init__(self, model, service="gemini", quota_error=QuotaExceeded, transport=transport):
+        """A Gemini GenerativeModel whose generate_content() is recorded / replayed.
+
+        Only the response text is kept. quota_error is raised for injected quota
+        errors, e.g. google.api_core.exceptions.ResourceExhausted.
+        """
+        self.model = model
+        self.name = getattr(model, "model_name", None)
+        self.service = service
+        self.quota_error = quota_error
+        self.transport = transport
+
+    def generate_content(self, prompt, **kwargs):
+        request = {"model": self.name, "prompt": prompt}
+        response = self.transport.call(self.service, request,
+                                       lambda: {"text": self.model.generate_content(prompt, **kwargs).text},
+                                       self.quota_error)
+        return ReplayResponse(response["text"])
+
+
+def wrap_model(model, service="gemini", quota_error=QuotaExceeded, transport=transport):
+    """Records / replays a Gemini model's calls (returns the model itself when the transport is off)."""
+    return ReplayModel(model, service, quota_error, transport) if transport.enabled else model
+
+
+def wrap_geocode(geocode, service, transport=transport):
+    """Records / replays a geopy geocode(query, **kwargs) function.
+
+    The wrapped function returns a Place (latitude, longitude, address) or None.
+    """
+    if not transport.enabled:
+        return geocode
+
+    def replayable(query, **kwargs):
+        def perform():
+            location = geocode(query, **kwargs)
+            return None if location is None else [location.latitude, location.longitude, location.address]
+        options = {name: value for name, value in kwargs.items() if name != "timeout"}
+        result = transport.call(service, {"query": query, "options": options}, perform)
+        return None if result is None else Place(*result)
+    return replayable
+
+
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Summarise the recorded API fixtures")
+    parser.add_argument("--fixtures-dir", default=FIXTURES_DIR)
+    args = parser.parse_args()
+
+    if not os.path.isdir(args.fixtures_dir):
+        print(f"No fixtures in {args.fixtures_dir}; record some with API_REPLAY=record")
+    else:
+        store = Transport("replay", args.fixtures_dir)
+        for filename in sorted(os.listdir(args.fixtures_dir)):
+            if filename.endswith(".jsonl"):
+                service = filename[:-len(".jsonl")]
+                entries = store._load(service).values()
+                elapsed = sorted(entry.get("elapsed", 0.0) for entry in entries)
+                median = elapsed[len(elapsed) // 2] if elapsed else 0.0
+                print(f"{service}: {len(elapsed)} responses, median recorded latency {median * 1000:.0f}ms")
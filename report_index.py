@@ -0,0 +1,202 @@
+import bisect
+import math
+import threading
+import time
+
+import report_store
+
+# How often (seconds) the holder checks the store for new reports
+INDEX_CHECK_INTERVAL = 30
+
+
+def parse_bbox(bbox):
+    """Parses "min_lon,min_lat,max_lon,max_lat" into a tuple of floats. Raises ValueError if malformed."""
+    values = [float(v) for v in bbox.split(",")]
+    if len(values) != 4:
+        raise ValueError("bbox must be min_lon,min_lat,max_lon,max_lat")
+    if not all(math.isfinite(v) for v in values):
+        raise ValueError("bbox values must be finite numbers")
+    return tuple(values)
+
+
+def parse_cursor(cursor):
+    """Parses a "day:id" page cursor. Raises ValueError("invalid cursor") if malformed."""
+    try:
+        day, report_id = cursor.split(":")
+        return int(day), int(report_id)
+    except ValueError:
+        raise ValueError("invalid cursor") from None
+
+
+def bitmap(positions, size):
+    """The int with the bits at `positions` (all below `size`) set.
+
+    Built from a byte array in one pass: or-ing the bits into an int one at a time
+    copies the growing int each time, which is quadratic in the number of reports.
+    """
+    bits = bytearray((size + 7) // 8)
+    for position in positions:
+        bits[position >> 3] |= 1 << (position & 7)
+    return int.from_bytes(bits, "little")
+
+
+def in_bbox(latitude, longitude, bbox):
+    min_lon, min_lat, max_lon, max_lat = bbox
+    return latitude is not None and min_lat <= latitude <= max_lat and min_lon <= longitude <= max_lon
+
+
+def sighting_points(reports):
+    """Yields one point per geocoded sighting of reports in the `report_store.query_reports` format."""
+    for report in reports:
+        for sighting in report["sightings"]:
+            if sighting["latitude"] is None or sighting["longitude"] is None:
+                continue
+            yield {
+                "report_id": report["id"],
+                "source": report["source"],
+                "date": report["date"],
+                "day": report["day"],
+                "flower": sighting["flower"],
+                "location_name": sighting["location_name"],
+                "place_id": sighting["place_id"],
+                "latitude": sighting["latitude"],
+                "longitude": sighting["longitude"],
+            }
+
+
+class ReportIndex:
+    def __init__(self, reports, version, last_rewrite=0):
+        """Read-only in-memory indexes over the report store.
+
+        Reports are kept sorted by day (oldest first), so a date range is a contiguous
+        range of positions found by bisecting `days`. Flower postings and sources are
+        bitmaps (Python ints, bit i = report at position i); a query ANDs them together
+        and walks the set bits from the highest (newest report) down.
+
+        Args:
+            reports (list): Reports as returned by `report_store.query_reports`.
+            version (str): Version of the store the reports were read from (its last change sequence number).
+            last_rewrite (int): Sequence number of the last update or deletion in the store.
+                Indexes derived from a version at or after it can be brought up to date
+                by adding the reports they have not seen.
+        """
+        self.version = version
+        self.last_rewrite = last_rewrite
+        self.built_at = time.time()
+        self.reports = sorted(reports, key=lambda r: (r["day"] if r["day"] is not None else -1, r["id"]))
+        self.keys = [(r["day"] if r["day"] is not None else -1, r["id"]) for r in self.reports]
+        self.days = [key[0] for key in self.keys]
+        flower_positions = {}
+        source_positions = {}
+        for position, report in enumerate(self.reports):
+            source_positions.setdefault(report["source"], []).append(position)
+            for flower in {s["flower"] for s in report["sightings"] if s["flower"]}:
+                flower_positions.setdefault(flower, []).append(position)
+        size = len(self.reports)
+        self.flowers = {flower: bitmap(positions, size) for flower, positions in flower_positions.items()}
+        self.sources = {source: bitmap(positions, size) for source, positions in source_positions.items()}
+
+    def __len__(self):
+        return len(self.reports)
+
+    def match(self, date_from=None, date_to=None, flower=None, source=None):
+        """Returns the bitmap of reports matching the date range (day numbers), flower and source."""
+        lo = bisect.bisect_left(self.days, date_from) if date_from is not None else 0
+        hi = bisect.bisect_right(self.days, date_to) if date_to is not None else len(self.days)
+        mask = ((1 << hi) - 1) ^ ((1 << lo) - 1)
+        if flower:
+            mask &= self.flowers.get(flower, 0)
+        if source:
+            sources = source.split(",") if isinstance(source, str) else source
+            source_mask = 0
+            for name in sources:
+                source_mask |= self.sources.get(name, 0)
+            mask &= source_mask
+        return mask
+
+    def query(self, date_from=None, date_to=None, flower=None, source=None, bbox=None, cursor=None, limit=100):
+        """Returns (reports, next_cursor, total), newest first.
+
+        `cursor` is the opaque string returned as next_cursor by the previous page (None
+        for the first page). It names the last report returned rather than a position,
+        so paging stays consistent when the index is rebuilt with new reports.
+        `total` is the number of matches before the bbox filter.
+        """
+        mask = self.match(date_from, date_to, flower, source)
+        total = mask.bit_count()
+        if cursor is not None:
+            mask &= (1 << bisect.bisect_left(self.keys, parse_cursor(cursor))) - 1
+
+        results = []
+        while mask and len(results) < limit:
+            position = mask.bit_length() - 1
+            mask ^= 1 << position
+            report = self.reports[position]
+            if bbox is not None and not any(in_bbox(s["latitude"], s["longitude"], bbox) for s in report["sightings"]):
+                continue
+            results.append(report)
+        next_cursor = "%d:%d" % self.keys[position] if mask and len(results) == limit else None
+        return results, next_cursor, total
+
+
+def store_version(conn):
+    """Version of the store contents: the sequence number of its latest change."""
+    return str(report_store.last_seq(conn))
+
+
+def append_only_since(index, version):
+    """Whether the store only had reports inserted between `version` (of a derived index) and `index`."""
+    return version is not None and int(version) >= index.last_rewrite
+
+
+class ReportIndexHolder:
+    def __init__(self, store_file=report_store.STORE_FILE, check_interval=INDEX_CHECK_INTERVAL):
+        """Keeps a ReportIndex in sync with the report store.
+
+        The store is checked for changes at most every `check_interval` seconds and
+        the index is rebuilt (off the lock-free read path) only when its version changed.
+        An empty store is populated from the JSON sources by start(), in the background;
+        until then the index is empty.
+        """
+        self.store_file = store_file
+        self.check_interval = check_interval
+        self.index = None
+        self.checked_at = 0
+        self.lock = threading.Lock()
+
+    def get(self):
+        index = self.index
+        if index is not None and time.time() - self.checked_at < self.check_interval:
+            return index
+        with self.lock:
+            if self.index is None or time.time() - self.checked_at >= self.check_interval:
+                self._refresh()
+            return self.index
+
+    def populate(self):
+        """Ingests the JSON sources into the store if it is empty, then refreshes the index."""
+        conn = report_store.connect(self.store_file)
+        try:
+            if conn.execute("SELECT 1 FROM reports LIMIT 1").fetchone() is not None:
+                return
+            print('populating the empty report store %s' % self.store_file)
+            report_store.ingest_all(conn)
+        finally:
+            conn.close()
+        with self.lock:
+            self._refresh()
+
+    def start(self):
+        """Populates an empty store in a background thread (see populate), so no request waits for it."""
+        threading.Thread(target=self.populate, name="report-store-populate", daemon=True).start()
+
+    def _refresh(self):
+        conn = report_store.connect(self.store_file)
+        try:
+            version = store_version(conn)
+            if self.index is None or self.index.version != version:
+                self.index = ReportIndex(report_store.query_reports(conn), version, report_store.last_rewrite_seq(conn))
+                print('built report index %s with %d reports' % (version, len(self.index)))
+        finally:
+            conn.close()
+        self.checked_at = time.time()
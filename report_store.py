@@ -0,0 +1,477 @@
+import hashlib
+import json
+import os
+import sqlite3
+from datetime import date, datetime, timedelta
+
+from places import PlaceIndex, load_report_sources
+
+STORE_FILE = "reports.db"
+FLASK_REPORTS_FILE = "static/reports.json"
+
+EPOCH = date(1970, 1, 1)
+DATE_FORMATS = ("%d/%m/%Y", "%d.%m.%Y", "%d-%m-%Y", "%Y-%m-%d")
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS places (
+    id TEXT PRIMARY KEY,
+    name TEXT NOT NULL,
+    latitude REAL NOT NULL,
+    longitude REAL NOT NULL,
+    aliases TEXT NOT NULL DEFAULT '[]'
+);
+CREATE TABLE IF NOT EXISTS reports (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    report_key TEXT NOT NULL UNIQUE,
+    fingerprint TEXT NOT NULL,
+    source TEXT NOT NULL,
+    day INTEGER,
+    date TEXT,
+    observer TEXT,
+    title TEXT,
+    text TEXT,
+    source_file TEXT
+);
+CREATE TABLE IF NOT EXISTS sightings (
+    report_id INTEGER NOT NULL REFERENCES reports(id) ON DELETE CASCADE,
+    flower TEXT,
+    location_name TEXT,
+    place_id TEXT REFERENCES places(id)
+);
+CREATE INDEX IF NOT EXISTS reports_day ON reports(day);
+CREATE INDEX IF NOT EXISTS reports_source_day ON reports(source, day);
+CREATE INDEX IF NOT EXISTS sightings_report ON sightings(report_id);
+CREATE INDEX IF NOT EXISTS sightings_flower ON sightings(flower);
+CREATE INDEX IF NOT EXISTS sightings_place ON sightings(place_id);
+CREATE TABLE IF NOT EXISTS changes (
+    seq INTEGER PRIMARY KEY AUTOINCREMENT,
+    report_id INTEGER NOT NULL,
+    op TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS changes_report ON changes(report_id);
+CREATE TRIGGER IF NOT EXISTS reports_insert_change AFTER INSERT ON reports BEGIN
+    INSERT INTO changes (report_id, op) VALUES (new.id, 'insert');
+END;
+CREATE TRIGGER IF NOT EXISTS reports_update_change AFTER UPDATE ON reports BEGIN
+    INSERT INTO changes (report_id, op) VALUES (new.id, 'update');
+END;
+CREATE TRIGGER IF NOT EXISTS reports_delete_change AFTER DELETE ON reports BEGIN
+    INSERT INTO changes (report_id, op) VALUES (old.id, 'delete');
+END;
+"""
+# The reports changed after a sequence number, in the order of their latest change;
+# bound to (since, limit). A subquery rather than a list of IDs, which could exceed
+# SQLite's limit on bound variables (999 before 3.32)
+CHANGED_REPORTS_SQL = ("SELECT report_id FROM changes WHERE seq > ? "
+                       "GROUP BY report_id ORDER BY MAX(seq) LIMIT ?")
+
+# Incremented when the reports table changes shape; older stores are migrated by `connect`
+SCHEMA_VERSION = 1
+
+
+def parse_day(date_str):
+    """Converts a report date string (DD/MM/YYYY and friends) to a day number since 1970-01-01.
+
+    Returns None for missing or unparseable dates.
+    """
+    if not date_str:
+        return None
+    for date_format in DATE_FORMATS:
+        try:
+            return (datetime.strptime(date_str.strip(), date_format).date() - EPOCH).days
+        except ValueError:
+            continue
+    return None
+
+
+def format_day(day):
+    """Inverse of `parse_day`: day number to a DD/MM/YYYY string."""
+    if day is None:
+        return None
+    return (EPOCH + timedelta(days=day)).strftime("%d/%m/%Y")
+
+
+def _migrate(conn):
+    """Drops the reports of a store older than SCHEMA_VERSION, keeping its change log.
+
+    Such stores keyed reports on their content, so they are reingested. Every dropped
+    report is logged as deleted, and new IDs continue after the old ones, so change
+    feed cursors stay valid.
+    """
+    if conn.execute("PRAGMA user_version").fetchone()[0] >= SCHEMA_VERSION:
+        return
+    tables = {row[0] for row in conn.execute("SELECT name FROM sqlite_master WHERE type = 'table'")}
+    if "reports" in tables:
+        with conn:
+            if "changes" in tables:
+                conn.execute("INSERT INTO changes (report_id, op) SELECT id, 'delete' FROM reports ORDER BY id")
+            last_id = conn.execute("SELECT COALESCE(MAX(id), 0) FROM reports").fetchone()[0]
+            conn.execute("DROP TABLE sightings")
+            conn.execute("DROP TABLE reports")
+        conn.executescript(SCHEMA)
+        with conn:
+            conn.execute("INSERT INTO sqlite_sequence (name, seq) VALUES ('reports', ?)", (last_id,))
+    conn.execute("PRAGMA user_version = %d" % SCHEMA_VERSION)
+
+
+def connect(store_file=STORE_FILE):
+    """Opens (and creates, if needed) the report store.
+
+    Creating the schema is not free; long-lived readers should keep their connection.
+    """
+    conn = sqlite3.connect(store_file)
+    conn.row_factory = sqlite3.Row
+    conn.execute("PRAGMA foreign_keys = ON")
+    conn.execute("PRAGMA journal_mode = WAL")
+    _migrate(conn)
+    conn.executescript(SCHEMA)
+    if conn.execute("SELECT 1 FROM changes LIMIT 1").fetchone() is None:
+        # Stores created before the change log: every existing report counts as inserted
+        with conn:
+            conn.execute("INSERT INTO changes (report_id, op) SELECT id, 'insert' FROM reports ORDER BY id")
+    return conn
+
+
+def normalize_report(report, source):
+    """Converts a report of any of the source schemas into a common shape.
+
+    Returns a dict with date, observer, title, text, source_file and `sightings`,
+    a list of (flower, location_name, coordinates) where coordinates is a
+    (latitude, longitude) tuple or None.
+
+    Supported shapes:
+    - merged/tiuli: `locations[]` of {location_name, flowers, maps_query_location} plus
+      a `geocoded_locations` {name: {latitude, longitude}} map.
+    - grok.py (wildflowers_data.json): flat `flowers`, `locations` and parallel
+      `coordinates` [{lat, lon}] lists; every flower is paired with every location.
+    - flask_app.py: flat `flowers`, `locations` and `maps_query_locations` lists, with
+      an optional `geocoded_locations` map keyed by the maps query location.
+    """
+    geocoded = report.get("geocoded_locations") or {}
+
+    def coords_of(*names):
+        for name in names:
+            coords = geocoded.get(name) if name else None
+            if coords and coords.get("latitude") is not None and coords.get("longitude") is not None:
+                return float(coords["latitude"]), float(coords["longitude"])
+        return None
+
+    sightings = []
+    locations = report.get("locations") or []
+    if locations and isinstance(locations[0], dict):
+        for location in locations:
+            name = location.get("location_name") or location.get("maps_query_location")
+            coords = coords_of(location.get("location_name"), location.get("maps_query_location"))
+            for flower in location.get("flowers") or [None]:
+                sightings.append((flower, name, coords))
+    else:
+        flowers = report.get("flowers") or [None]
+        if isinstance(flowers, str):
+            flowers = [flowers]
+        if isinstance(locations, str):
+            locations = [locations]
+        coordinates = report.get("coordinates")
+        queries = report.get("maps_query_locations") or []
+        for i, name in enumerate(locations):
+            coords = None
+            if isinstance(coordinates, list) and i < len(coordinates) and coordinates[i]:
+                if coordinates[i].get("lat") is not None and coordinates[i].get("lon") is not None:
+                    coords = (float(coordinates[i]["lat"]), float(coordinates[i]["lon"]))
+            if coords is None:
+                coords = coords_of(queries[i] if i < len(queries) else None, name)
+            for flower in flowers:
+                sightings.append((flower, name, coords))
+
+    description = report.get("description")
+    if isinstance(description, list):
+        description = "\n".join(description)
+    text = report.get("original_text") or report.get("original_report") or description
+
+    return {
+        "date": report.get("date"),
+        "observer": report.get("observer") or report.get("reporter") or None,
+        "title": report.get("title"),
+        "text": text,
+        "source_file": report.get("source_file"),
+        "sightings": sightings,
+    }
+
+
+def report_key(source, normalized, occurrence=0):
+    """Stable identity of a report across re-ingests: its source, file, date, observer and title.
+
+    `occurrence` tells apart reports sharing all of these (the n-th one in the source).
+    Edits to a report's text or sightings keep its key, so it is updated in place.
+    """
+    key = json.dumps([source, normalized["source_file"], normalized["date"], normalized["observer"],
+                      normalized["title"], occurrence], ensure_ascii=False)
+    return hashlib.sha1(key.encode("utf-8")).hexdigest()
+
+
+def report_fingerprint(source, normalized):
+    """Content hash of a report, geocoded coordinates included; a changed one means the report was edited."""
+    key = json.dumps([source, normalized["date"], normalized["observer"], normalized["title"], normalized["text"],
+                      normalized["source_file"],
+                      sorted({(f or "", n or "", tuple(c) if c else None) for f, n, c in normalized["sightings"]},
+                             key=json.dumps)],
+                     ensure_ascii=False)
+    return hashlib.sha1(key.encode("utf-8")).hexdigest()
+
+
+def load_place_index(conn):
+    """Rebuilds a PlaceIndex from the places table, so new aliases join existing places."""
+    index = PlaceIndex()
+    for row in conn.execute("SELECT id, name, latitude, longitude, aliases FROM places"):
+        index.add_place({"id": row["id"], "name": row["name"], "latitude": row["latitude"],
+                         "longitude": row["longitude"], "aliases": json.loads(row["aliases"])})
+    return index
+
+
+def ingest_reports(conn, reports, source, place_index=None, complete=False):
+    """Normalises reports into the store, keyed on `report_key`.
+
+    New reports are inserted and stored ones whose content changed are updated in
+    place (their sightings replaced); unchanged ones are skipped. Each insert, update
+    and deletion is recorded in the change log.
+
+    Args:
+        conn (sqlite3.Connection): An open store, from `connect`.
+        reports (list): Reports in any of the supported source schemas.
+        source (str): Source label stored with each report ("merged", "tiuli", ...).
+        place_index (PlaceIndex or None): Index used to assign place IDs. Loaded from
+            the store if None.
+        complete (bool): `reports` are all the reports of `source`: stored ones missing
+            from them are deleted.
+
+    Returns:
+        dict: The number of reports "inserted", "updated" and "deleted".
+    """
+    if place_index is None:
+        place_index = load_place_index(conn)
+
+    stored = {row["report_key"]: (row["id"], row["fingerprint"])
+              for row in conn.execute("SELECT id, report_key, fingerprint FROM reports WHERE source = ?", (source,))}
+    counts = {"inserted": 0, "updated": 0, "deleted": 0}
+    occurrences = {}
+    seen = set()
+    sighting_rows = []
+    with conn:
+        for report in reports:
+            normalized = normalize_report(report, source)
+            identity = report_key(source, normalized)
+            occurrence = occurrences[identity] = occurrences.get(identity, -1) + 1
+            key = report_key(source, normalized, occurrence) if occurrence else identity
+            seen.add(key)
+            fingerprint = report_fingerprint(source, normalized)
+            values = (fingerprint, parse_day(normalized["date"]), normalized["date"], normalized["observer"],
+                      normalized["title"], normalized["text"], normalized["source_file"])
+            if key not in stored:
+                report_id = conn.execute(
+                    "INSERT INTO reports (fingerprint, day, date, observer, title, text, source_file, report_key, source) "
+                    "VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)", values + (key, source)).lastrowid
+                stored[key] = (report_id, fingerprint)
+                counts["inserted"] += 1
+            elif stored[key][1] != fingerprint:
+                report_id = stored[key][0]
+                conn.execute("UPDATE reports SET fingerprint = ?, day = ?, date = ?, observer = ?, title = ?, text = ?, "
+                             "source_file = ? WHERE id = ?", values + (report_id,))
+                conn.execute("DELETE FROM sightings WHERE report_id = ?", (report_id,))
+                counts["updated"] += 1
+            else:
+                continue
+            for flower, name, coords in normalized["sightings"]:
+                pid = place_index.add_alias(name, coords[0], coords[1]) if name and coords else None
+                sighting_rows.append((report_id, flower, name, pid))
+
+        if complete:
+            removed = [(report_id,) for key, (report_id, _) in stored.items() if key not in seen]
+            conn.executemany("DELETE FROM reports WHERE id = ?", removed)
+            counts["deleted"] = len(removed)
+
+        # Places first, so the sightings' place_id foreign keys resolve
+        conn.executemany(
+            "INSERT INTO places (id, name, latitude, longitude, aliases) VALUES (?, ?, ?, ?, ?) "
+            "ON CONFLICT(id) DO UPDATE SET aliases = excluded.aliases",
+            [(pid, place["name"], place["latitude"], place["longitude"], json.dumps(place["aliases"], ensure_ascii=False))
+             for pid, place in place_index.places.items()])
+        conn.executemany("INSERT INTO sightings (report_id, flower, location_name, place_id) VALUES (?, ?, ?, ?)",
+                         sighting_rows)
+    return counts
+
+
+def ingest_all(conn, flask_reports_file=FLASK_REPORTS_FILE, **source_files):
+    """Ingests every available JSON source (see `places.load_report_sources`), each as complete.
+
+    Returns:
+        dict: {source: counts}, counts as returned by `ingest_reports`.
+    """
+    sources = load_report_sources(**source_files)
+    if flask_reports_file and os.path.exists(flask_reports_file):
+        with open(flask_reports_file, "r", encoding="utf-8") as f:
+            sources["flask"] = json.load(f)
+
+    place_index = load_place_index(conn)
+    return {source: ingest_reports(conn, reports, source, place_index, complete=True)
+            for source, reports in sources.items()}
+
+
+def _filters(date_from=None, date_to=None, flower=None, place_id=None, source=None, changed=None):
+    """Builds the WHERE clause shared by the query helpers. Dates are day numbers or date strings.
+
+    `changed` is (since, limit): only the first `limit` reports changed after sequence
+    number `since` (see query_changes).
+    """
+    clauses, params = [], []
+    if changed is not None:
+        clauses.append("r.id IN (%s)" % CHANGED_REPORTS_SQL)
+        params.extend(changed)
+    if isinstance(date_from, str):
+        date_from = parse_day(date_from)
+    if isinstance(date_to, str):
+        date_to = parse_day(date_to)
+    if date_from is not None:
+        clauses.append("r.day >= ?")
+        params.append(date_from)
+    if date_to is not None:
+        clauses.append("r.day <= ?")
+        params.append(date_to)
+    if flower is not None:
+        clauses.append("s.flower = ?")
+        params.append(flower)
+    if place_id is not None:
+        clauses.append("s.place_id = ?")
+        params.append(place_id)
+    if source is not None:
+        clauses.append("r.source = ?")
+        params.append(source)
+    return (" WHERE " + " AND ".join(clauses)) if clauses else "", params
+
+
+def query_sightings(conn, date_from=None, date_to=None, flower=None, place_id=None, source=None, geocoded_only=True):
+    """Returns sighting rows joined with their report and place, ordered by date (newest first).
+
+    Each row has report_id, source, day, date, observer, title, text, flower,
+    location_name, place_id, place_name, latitude and longitude.
+    """
+    where, params = _filters(date_from, date_to, flower, place_id, source)
+    if geocoded_only:
+        where += (" AND " if where else " WHERE ") + "s.place_id IS NOT NULL"
+    sql = ("SELECT r.id AS report_id, r.source, r.day, r.date, r.observer, r.title, r.text, s.flower, "
+           "s.location_name, s.place_id, p.name AS place_name, p.latitude, p.longitude "
+           "FROM sightings s JOIN reports r ON r.id = s.report_id LEFT JOIN places p ON p.id = s.place_id"
+           + where + " ORDER BY r.day DESC, r.id, s.rowid")
+    return [dict(row) for row in conn.execute(sql, params)]
+
+
+def query_reports(conn, date_from=None, date_to=None, flower=None, place_id=None, source=None, changed=None):
+    """Returns matching reports, newest first, each with its list of sightings.
+
+    Reports are dicts with id, source, date, day, observer, title, text, source_file
+    and `sightings` [{flower, location_name, place_id, latitude, longitude}].
+    """
+    where, params = _filters(date_from, date_to, flower, place_id, source, changed)
+    ids_sql = "SELECT DISTINCT r.id FROM reports r LEFT JOIN sightings s ON s.report_id = r.id" + where
+    sql = ("SELECT r.*, s.flower, s.location_name, s.place_id, p.latitude, p.longitude FROM reports r "
+           "LEFT JOIN sightings s ON s.report_id = r.id LEFT JOIN places p ON p.id = s.place_id "
+           f"WHERE r.id IN ({ids_sql}) ORDER BY r.day DESC, r.id, s.rowid")
+    reports = {}
+    for row in conn.execute(sql, params):
+        report = reports.get(row["id"])
+        if report is None:
+            report = reports[row["id"]] = {key: row[key] for key in (
+                "id", "source", "date", "day", "observer", "title", "text", "source_file")}
+            report["sightings"] = []
+        if row["flower"] is not None or row["location_name"] is not None:
+            report["sightings"].append({key: row[key] for key in (
+                "flower", "location_name", "place_id", "latitude", "longitude")})
+    return list(reports.values())
+
+
+def flower_counts(conn, date_from=None, date_to=None, source=None):
+    """Returns [(flower, distinct report count)], most reported first."""
+    where, params = _filters(date_from, date_to, source=source)
+    where += (" AND " if where else " WHERE ") + "s.flower IS NOT NULL"
+    sql = ("SELECT s.flower, COUNT(DISTINCT r.id) AS reports FROM sightings s JOIN reports r ON r.id = s.report_id"
+           + where + " GROUP BY s.flower ORDER BY reports DESC, s.flower")
+    return [(row["flower"], row["reports"]) for row in conn.execute(sql, params)]
+
+
+def date_range(conn, source=None):
+    """Returns (first_day, last_day) of the stored reports, or (None, None)."""
+    where, params = _filters(source=source)
+    row = conn.execute("SELECT MIN(r.day), MAX(r.day) FROM reports r" + where, params).fetchone()
+    return row[0], row[1]
+
+
+def last_seq(conn):
+    """Sequence number of the latest change to the store (0 if none); a version of its contents."""
+    return conn.execute("SELECT COALESCE(MAX(seq), 0) FROM changes").fetchone()[0]
+
+
+def last_rewrite_seq(conn):
+    """Sequence number of the latest update or deletion (0 if reports were only ever inserted)."""
+    return conn.execute("SELECT COALESCE(MAX(seq), 0) FROM changes WHERE op != 'insert'").fetchone()[0]
+
+
+def query_changes(conn, since=0, limit=1000):
+    """Returns the reports changed after sequence number `since`, oldest change first.
+
+    Several changes to one report are collapsed into its latest state: op is
+    "delete" if the report no longer exists, "insert" if it was inserted after
+    `since`, and "update" otherwise.
+
+    Returns:
+        (list, int, bool): [{seq, op, id, report}] (report is None for deletions, else
+        as returned by `query_reports`), the cursor to pass as `since` for the next
+        page, and whether more changes follow.
+    """
+    # one read transaction, so both queries see the same changes even while an ingest commits
+    own_transaction = not conn.in_transaction
+    if own_transaction:
+        conn.execute("BEGIN")
+    try:
+        rows = conn.execute(
+            "SELECT report_id, MAX(seq) AS seq, SUM(op = 'insert') AS inserts FROM changes WHERE seq > ? "
+            "GROUP BY report_id ORDER BY seq LIMIT ?", (since, limit + 1)).fetchall()
+        more = len(rows) > limit
+        rows = rows[:limit]
+        reports = {}
+        if rows:
+            reports = {report["id"]: report for report in query_reports(conn, changed=(since, limit))}
+    finally:
+        if own_transaction:
+            conn.execute("COMMIT")
+    changes = []
+    for row in rows:
+        report = reports.get(row["report_id"])
+        op = "delete" if report is None else "insert" if row["inserts"] else "update"
+        changes.append({"seq": row["seq"], "op": op, "id": row["report_id"], "report": report})
+    return changes, rows[-1]["seq"] if rows else since, more
+
+
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Ingest and query the SQLite report store")
+    parser.add_argument("--store-file", default=STORE_FILE)
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    subparsers.add_parser("ingest", help="Ingest every available JSON report source")
+    query_parser = subparsers.add_parser("query", help="List matching sightings")
+    query_parser.add_argument("--from", dest="date_from", help="DD/MM/YYYY")
+    query_parser.add_argument("--to", dest="date_to", help="DD/MM/YYYY")
+    query_parser.add_argument("--flower")
+    query_parser.add_argument("--source")
+    args = parser.parse_args()
+
+    conn = connect(args.store_file)
+    if args.command == "ingest":
+        for source, counts in ingest_all(conn).items():
+            print(f"Ingested {source} reports: {counts['inserted']} new, {counts['updated']} updated, "
+                  f"{counts['deleted']} deleted")
+        first_day, last_day = date_range(conn)
+        total = conn.execute("SELECT COUNT(*) FROM reports").fetchone()[0]
+        print(f"Store has {total} reports from {format_day(first_day)} to {format_day(last_day)}")
+    else:
+        for row in query_sightings(conn, args.date_from, args.date_to, args.flower, source=args.source):
+            print(f"{row['date']}\t{row['flower']}\t{row['place_name']}\t{row['latitude']:.5f},{row['longitude']:.5f}")
+    conn.close()
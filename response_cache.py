@@ -0,0 +1,118 @@
+import functools
+import hashlib
+import os
+import threading
+from collections import OrderedDict
+
+from flask import Response, request
+
+from static_files import ENCODINGS, compressed_variants
+
+# Total size of the cached bodies (all encodings), in bytes
+RESPONSE_CACHE_BYTES = int(os.getenv("RESPONSE_CACHE_BYTES", str(64 * 1024 * 1024)))
+
+
+class CachedResponse:
+    def __init__(self, body, mimetype):
+        """A rendered response body with its precompressed variants and ETag."""
+        self.mimetype = mimetype
+        self.bodies = {None: body}
+        variants = compressed_variants(body)
+        for encoding, suffix in ENCODINGS:
+            if suffix in variants and len(variants[suffix]) < len(body):
+                self.bodies[encoding] = variants[suffix]
+        self.etag = hashlib.sha1(body).hexdigest()[:16]
+        self.size = sum(len(data) for data in self.bodies.values())
+
+    def response(self):
+        """Builds the response for the current request: 304, or the best accepted encoding.
+
+        Each encoding is a representation of its own, with its own strong ETag
+        (the identity ETag suffixed with "-gzip" or "-br").
+        """
+        encoding = request.accept_encodings.best_match([e for e in self.bodies if e is not None])
+        etag = "%s-%s" % (self.etag, encoding) if encoding else self.etag
+        response = Response(mimetype=self.mimetype)
+        response.set_etag(etag)
+        response.vary.add("Accept-Encoding")
+        if request.if_none_match.contains(etag):
+            response.status_code = 304
+            return response
+        response.set_data(self.bodies[encoding])
+        if encoding:
+            response.content_encoding = encoding
+        return response
+
+
+class ResponseCache:
+    def __init__(self, max_bytes=RESPONSE_CACHE_BYTES):
+        """LRU cache of rendered responses for one data version, bounded by the size of the bodies.
+
+        Entries are keyed by (route, query args). Accessing the cache with another
+        version drops every entry, so a snapshot swap invalidates it automatically.
+        """
+        self.max_bytes = max_bytes
+        self.version = None
+        self.entries = OrderedDict()
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+
+    def _check_version(self, version):
+        if version != self.version:
+            self.entries.clear()
+            self.size = 0
+            self.version = version
+
+    def get(self, key, version):
+        with self.lock:
+            self._check_version(version)
+            entry = self.entries.get(key)
+            if entry is None:
+                self.misses += 1
+                return None
+            self.entries.move_to_end(key)
+            self.hits += 1
+            return entry
+
+    def put(self, key, version, entry):
+        with self.lock:
+            self._check_version(version)
+            if entry.size > self.max_bytes:
+                return
+            old = self.entries.pop(key, None)
+            if old is not None:
+                self.size -= old.size
+            self.entries[key] = entry
+            self.size += entry.size
+            while self.size > self.max_bytes:
+                _, evicted = self.entries.popitem(last=False)
+                self.size -= evicted.size
+
+    def stats(self):
+        return {"version": self.version, "entries": len(self.entries), "bytes": self.size,
+                "hits": self.hits, "misses": self.misses}
+
+    def cached(self, get_version, mimetype="text/html"):
+        """Decorator caching the body a view returns, per route, query args and data version.
+
+        Args:
+            get_version (callable): () -> the current data version, or None to bypass
+                the cache (e.g. while there is nothing to serve yet).
+            mimetype (str): The mimetype of the view's string response.
+        """
+        def decorator(view):
+            @functools.wraps(view)
+            def wrapper(*args, **kwargs):
+                version = get_version()
+                if version is None:
+                    return view(*args, **kwargs)
+                key = (request.path, tuple(sorted(request.args.items(multi=True))))
+                entry = self.get(key, version)
+                if entry is None:
+                    entry = CachedResponse(view(*args, **kwargs).encode("utf-8"), mimetype)
+                    self.put(key, version, entry)
+                return entry.response()
+            return wrapper
+        return decorator
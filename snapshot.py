@@ -0,0 +1,162 @@
+import json
+import os
+import threading
+import time
+
+from map_layer import data_version
+
+REPORTS_FILE = "static/reports.json"
+REFRESH_INTERVAL = int(os.getenv("REFRESH_INTERVAL", "3600"))
+
+
+class Snapshot:
+    def __init__(self, reports, built_at, version=None):
+        """An immutable set of reports served to requests.
+
+        Args:
+            reports (list): The reports, in the flask_app.py format.
+            built_at (float): Epoch time the reports were produced (file mtime for loaded snapshots).
+            version (str or None): Data version, computed from the reports if None.
+        """
+        self.reports = reports
+        self.built_at = built_at
+        self.version = version or data_version(reports)
+
+    @property
+    def age(self):
+        return time.time() - self.built_at
+
+
+def write_atomic(path, data):
+    """Writes JSON to a temporary file and renames it over path, so readers never see a partial file."""
+    tmp_path = path + ".tmp"
+    with open(tmp_path, "w", encoding="utf-8") as f:
+        json.dump(data, f)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_path, path)
+
+
+class SnapshotRefresher:
+    def __init__(self, build, reports_file=REPORTS_FILE, interval=REFRESH_INTERVAL, on_swap=None):
+        """Serves the last good snapshot while rebuilding it in a background thread.
+
+        Args:
+            build (callable): () -> (err, reports); produces a fresh report list.
+            reports_file (str): On-disk copy of the snapshot, loaded at startup.
+            interval (int): Seconds between refreshes; also the maximal snapshot age.
+            on_swap (callable or None): Called with each new snapshot, in the refreshing
+                thread, after it is installed (e.g. to precompute derived data).
+        """
+        self.build = build
+        self.on_swap = on_swap
+        self.reports_file = reports_file
+        self.interval = interval
+        self.snapshot = None
+        self.last_refresh_at = None
+        self.last_refresh_duration = None
+        self.last_refresh_error = None
+        self._refresh_lock = threading.Lock()
+        self._stop = threading.Event()
+        self._thread = None
+        self._start_lock = threading.Lock()
+        self.load()
+
+    def load(self):
+        """Loads the on-disk snapshot, if any. Returns True on success."""
+        try:
+            with open(self.reports_file, "r") as f:
+                reports = json.load(f)
+            self.snapshot = Snapshot(reports, os.path.getmtime(self.reports_file))
+            print('loaded %d reports from %s' % (len(reports), self.reports_file))
+            return True
+        except FileNotFoundError:
+            print('file not found: %s' % self.reports_file)
+        except json.JSONDecodeError as e:
+            print('invalid snapshot file %s: %s' % (self.reports_file, e))
+        return False
+
+    @property
+    def refreshing(self):
+        return self._refresh_lock.locked()
+
+    def refresh(self, wait=True):
+        """Rebuilds the snapshot, then swaps it in and writes it to disk.
+
+        Only one refresh runs at a time: with wait=False, returns immediately (False)
+        if another refresh is in progress; with wait=True, waits for it and returns
+        its outcome instead of starting a second one.
+
+        Returns:
+            bool: whether a new snapshot was installed.
+        """
+        if not self._refresh_lock.acquire(blocking=False):
+            if not wait:
+                return False
+            with self._refresh_lock:
+                return self.last_refresh_error is None
+
+        try:
+            started = time.time()
+            try:
+                err, reports = self.build()
+            except Exception as e:
+                err, reports = "refresh failed: %s" % e, None
+            self.last_refresh_at = started
+            self.last_refresh_duration = time.time() - started
+            self.last_refresh_error = err
+            if err:
+                print('refresh failed, keeping the previous snapshot: %s' % err)
+                return False
+
+            write_atomic(self.reports_file, reports)
+            self.snapshot = Snapshot(reports, time.time())
+            print('refreshed snapshot %s with %d reports in %.1fs' % (
+                self.snapshot.version, len(reports), self.last_refresh_duration))
+            if self.on_swap is not None:
+                try:
+                    self.on_swap(self.snapshot)
+                except Exception as e:
+                    print('post-refresh step failed: %s' % e)
+            return True
+        finally:
+            self._refresh_lock.release()
+
+    def refresh_in_background(self):
+        threading.Thread(target=self.refresh, kwargs={"wait": False}, daemon=True).start()
+
+    def _run(self):
+        while not self._stop.is_set():
+            if self.snapshot is None or self.snapshot.age >= self.interval:
+                self.refresh(wait=False)
+            if self.snapshot is None or self.snapshot.age >= self.interval:
+                # The refresh failed: retry in a minute
+                delay = 60
+            else:
+                # Sleep until the snapshot goes stale
+                delay = self.interval - self.snapshot.age
+            self._stop.wait(max(delay, 1))
+
+    def start(self):
+        """Starts the background refresh thread (once)."""
+        with self._start_lock:
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name="snapshot-refresher", daemon=True)
+                self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+
+    def health(self):
+        """Returns a JSON-serialisable status of the snapshot and of the last refresh."""
+        snapshot = self.snapshot
+        return {
+            "status": "ok" if snapshot is not None else "no snapshot",
+            "snapshot_version": snapshot.version if snapshot else None,
+            "snapshot_reports": len(snapshot.reports) if snapshot else 0,
+            "snapshot_age_seconds": round(snapshot.age, 1) if snapshot else None,
+            "refreshing": self.refreshing,
+            "last_refresh_at": self.last_refresh_at,
+            "last_refresh_duration_seconds": self.last_refresh_duration,
+            "last_refresh_error": self.last_refresh_error,
+        }
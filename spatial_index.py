@@ -0,0 +1,244 @@
+import bisect
+import heapq
+import math
+import threading
+from array import array
+
+from places import EARTH_RADIUS_KM, haversine_km
+from report_index import sighting_points
+
+# Grid cell size in degrees (about 11 km north-south)
+CELL_DEGREES = 0.1
+KM_PER_DEGREE = math.pi * EARTH_RADIUS_KM / 180
+
+
+class SpatialIndex:
+    def __init__(self, points, version=None, cell_degrees=CELL_DEGREES):
+        """Grid-bucket spatial index over geocoded sightings.
+
+        Coordinates and days are kept in flat arrays; each grid bucket holds the ids of
+        its points sorted by day (with a parallel day array), so a date window inside
+        a bucket is a bisect and only the buckets overlapping the query area are read.
+
+        Args:
+            points (list): Sightings as yielded by `report_index.sighting_points`.
+            version (str): Version of the reports the points come from.
+            cell_degrees (float): Grid cell size in degrees.
+        """
+        self.version = version
+        self.cell_degrees = cell_degrees
+        self.points = list(points)
+        self.lats = array('d', (p["latitude"] for p in self.points))
+        self.lons = array('d', (p["longitude"] for p in self.points))
+        self.days = array('l', (p["day"] if p["day"] is not None else -1 for p in self.points))
+
+        buckets = {}
+        for i in range(len(self.points)):
+            buckets.setdefault(self._cell(self.lats[i], self.lons[i]), []).append(i)
+        # cell -> (ids sorted by day, their days)
+        self.buckets = {}
+        for cell, ids in buckets.items():
+            ids.sort(key=self.days.__getitem__)
+            self.buckets[cell] = (array('l', ids), array('l', (self.days[i] for i in ids)))
+
+        if self.buckets:
+            rows = [cell[0] for cell in self.buckets]
+            cols = [cell[1] for cell in self.buckets]
+            self.extent = (min(rows), min(cols), max(rows), max(cols))
+            max_abs_lat = max(abs(min(self.lats)), abs(max(self.lats)))
+        else:
+            self.extent = None
+            max_abs_lat = 0
+        # Narrowest cell side over the indexed area, the step of the kNN distance bound
+        self.min_cell_km = cell_degrees * KM_PER_DEGREE * math.cos(math.radians(min(max_abs_lat, 89)))
+
+    def __len__(self):
+        return len(self.points)
+
+    def _cell(self, lat, lon):
+        return int(math.floor(lat / self.cell_degrees)), int(math.floor(lon / self.cell_degrees))
+
+    def _cell_range(self, min_lat, min_lon, max_lat, max_lon):
+        """(row0, col0, row1, col1) of the cells overlapping an area, clamped to the indexed extent.
+
+        Returns None if the area misses the extent (or a bound is NaN), so the cost of a
+        query is bounded by the occupied grid, however large (or infinite) the area.
+        """
+        if self.extent is None or not (min_lat <= max_lat and min_lon <= max_lon):
+            return None
+        min_row, min_col, max_row, max_col = self.extent
+        size = self.cell_degrees
+        # clamped in degrees first, so huge bounds do not overflow int()
+        min_lat, max_lat = max(min_lat, min_row * size), min(max_lat, (max_row + 1) * size)
+        min_lon, max_lon = max(min_lon, min_col * size), min(max_lon, (max_col + 1) * size)
+        if min_lat > max_lat or min_lon > max_lon:
+            return None
+        row0, col0 = self._cell(min_lat, min_lon)
+        row1, col1 = self._cell(max_lat, max_lon)
+        return max(row0, min_row), max(col0, min_col), min(row1, max_row), min(col1, max_col)
+
+    def _candidates(self, cell, date_from, date_to, flower):
+        """Yields the ids of the points in a bucket that match the date window and flower."""
+        bucket = self.buckets.get(cell)
+        if bucket is None:
+            return
+        ids, days = bucket
+        lo = bisect.bisect_left(days, date_from) if date_from is not None else 0
+        hi = bisect.bisect_right(days, date_to) if date_to is not None else len(days)
+        for i in ids[lo:hi]:
+            if flower is None or self.points[i]["flower"] == flower:
+                yield i
+
+    def bbox(self, bbox, date_from=None, date_to=None, flower=None):
+        """Returns the points inside (min_lon, min_lat, max_lon, max_lat), optionally filtered by day and flower."""
+        min_lon, min_lat, max_lon, max_lat = bbox
+        cells = self._cell_range(min_lat, min_lon, max_lat, max_lon)
+        if cells is None:
+            return []
+        row0, col0, row1, col1 = cells
+        results = []
+        for row in range(row0, row1 + 1):
+            for col in range(col0, col1 + 1):
+                edge = row in (row0, row1) or col in (col0, col1)
+                for i in self._candidates((row, col), date_from, date_to, flower):
+                    if not edge or (min_lat <= self.lats[i] <= max_lat and min_lon <= self.lons[i] <= max_lon):
+                        results.append(self.points[i])
+        return results
+
+    def within(self, lat, lon, km, date_from=None, date_to=None, flower=None):
+        """Returns [(distance_km, point)] of the points within km of (lat, lon), nearest first."""
+        dlat = km / KM_PER_DEGREE
+        dlon = km / (KM_PER_DEGREE * max(math.cos(math.radians(min(abs(lat) + dlat, 89))), 1e-6))
+        cells = self._cell_range(lat - dlat, lon - dlon, lat + dlat, lon + dlon)
+        if cells is None:
+            return []
+        row0, col0, row1, col1 = cells
+        results = []
+        for row in range(row0, row1 + 1):
+            for col in range(col0, col1 + 1):
+                for i in self._candidates((row, col), date_from, date_to, flower):
+                    distance = haversine_km(lat, lon, self.lats[i], self.lons[i])
+                    if distance <= km:
+                        results.append((distance, i))
+        results.sort()
+        return [(distance, self.points[i]) for distance, i in results]
+
+    def nearest(self, lat, lon, k, max_km=None, date_from=None, date_to=None, flower=None):
+        """Returns [(distance_km, point)] of the k points nearest to (lat, lon), nearest first.
+
+        Searches rings of grid cells outwards from the query cell, and stops once the
+        k-th best distance is below the smallest possible distance of the next ring.
+        """
+        if self.extent is None or k <= 0:
+            return []
+        row, col = self._cell(lat, lon)
+        min_row, min_col, max_row, max_col = self.extent
+        max_ring = max(row - min_row, max_row - row, col - min_col, max_col - col)
+        # max-heap of the k best (negated distance, id)
+        best = []
+        for ring in range(max_ring + 1):
+            bound = max(ring - 1, 0) * self.min_cell_km
+            if len(best) == k and -best[0][0] <= bound:
+                break
+            if max_km is not None and bound > max_km:
+                break
+            for r in range(row - ring, row + ring + 1):
+                step = 1 if r in (row - ring, row + ring) else 2 * ring or 1
+                for c in range(col - ring, col + ring + 1, step):
+                    for i in self._candidates((r, c), date_from, date_to, flower):
+                        distance = haversine_km(lat, lon, self.lats[i], self.lons[i])
+                        if max_km is not None and distance > max_km:
+                            continue
+                        if len(best) < k:
+                            heapq.heappush(best, (-distance, i))
+                        elif distance < -best[0][0]:
+                            heapq.heapreplace(best, (-distance, i))
+        return [(-distance, self.points[i]) for distance, i in sorted(best, reverse=True)]
+
+
+class SpatialHolder:
+    def __init__(self):
+        """Keeps a SpatialIndex built from the current report_index.ReportIndex."""
+        self.spatial = SpatialIndex([])
+        self.lock = threading.Lock()
+
+    def get(self, report_index):
+        spatial = self.spatial
+        if spatial.version == report_index.version:
+            return spatial
+        with self.lock:
+            if self.spatial.version != report_index.version:
+                self.spatial = SpatialIndex(sighting_points(report_index.reports), report_index.version)
+            return self.spatial
+
+
+def synthesize(points, scale, seed=0):
+    """Returns `scale` copies of points, jittered by up to ~5 km and up to a year, for benchmarks."""
+    import random
+
+    rng = random.Random(seed)
+    synthetic = []
+    for copy in range(scale):
+        for point in points:
+            if copy == 0:
+                synthetic.append(point)
+                continue
+            day = point["day"] + rng.randint(-365, 365) if point["day"] is not None else None
+            synthetic.append(dict(point, latitude=point["latitude"] + rng.uniform(-0.05, 0.05),
+                                  longitude=point["longitude"] + rng.uniform(-0.05, 0.05), day=day))
+    return synthetic
+
+
+def benchmark(points, scales=(1, 10, 100), queries=200, seed=0):
+    """Times index builds and queries against a linear scan at several corpus sizes."""
+    import random
+    import time
+
+    rng = random.Random(seed)
+    for scale in scales:
+        data = synthesize(points, scale, seed)
+        started = time.perf_counter()
+        index = SpatialIndex(data)
+        build = time.perf_counter() - started
+        centers = [(p["latitude"], p["longitude"]) for p in rng.sample(data, min(queries, len(data)))]
+        last_day = max(index.days)
+
+        timings = {}
+        started = time.perf_counter()
+        for lat, lon in centers:
+            index.within(lat, lon, 10, date_from=last_day - 365)
+        timings['within 10km, 1y'] = time.perf_counter() - started
+        started = time.perf_counter()
+        for lat, lon in centers:
+            index.nearest(lat, lon, 10)
+        timings['nearest 10'] = time.perf_counter() - started
+        started = time.perf_counter()
+        for lat, lon in centers:
+            index.bbox((lon - 0.1, lat - 0.1, lon + 0.1, lat + 0.1))
+        timings['bbox 0.2deg'] = time.perf_counter() - started
+        started = time.perf_counter()
+        for lat, lon in centers[:20]:
+            [p for p in data if haversine_km(lat, lon, p["latitude"], p["longitude"]) <= 10
+             and p["day"] is not None and p["day"] >= last_day - 365]
+        timings['linear scan 10km, 1y'] = (time.perf_counter() - started) * len(centers) / min(len(centers), 20)
+
+        print(f"{scale}x: {len(data)} points, built in {build * 1000:.0f}ms, {len(index.buckets)} buckets")
+        for name, total in timings.items():
+            print(f"  {name}: {total / len(centers) * 1000:.3f}ms/query")
+
+
+if __name__ == "__main__":
+    import argparse
+
+    import report_store
+
+    parser = argparse.ArgumentParser(description="Benchmark the spatial index over the report store")
+    parser.add_argument("--store-file", default=report_store.STORE_FILE)
+    parser.add_argument("--scales", type=int, nargs="+", default=[1, 10, 100], help="Corpus size multipliers")
+    parser.add_argument("--queries", type=int, default=200)
+    args = parser.parse_args()
+
+    conn = report_store.connect(args.store_file)
+    points = list(sighting_points(report_store.query_reports(conn)))
+    conn.close()
+    benchmark(points, args.scales, args.queries)
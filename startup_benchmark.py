@@ -0,0 +1,65 @@
+import json
+import os
+import statistics
+import subprocess
+import sys
+
+# Routes requested, in order, by each fresh process after importing the app
+ROUTES = ("/healthz", "/map", "/reports", "/api/reports?limit=20")
+
+CHILD = """
+import json, sys, time
+started = time.perf_counter()
+import flask_app
+timings = {"import": time.perf_counter() - started}
+client = flask_app.app.test_client()
+for route in sys.argv[1:]:
+    started = time.perf_counter()
+    status = client.get(route).status_code
+    timings[route] = time.perf_counter() - started
+    timings[route + " status"] = status
+print("STARTUP_TIMINGS " + json.dumps(timings))
+"""
+
+
+def measure_once(routes=ROUTES, env=None):
+    """Imports flask_app in a fresh interpreter and times the import and the first request to each route."""
+    result = subprocess.run([sys.executable, "-c", CHILD] + list(routes), capture_output=True, text=True,
+                            env=env, cwd=os.path.dirname(os.path.abspath(__file__)))
+    for line in result.stdout.splitlines():
+        if line.startswith("STARTUP_TIMINGS "):
+            return json.loads(line[len("STARTUP_TIMINGS "):])
+    raise RuntimeError("startup run failed:\n" + result.stderr[-2000:])
+
+
+def benchmark(runs=5, routes=ROUTES, env=None):
+    """Returns {step: {median, max}} (seconds) over `runs` cold starts."""
+    samples = [measure_once(routes, env) for _ in range(runs)]
+    summary = {}
+    for step in ("import",) + tuple(routes):
+        values = [sample[step] for sample in samples]
+        summary[step] = {"median": statistics.median(values), "max": max(values),
+                         "status": samples[-1].get(step + " status")}
+    return summary
+
+
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Measure flask_app cold start: import time and first-response latency")
+    parser.add_argument("--runs", type=int, default=5)
+    parser.add_argument("--routes", nargs="+", default=list(ROUTES))
+    parser.add_argument("--no-refresh", action="store_true", help="Run with SNAPSHOT_REFRESH=0 (serve the prebuilt snapshot only)")
+    parser.add_argument("--output", help="Also write the results to this JSON file")
+    args = parser.parse_args()
+
+    env = dict(os.environ)
+    if args.no_refresh:
+        env["SNAPSHOT_REFRESH"] = "0"
+    summary = benchmark(args.runs, args.routes, env)
+    for step, values in summary.items():
+        status = "" if values["status"] is None else " (HTTP %d)" % values["status"]
+        print(f"{step}: median {values['median'] * 1000:.1f}ms, max {values['max'] * 1000:.1f}ms{status}")
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            json.dump({"runs": args.runs, "steps": summary}, f, indent=2)
@@ -0,0 +1,49 @@
+import gzip
+import os
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+# Precompressed variants written next to each file, in order of preference when serving
+ENCODINGS = (("br", ".br"), ("gzip", ".gz"))
+
+
+def compressed_variants(data):
+    """Returns {suffix: bytes} of the precompressed variants of data (brotli only if the module is installed).
+
+    gzip output has a fixed mtime so that unchanged content gives byte-identical files.
+    """
+    variants = {".gz": gzip.compress(data, compresslevel=9, mtime=0)}
+    if brotli is not None:
+        variants[".br"] = brotli.compress(data, quality=11)
+    return variants
+
+
+def write_if_changed(path, data):
+    """Writes data to path (atomically) unless the file already holds exactly that. Returns True if written."""
+    if os.path.exists(path) and os.path.getsize(path) == len(data):
+        with open(path, "rb") as f:
+            if f.read() == data:
+                return False
+    tmp_path = path + ".tmp"
+    with open(tmp_path, "wb") as f:
+        f.write(data)
+    os.replace(tmp_path, path)
+    return True
+
+
+def write_with_variants(path, data):
+    """Writes a file and its .gz/.br variants, skipping those already up to date. Returns True if the file changed."""
+    changed = write_if_changed(path, data)
+    if changed or not os.path.exists(path + ".gz"):
+        for suffix, compressed in compressed_variants(data).items():
+            write_if_changed(path + suffix, compressed)
+    return changed
+
+
+def remove_with_variants(path):
+    for candidate in (path,) + tuple(path + suffix for _, suffix in ENCODINGS):
+        if os.path.exists(candidate):
+            os.remove(candidate)
@@ -0,0 +1,242 @@
+import threading
+from bisect import bisect_left, bisect_right
+
+from report_index import append_only_since
+from report_store import format_day
+
+TOP_N = 5
+
+
+def month_of(day):
+    """Day number -> "YYYY-MM", None for undated reports."""
+    if day is None:
+        return None
+    dd, mm, yyyy = format_day(day).split("/")
+    return "%s-%s" % (yyyy, mm)
+
+
+def _add(counts, key, sightings, reports):
+    old = counts.get(key, (0, 0))
+    counts[key] = (old[0] + sightings, old[1] + reports)
+
+
+def _top(counts, n):
+    return sorted(counts.items(), key=lambda item: (-item[1], item[0]))[:n]
+
+
+class Series:
+    def __init__(self, rows):
+        """Running totals of one key of a cube table over its months, summed over any month range by two bisections.
+
+        Args:
+            rows (iterable): (month, sightings, reports); month is None for undated reports.
+        """
+        self.months = []
+        self.sightings = [0]
+        self.reports = [0]
+        self.undated = (0, 0)
+        for month, sightings, reports in sorted(rows, key=lambda row: (row[0] is None, row[0] or "")):
+            if month is None:
+                self.undated = (self.undated[0] + sightings, self.undated[1] + reports)
+                continue
+            self.months.append(month)
+            self.sightings.append(self.sightings[-1] + sightings)
+            self.reports.append(self.reports[-1] + reports)
+
+    def total(self, month_from=None, month_to=None):
+        """(sightings, reports) in a month range; undated reports count only when neither bound is given."""
+        if month_from is None and month_to is None:
+            return self.sightings[-1] + self.undated[0], self.reports[-1] + self.undated[1]
+        lo = bisect_left(self.months, month_from) if month_from is not None else 0
+        hi = bisect_right(self.months, month_to) if month_to is not None else len(self.months)
+        if hi <= lo:
+            return 0, 0
+        return self.sightings[hi] - self.sightings[lo], self.reports[hi] - self.reports[lo]
+
+
+def _series(table, key):
+    """Groups a {(month, ...): (sightings, reports)} table into {key(rest of the key): Series}."""
+    rows = {}
+    for (month, *rest), (sightings, reports) in table.items():
+        rows.setdefault(key(*rest), []).append((month, sightings, reports))
+    return {name: Series(series_rows) for name, series_rows in rows.items()}
+
+
+class StatsCube:
+    def __init__(self, version=None):
+        """Materialised report statistics over (month, flower, place, source).
+
+        Every table maps a key to (sightings, distinct reports). A report counts once
+        per cell, so distinct-report counts can be summed over months and sources;
+        the roll-ups by (month, source), (month, flower, source) and (month, place,
+        source) keep report totals, per-flower and per-place counts exact as well.
+        `with_reports` adds reports to copies of the tables and returns a new cube,
+        with the tables also laid out as running totals over months (see Series), so
+        a slice sums one entry per (flower or place, source) instead of every cell.
+        """
+        self.version = version
+        self.cells = {}
+        self.by_month = {}
+        self.by_flower = {}
+        self.by_place = {}
+        self.place_names = {}
+        self.report_ids = frozenset()
+        # {(flower, source): Series}, {(place, source): Series}, {flower: {(place, source): Series}}
+        self.flower_series = {}
+        self.place_series = {}
+        self.flower_place_series = {}
+        # {flower: [(month, source, sightings, reports)]}
+        self.flower_months = {}
+
+    def with_reports(self, reports, version):
+        new = StatsCube(version)
+        new.cells = dict(self.cells)
+        new.by_month = dict(self.by_month)
+        new.by_flower = dict(self.by_flower)
+        new.by_place = dict(self.by_place)
+        new.place_names = dict(self.place_names)
+        new.report_ids = self.report_ids | {report["id"] for report in reports}
+
+        for report in reports:
+            month, source = month_of(report["day"]), report["source"]
+            cells, flowers, places = {}, {}, {}
+            for sighting in report["sightings"]:
+                flower, place = sighting["flower"], sighting["place_id"]
+                if place is not None:
+                    new.place_names.setdefault(place, sighting["location_name"])
+                cells[flower, place] = cells.get((flower, place), 0) + 1
+                if flower:
+                    flowers[flower] = flowers.get(flower, 0) + 1
+                if place is not None:
+                    places[place] = places.get(place, 0) + 1
+            _add(new.by_month, (month, source), len(report["sightings"]), 1)
+            for (flower, place), sightings in cells.items():
+                _add(new.cells, (month, flower, place, source), sightings, 1)
+            for flower, sightings in flowers.items():
+                _add(new.by_flower, (month, flower, source), sightings, 1)
+            for place, sightings in places.items():
+                _add(new.by_place, (month, place, source), sightings, 1)
+        new._build_series()
+        return new
+
+    def _build_series(self):
+        self.flower_series = _series(self.by_flower, lambda flower, source: (flower, source))
+        self.place_series = _series(self.by_place, lambda place, source: (place, source))
+        by_flower_place = {}
+        for (month, flower, place, source), counts in self.cells.items():
+            if flower and place is not None:
+                by_flower_place.setdefault(flower, {})[month, place, source] = counts
+        self.flower_place_series = {flower: _series(table, lambda place, source: (place, source))
+                                    for flower, table in by_flower_place.items()}
+        self.flower_months = {}
+        for (month, flower, source), (sightings, reports) in self.by_flower.items():
+            self.flower_months.setdefault(flower, []).append((month, source, sightings, reports))
+
+    def slice(self, month_from=None, month_to=None, sources=None, flower=None, top=TOP_N):
+        """Sums the cube over a month range, a set of sources and optionally one flower.
+
+        Args:
+            month_from, month_to (str or None): "YYYY-MM" bounds, inclusive. Undated
+                reports are only counted when neither bound is given.
+            sources (collection or None): Sources to include, None for all.
+            flower (str or None): Restrict every count to this flower.
+            top (int): Length of the top locations / flowers lists.
+
+        Returns:
+            dict: totalReports, totalSightings, reportsPerFlower, flowerTypes (sightings
+            per flower), mostCommonFlowers, topLocations and monthlyTrends (reports per month).
+        """
+        def selected(month, source):
+            if sources is not None and source not in sources:
+                return False
+            if month_from is None and month_to is None:
+                return True
+            return month is not None and (month_from is None or month >= month_from) and (
+                month_to is None or month <= month_to)
+
+        def summed(series_by_key, counts, sighting_counts=None):
+            for (name, source), series in series_by_key.items():
+                if sources is not None and source not in sources:
+                    continue
+                sightings, reports = series.total(month_from, month_to)
+                if reports:
+                    counts[name] = counts.get(name, 0) + reports
+                    if sighting_counts is not None:
+                        sighting_counts[name] = sighting_counts.get(name, 0) + sightings
+
+        total_reports = total_sightings = 0
+        monthly = {}
+        flower_reports, flower_sightings, place_reports = {}, {}, {}
+        if flower is None:
+            # (month, source) rows: few, and the monthly trend needs each of them anyway
+            for (month, source), (sightings, reports) in self.by_month.items():
+                if selected(month, source):
+                    total_reports += reports
+                    total_sightings += sightings
+                    if month is not None:
+                        monthly[month] = monthly.get(month, 0) + reports
+            summed(self.flower_series, flower_reports, flower_sightings)
+            summed(self.place_series, place_reports)
+        else:
+            for month, source, sightings, reports in self.flower_months.get(flower, ()):
+                if selected(month, source):
+                    total_reports += reports
+                    total_sightings += sightings
+                    if month is not None:
+                        monthly[month] = monthly.get(month, 0) + reports
+            flower_reports = {flower: total_reports} if total_reports else {}
+            flower_sightings = {flower: total_sightings} if total_sightings else {}
+            summed(self.flower_place_series.get(flower, {}), place_reports)
+
+        return {
+            "totalReports": total_reports,
+            "totalSightings": total_sightings,
+            "reportsPerFlower": flower_reports,
+            "flowerTypes": flower_sightings,
+            "mostCommonFlowers": _top(flower_reports, top),
+            "topLocations": [{"place_id": place, "name": self.place_names.get(place), "reports": reports}
+                             for place, reports in _top(place_reports, top)],
+            "monthlyTrends": dict(sorted(monthly.items())),
+        }
+
+
+class StatsHolder:
+    def __init__(self):
+        """Keeps a StatsCube in step with a report_index.ReportIndex, off the request threads.
+
+        New reports are added to the cube; it is rebuilt from scratch only if reports were
+        updated or removed. The update runs in a background thread while get() keeps
+        serving the last cube, as api.py does for the map payload.
+        """
+        self.cube = None
+        self.lock = threading.Lock()
+
+    def get(self, report_index):
+        """Returns the cube of the index's version, else the last one built (None before the first).
+
+        A stale or missing cube is updated in a background thread (see update).
+        """
+        cube = self.cube
+        if cube is not None and cube.version == report_index.version:
+            return cube
+        if not self.lock.locked():
+            threading.Thread(target=self.update, args=(report_index,), name="stats-cube-build", daemon=True).start()
+        return cube
+
+    def update(self, report_index):
+        """Brings the cube up to the index's version, unless another thread is already updating it."""
+        if not self.lock.acquire(blocking=False):
+            return
+        try:
+            cube = self.cube or StatsCube()
+            if cube.version != report_index.version:
+                new_reports = [r for r in report_index.reports if r["id"] not in cube.report_ids]
+                if (not append_only_since(report_index, cube.version)
+                        or len(cube.report_ids) + len(new_reports) != len(report_index)):
+                    cube, new_reports = StatsCube(), report_index.reports
+                self.cube = cube.with_reports(new_reports, report_index.version)
+                print('added %d new reports to the statistics' % len(new_reports))
+        except Exception as e:
+            print('failed to update the statistics: %s: %s' % (type(e).__name__, e))
+        finally:
+            self.lock.release()
@@ -0,0 +1,175 @@
+import queue
+import threading
+import time
+
+# Marks the end of a stage's input
+_DONE = object()
+
+
+class RateLimiter:
+    def __init__(self, rate=None, burst=1):
+        """Token bucket shared by the threads calling one external service.
+
+        Args:
+            rate (float or None): Calls per second on average; None for no limit.
+            burst (int): Calls allowed back to back after an idle period.
+        """
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.updated = time.monotonic()
+        self.waited = 0.0
+        self.calls = 0
+        self.lock = threading.Lock()
+
+    def acquire(self):
+        """Blocks until a call is allowed. Returns the seconds waited."""
+        with self.lock:
+            self.calls += 1
+            if not self.rate:
+                return 0.0
+            now = time.monotonic()
+            self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+            self.tokens -= 1
+            # a negative balance is the time this caller has to wait for its token
+            delay = -self.tokens / self.rate if self.tokens < 0 else 0.0
+            self.waited += delay
+        if delay:
+            time.sleep(delay)
+        return delay
+
+
+class Stage:
+    def __init__(self, name, work, workers=1, limiter=None, queue_size=None, close=None):
+        """One step of a StreamPipeline.
+
+        Args:
+            name (str): Stage name, for logs and the summary.
+            work (callable): item -> iterable of items for the next stage (None for none).
+                Called from `workers` threads at once.
+            workers (int): Threads running `work`.
+            limiter (RateLimiter or None): Limiter of the service the stage calls. `work`
+                acquires it itself (once per external call); it is listed in the summary.
+            queue_size (int or None): Capacity of the stage's input queue, 2 * workers by default.
+                A full queue blocks the previous stage, so no stage runs far ahead.
+            close (callable or None): () -> iterable of items, called once after the last
+                item (e.g. to flush a batch).
+        """
+        self.name = name
+        self.work = work
+        self.workers = workers
+        self.limiter = limiter
+        self.queue_size = queue_size or 2 * workers
+        self.close = close
+        self.items = 0
+        self.errors = 0
+        self.busy = 0.0
+        self.blocked = 0.0
+        self.lock = threading.Lock()
+
+
+class StreamPipeline:
+    def __init__(self, stages, logger=None):
+        """Runs stages concurrently, connected by bounded queues.
+
+        Each stage has its own worker threads, so the network latency of one stage
+        overlaps with the others, and throughput is bounded by the slowest stage
+        (typically the tightest rate limit) instead of the sum of all latencies.
+        An exception in `work` is logged and counted; the item is dropped.
+        """
+        self.stages = stages
+        self.logger = logger
+        self.stopped = threading.Event()
+        self.queues = [queue.Queue(maxsize=stage.queue_size) for stage in stages]
+
+    def stop(self):
+        """Stops feeding new items; the items already in the pipeline are still processed."""
+        self.stopped.set()
+
+    def _put(self, index, item, stage=None):
+        started = time.perf_counter()
+        self.queues[index].put(item)
+        if stage is not None:
+            with stage.lock:
+                stage.blocked += time.perf_counter() - started
+
+    def _emit(self, index, stage, items):
+        if items is None or index + 1 == len(self.stages):
+            return
+        for item in items:
+            self._put(index + 1, item, stage)
+
+    def _worker(self, index, remaining):
+        stage = self.stages[index]
+        inbox = self.queues[index]
+        while True:
+            item = inbox.get()
+            if item is _DONE:
+                break
+            started = time.perf_counter()
+            try:
+                items = stage.work(item)
+                # generators run here, so their time counts as work, not as waiting on the next stage
+                items = list(items) if items is not None else None
+            except Exception as e:
+                items = None
+                with stage.lock:
+                    stage.errors += 1
+                if self.logger:
+                    self.logger.error(f"{stage.name}: {type(e).__name__}: {e}")
+            with stage.lock:
+                stage.busy += time.perf_counter() - started
+                stage.items += 1
+            self._emit(index, stage, items)
+
+        with stage.lock:
+            remaining[index] -= 1
+            last = remaining[index] == 0
+        if last:
+            if stage.close:
+                try:
+                    self._emit(index, stage, stage.close())
+                except Exception as e:
+                    with stage.lock:
+                        stage.errors += 1
+                    if self.logger:
+                        self.logger.error(f"{stage.name}: {type(e).__name__}: {e}")
+            if index + 1 < len(self.stages):
+                for _ in range(self.stages[index + 1].workers):
+                    self._put(index + 1, _DONE)
+
+    def run(self, items):
+        """Feeds items to the first stage until they run out or stop() is called, and waits for every stage to finish.
+
+        Returns:
+            float: The elapsed seconds.
+        """
+        started = time.perf_counter()
+        remaining = [stage.workers for stage in self.stages]
+        threads = [threading.Thread(target=self._worker, args=(index, remaining), daemon=True,
+                                    name=f"{stage.name}-{n}")
+                   for index, stage in enumerate(self.stages) for n in range(stage.workers)]
+        for thread in threads:
+            thread.start()
+        for item in items:
+            if self.stopped.is_set():
+                break
+            self._put(0, item)
+        for _ in range(self.stages[0].workers):
+            self._put(0, _DONE)
+        for thread in threads:
+            thread.join()
+        return time.perf_counter() - started
+
+    def summary(self, elapsed):
+        """One line per stage: items, errors, busy / blocked time and rate limiter waits."""
+        lines = []
+        for stage in self.stages:
+            line = (f"{stage.name}: {stage.items} items, {stage.errors} errors, {stage.workers} workers, "
+                    f"{100 * stage.busy / (stage.workers * elapsed or 1):.0f}% busy, "
+                    f"{stage.blocked:.1f}s blocked on the next stage")
+            if stage.limiter is not None and stage.limiter.rate:
+                line += f", {stage.limiter.calls} calls, {stage.limiter.waited:.1f}s rate limited"
+            lines.append(line)
+        return lines
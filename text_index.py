@@ -0,0 +1,265 @@
+import bisect
+import math
+import re
+import threading
+
+from gazetteer import FINAL_LETTERS, NIQQUD_RE
+from report_index import append_only_since
+
+# A word, possibly with niqqud and inner quotes (abbreviations such as צה"ל, ק"מ)
+WORD_RE = re.compile(r"(?:[^\W_]|[֑-ׇ])+(?:[\"'׳״](?:[^\W_]|[֑-ׇ])+)*")
+QUOTES_RE = re.compile(r"[\"'׳״]")
+# One-letter Hebrew prefixes (and, the, in, to, from, that, as), stripped up to MAX_PREFIX letters deep
+HEBREW_PREFIXES = "והבלמשכ"
+MAX_PREFIX = 3
+MIN_STEM_LENGTH = 3
+QUERY_RE = re.compile(r'"([^"]*)"|(\S+)')
+SNIPPET_WORDS = 12
+
+BM25_K1 = 1.2
+BM25_B = 0.75
+
+
+def normalize_token(word):
+    """Lower-cases a word, removes niqqud and quotes and folds Hebrew final letters."""
+    return QUOTES_RE.sub("", NIQQUD_RE.sub("", word)).lower().translate(FINAL_LETTERS)
+
+
+def tokenize(text):
+    """Yields (token, start, end) for each word of a text, with character offsets into it."""
+    for match in WORD_RE.finditer(text or ""):
+        token = normalize_token(match.group())
+        if token:
+            yield token, match.start(), match.end()
+
+
+def stems(token):
+    """Returns the token and its forms with up to MAX_PREFIX Hebrew prefix letters removed.
+
+    "ובמרבדי" -> ["ובמרבדי", "במרבדי", "מרבדי"]; stems shorter than MIN_STEM_LENGTH are dropped.
+    """
+    forms = [token]
+    for i in range(min(MAX_PREFIX, len(token) - MIN_STEM_LENGTH)):
+        if token[i] not in HEBREW_PREFIXES:
+            break
+        forms.append(token[i + 1:])
+    return forms
+
+
+def encode_varint(value, out):
+    while value >= 0x80:
+        out.append((value & 0x7F) | 0x80)
+        value >>= 7
+    out.append(value)
+
+
+def decode_varint(data, pos):
+    value = shift = 0
+    while True:
+        byte = data[pos]
+        pos += 1
+        value |= (byte & 0x7F) << shift
+        if byte < 0x80:
+            return value, pos
+        shift += 7
+
+
+def encode_postings(entries, last_doc=0):
+    """Encodes [(doc_id, [positions])] (doc ids increasing, above last_doc) as varint deltas."""
+    out = bytearray()
+    for doc_id, positions in entries:
+        encode_varint(doc_id - last_doc, out)
+        encode_varint(len(positions), out)
+        last_position = 0
+        for position in positions:
+            encode_varint(position - last_position, out)
+            last_position = position
+        last_doc = doc_id
+    return bytes(out)
+
+
+def decode_postings(data):
+    """Inverse of `encode_postings`: returns [(doc_id, [positions])]."""
+    entries = []
+    pos = doc_id = 0
+    while pos < len(data):
+        delta, pos = decode_varint(data, pos)
+        doc_id += delta
+        count, pos = decode_varint(data, pos)
+        positions = []
+        position = 0
+        for _ in range(count):
+            delta, pos = decode_varint(data, pos)
+            position += delta
+            positions.append(position)
+        entries.append((doc_id, positions))
+    return entries
+
+
+def report_text(report):
+    return "%s\n%s" % (report.get("title") or "", report.get("text") or "")
+
+
+def parse_query(query):
+    """Splits a query into clauses: lists of (token, is_prefix); a quoted phrase is one multi-token clause.
+
+    `מרבד*` is a prefix query, `"נחל עמוד"` a phrase.
+    """
+    clauses = []
+    for phrase, word in QUERY_RE.findall(query):
+        text = phrase if phrase else word
+        prefix = not phrase and text.endswith("*")
+        tokens = [token for token, _, _ in tokenize(text)]
+        if tokens:
+            clauses.append([(token, prefix and i == len(tokens) - 1) for i, token in enumerate(tokens)])
+    return clauses
+
+
+class TextIndex:
+    def __init__(self, version=None):
+        """Positional inverted index over report titles and texts, ranked with BM25.
+
+        Every word is indexed under its normalized form and under its prefix-stripped
+        stems at the same position, so "מרבדי" finds "ובמרבדי" and phrases still line up.
+        Postings are varint delta-encoded bytes per term; `with_reports` appends to the
+        touched terms only and returns a new index, leaving the current one readable.
+        """
+        self.version = version
+        self.postings = {}
+        self.last_doc = {}
+        self.doc_lengths = {}
+        self.docs = {}
+        self.total_length = 0
+        self._terms = None
+
+    def __len__(self):
+        return len(self.docs)
+
+    @property
+    def terms(self):
+        """Sorted term list, for prefix queries (built lazily)."""
+        if self._terms is None:
+            self._terms = sorted(self.postings)
+        return self._terms
+
+    def with_reports(self, reports, version):
+        """Returns a new index with reports added. Their ids must be above every indexed id."""
+        new = TextIndex(version)
+        new.postings = dict(self.postings)
+        new.last_doc = dict(self.last_doc)
+        new.doc_lengths = dict(self.doc_lengths)
+        new.docs = dict(self.docs)
+        new.total_length = self.total_length
+
+        added = {}
+        for report in sorted(reports, key=lambda r: r["id"]):
+            term_positions = {}
+            length = 0
+            for position, (token, _, _) in enumerate(tokenize(report_text(report))):
+                for form in stems(token):
+                    term_positions.setdefault(form, []).append(position)
+                length += 1
+            new.docs[report["id"]] = report
+            new.doc_lengths[report["id"]] = length
+            new.total_length += length
+            for term, positions in term_positions.items():
+                added.setdefault(term, []).append((report["id"], positions))
+
+        for term, entries in added.items():
+            new.postings[term] = new.postings.get(term, b"") + encode_postings(entries, new.last_doc.get(term, 0))
+            new.last_doc[term] = entries[-1][0]
+        return new
+
+    def _term_postings(self, token, prefix):
+        """Returns {doc_id: sorted positions} for a token (or every term it prefixes)."""
+        if not prefix:
+            # a query word that never occurs as such may still occur without its prefix letters
+            data = next((self.postings[form] for form in stems(token) if form in self.postings), None)
+            return dict(decode_postings(data)) if data else {}
+        merged = {}
+        terms = self.terms
+        for i in range(bisect.bisect_left(terms, token), len(terms)):
+            if not terms[i].startswith(token):
+                break
+            for doc_id, positions in decode_postings(self.postings[terms[i]]):
+                merged.setdefault(doc_id, set()).update(positions)
+        return {doc_id: sorted(positions) for doc_id, positions in merged.items()}
+
+    def _clause_postings(self, clause):
+        """Returns {doc_id: positions} where the clause's tokens occur consecutively."""
+        matches = self._term_postings(*clause[0])
+        for offset, (token, prefix) in enumerate(clause[1:], 1):
+            following = self._term_postings(token, prefix)
+            phrase = {}
+            for doc_id, positions in matches.items():
+                if doc_id in following:
+                    later = set(following[doc_id])
+                    found = [p for p in positions if p + offset in later]
+                    if found:
+                        phrase[doc_id] = found
+            matches = phrase
+        return matches
+
+    def search(self, query, limit=20):
+        """Returns (total, [(score, report, first match position)]) for the reports matching every clause, best first."""
+        clauses = parse_query(query)
+        if not clauses or not self.docs:
+            return 0, []
+        doc_count = len(self.docs)
+        average_length = self.total_length / doc_count
+        scores = None
+        first_match = {}
+        for clause in clauses:
+            matches = self._clause_postings(clause)
+            idf = math.log(1 + (doc_count - len(matches) + 0.5) / (len(matches) + 0.5))
+            clause_scores = {}
+            for doc_id, positions in matches.items():
+                tf = len(positions)
+                norm = BM25_K1 * (1 - BM25_B + BM25_B * self.doc_lengths[doc_id] / average_length)
+                clause_scores[doc_id] = idf * tf * (BM25_K1 + 1) / (tf + norm)
+                first_match[doc_id] = min(first_match.get(doc_id, positions[0]), positions[0])
+            if scores is None:
+                scores = clause_scores
+            else:
+                scores = {doc_id: score + clause_scores[doc_id] for doc_id, score in scores.items() if doc_id in clause_scores}
+        ranked = sorted(scores.items(), key=lambda item: (-item[1], -item[0]))
+        return len(ranked), [(score, self.docs[doc_id], first_match[doc_id]) for doc_id, score in ranked[:limit]]
+
+
+def snippet(report, position, words=SNIPPET_WORDS):
+    """Returns the text around the word at a token position of report_text(report)."""
+    text = report_text(report)
+    spans = [(start, end) for _, start, end in tokenize(text)]
+    if not spans:
+        return ""
+    first = max(position - words // 2, 0)
+    last = min(first + words, len(spans)) - 1
+    return ("..." if first else "") + text[spans[first][0]:spans[last][1]] + ("..." if last < len(spans) - 1 else "")
+
+
+class TextHolder:
+    def __init__(self):
+        """Keeps a TextIndex in step with a report_index.ReportIndex.
+
+        New reports are appended to the index; it is rebuilt from scratch only if
+        reports were updated or removed, or arrived with ids below the indexed ones.
+        """
+        self.text_index = TextIndex()
+        self.lock = threading.Lock()
+
+    def get(self, report_index):
+        text_index = self.text_index
+        if text_index.version == report_index.version:
+            return text_index
+        with self.lock:
+            text_index = self.text_index
+            if text_index.version != report_index.version:
+                new_reports = [r for r in report_index.reports if r["id"] not in text_index.docs]
+                last_id = max(text_index.docs, default=0)
+                if (not append_only_since(report_index, text_index.version)
+                        or len(text_index) + len(new_reports) != len(report_index)
+                        or any(r["id"] < last_id for r in new_reports)):
+                    text_index, new_reports = TextIndex(), report_index.reports
+                self.text_index = text_index = text_index.with_reports(new_reports, report_index.version)
+                print('indexed the text of %d new reports' % len(new_reports))
+            return text_index
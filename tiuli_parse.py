@@ -3,8 +3,12 @@ import os
 from bs4 import BeautifulSoup
 import re
 
+from instrument import add_profile_argument, count, profiling, span
+
+@span("extract_data_from_html")
 def extract_data_from_html(html_content, source_file):
-    soup = BeautifulSoup(html_content, 'html.parser')
+    with span("soup"):
+        soup = BeautifulSoup(html_content, 'html.parser')
     reports = []
     articles = soup.find_all('article', class_='shadow-card')
 
@@ -71,6 +75,7 @@ def extract_data_from_html(html_content, source_file):
 
         reports.append(report)
 
+    count("reports", len(reports))
     return reports
 
 
@@ -89,6 +94,12 @@ def process_html_files(html_dir):
     return {"reports": all_reports}
 
 if __name__ == '__main__':
+    import argparse
+
+    parser = argparse.ArgumentParser(description='Parse the scraped tiuli report pages into tiuli_reports.json')
+    add_profile_argument(parser)
+    args = parser.parse_args()
+
     html_directory = 'tiuli_scraped_reports'  # Directory with your HTML files
     output_file = "tiuli_reports.json"
     
@@ -97,9 +108,10 @@ if __name__ == '__main__':
         print(f"Error: Directory '{html_directory}' does not exist.")
         exit()
     
-    formatted_data = process_html_files(html_directory)
-    
-    with open(output_file, 'w', encoding='utf-8') as outfile:
-        json.dump(formatted_data, outfile, indent=2, ensure_ascii=False)
+    with profiling("tiuli_parse", args.profile):
+        formatted_data = process_html_files(html_directory)
+
+        with span("write"), open(output_file, 'w', encoding='utf-8') as outfile:
+            json.dump(formatted_data, outfile, indent=2, ensure_ascii=False)
 
-    print(f"Data extracted and saved to {output_file}")
\ No newline at end of file
+    print(f"Data extracted and saved to {output_file}")
@@ -0,0 +1,63 @@
+import logging
+
+from bs4 import BeautifulSoup, NavigableString
+
+from instrument import span
+
+logger = logging.getLogger(__name__)
+
+
+@span("parse_page")
+def parse_page(html, page_num):
+    """Splits a page into its reports (title, date, description, reporter, links)."""
+    soup = BeautifulSoup(html, 'html.parser')
+    content = soup.find('div', class_='aboutBody')
+    if not content:
+        logger.warning(f"No content found with class 'aboutBody' on page {page_num}")
+        return []
+        
+    bold_tags = content.find_all('b')
+    logger.info(f"Found {len(bold_tags)} bold tags on page {page_num}")
+    
+    reports = []
+    for bold_tag in bold_tags:
+        report = {
+            'title': bold_tag.get_text(strip=True),
+            'date': '',
+            'description': [],
+            'reporter': '',
+            'links': []
+        }
+        
+        current = bold_tag.next_sibling
+        while current:
+            if isinstance(current, BeautifulSoup) and current.name == 'b':
+                break
+            if isinstance(current, NavigableString):
+                text = current.strip()
+                if text:
+                    if text.startswith('תאריך:'):
+                        report['date'] = text.replace('תאריך:', '').strip()
+                    else:
+                        report['description'].append(text)
+            elif isinstance(current, BeautifulSoup):
+                if current.name == 'a':
+                    if 'mailto:' in current.get('href', ''):
+                        report['reporter'] = current.get_text(strip=True)
+                    elif 'http' in current.get('href', ''):
+                        report['links'].append({
+                            'text': current.get_text(strip=True),
+                            'url': current['href']
+                        })
+                elif current.name == 'br':
+                    next_sib = current.next_sibling
+                    if next_sib and isinstance(next_sib, BeautifulSoup) and next_sib.name == 'br':
+                        break
+            
+            current = current.next_sibling if current else None
+        
+        if report['title'] and report['date'] and not report['title'].startswith(('סך הכל:', '[', 'דווחים')):
+            reports.append(report)
+    
+    logger.info(f"Extracted {len(reports)} valid reports from page {page_num}")
+    return reports